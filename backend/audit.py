@@ -0,0 +1,114 @@
+"""
+Optional batched writer for history logs.
+
+With HISTORY_LOG_MODE=sync (the default) crud.create_history_log adds the row to
+the request's own transaction, exactly as before. With HISTORY_LOG_MODE=batched
+the entry is serialized once, held on the session until it commits (a rollback
+drops it), then pushed onto a bounded queue. A background thread drains the
+queue and inserts up to HISTORY_LOG_BATCH_SIZE rows per transaction.
+
+Entries created with durable=True always take the synchronous path.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from sqlalchemy import event, insert, bindparam, String
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+import models
+import database
+
+logger = logging.getLogger(__name__)
+
+HISTORY_LOG_MODE = os.getenv("HISTORY_LOG_MODE", "sync").lower()
+HISTORY_LOG_BATCH_SIZE = int(os.getenv("HISTORY_LOG_BATCH_SIZE", "500"))
+HISTORY_LOG_FLUSH_INTERVAL = float(os.getenv("HISTORY_LOG_FLUSH_INTERVAL", "0.5"))
+HISTORY_LOG_QUEUE_SIZE = int(os.getenv("HISTORY_LOG_QUEUE_SIZE", "10000"))
+
+# `changes` arrives pre-serialized, so bind it as plain text instead of through the JSON type
+_insert_logs = insert(models.HistoryLog.__table__).values(changes=bindparam("changes_json", type_=String()))
+_PENDING_KEY = "pending_history_logs"
+_STOP = object()
+
+_queue = queue.Queue(maxsize=HISTORY_LOG_QUEUE_SIZE)
+_thread = None
+
+
+def is_running() -> bool:
+    return _thread is not None and _thread.is_alive()
+
+
+def enqueue_after_commit(db: Session, entry: dict):
+    """Queues `entry` for the writer once `db` commits. Blocks if the queue is full (backpressure)."""
+    db.info.setdefault(_PENDING_KEY, []).append(entry)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending(session):
+    for entry in session.info.pop(_PENDING_KEY, ()):
+        _queue.put(entry)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+# --- Writer ---
+def _write_batch(engine, batch):
+    try:
+        with engine.begin() as conn:
+            conn.execute(_insert_logs, batch)
+        return
+    except IntegrityError:
+        pass
+    # A user or patient referenced by a queued entry was deleted before the flush:
+    # write rows one by one and detach the missing reference, as ON DELETE SET NULL would.
+    for entry in batch:
+        try:
+            with engine.begin() as conn:
+                conn.execute(_insert_logs, entry)
+        except IntegrityError:
+            with engine.begin() as conn:
+                conn.execute(_insert_logs, {**entry, "user_id": None, "patient_id": None})
+
+
+def _run(engine):
+    stopping = False
+    while not stopping:
+        item = _queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        deadline = time.monotonic() + HISTORY_LOG_FLUSH_INTERVAL
+        while len(batch) < HISTORY_LOG_BATCH_SIZE:
+            try:
+                item = _queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        try:
+            _write_batch(engine, batch)
+        except Exception:
+            logger.exception("Failed to write %d history log entries", len(batch))
+
+
+def start(engine=None):
+    global _thread
+    if is_running(): return
+    _thread = threading.Thread(target=_run, args=(engine or database.engine,), name="history-log-writer", daemon=True)
+    _thread.start()
+
+
+def stop(timeout: float = 30.0):
+    """Flushes everything queued so far and stops the writer (called from the lifespan shutdown)."""
+    global _thread
+    if not is_running(): return
+    _queue.put(_STOP)
+    _thread.join(timeout)
+    _thread = None
@@ -1,29 +1,103 @@
 import os
+import time
+import hashlib
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-import crud, models, schemas
-from database import get_db
+import crud, models, schemas, caching
+from database import get_db, get_async_db, uses_async
 
 # --- Configuration ---
 # Load from environment variables for security
 SECRET_KEY = os.getenv("SECRET_KEY", "a_default_secret_key_for_development")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Refresh tokens (see crud "Refresh Token Functions") renew access tokens without a password check
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14"))
 
 # --- Password Hashing ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Pinning min = max = default makes any hash with a different cost "need update",
+# so changing BCRYPT_ROUNDS re-hashes passwords on the next successful login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# bcrypt runs on its own small pool so a burst of logins cannot occupy the request threads.
+# At most WORKERS + QUEUE jobs are admitted at once; beyond that callers get PasswordHasherBusy (503).
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "32"))
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE)
+
+class PasswordHasherBusy(Exception):
+    """Raised when the password hashing queue is full."""
+
+def _submit_hash_job(fn, *args):
+    if not _hash_slots.acquire(blocking=False):
+        raise PasswordHasherBusy()
+    try:
+        future = _hash_executor.submit(fn, *args)
+    except BaseException:
+        _hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hash_slots.release())
+    return future
+
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return _submit_hash_job(pwd_context.verify, plain_password, hashed_password).result()
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return _submit_hash_job(pwd_context.hash, password).result()
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    return await asyncio.wrap_future(_submit_hash_job(pwd_context.verify, plain_password, hashed_password))
+
+async def verify_and_update_password_async(plain_password, hashed_password):
+    """Returns (is_valid, new_hash); new_hash is set when the stored hash uses an outdated cost."""
+    return await asyncio.wrap_future(_submit_hash_job(pwd_context.verify_and_update, plain_password, hashed_password))
+
+# --- Principal Cache ---
+# Authenticated requests resolve their user from this cache instead of loading the row per call.
+# Each entry remembers the `users` table version (see caching.py) it was loaded at, and a lookup
+# only hits while that version is current, so an update/approve/block/delete committed by any
+# worker process invalidates every worker's entries. The TTL bounds memory, not staleness.
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+def _get_cached_user(username: str, version: int) -> Optional[schemas.UserPrincipal]:
+    with _user_cache_lock:
+        entry = _user_cache.get(username)
+        if entry is None:
+            return None
+        expires_at, cached_version, principal = entry
+        if expires_at < time.monotonic() or cached_version != version:
+            del _user_cache[username]
+            return None
+        return principal
+
+def _cache_user(principal: schemas.UserPrincipal, version: int):
+    if USER_CACHE_TTL_SECONDS <= 0: return
+    with _user_cache_lock:
+        _user_cache[principal.user_name] = (time.monotonic() + USER_CACHE_TTL_SECONDS, version, principal)
+
+def invalidate_cached_user(*usernames: Optional[str]):
+    with _user_cache_lock:
+        for username in usernames:
+            _user_cache.pop(username, None)
 
 # --- JWT Token ---
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -36,13 +110,20 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def hash_refresh_token(token: str) -> str:
+    # Refresh tokens are 256 random bits, so a fast hash is enough; bcrypt would defeat their purpose
+    return hashlib.sha256(token.encode()).hexdigest()
+
 # --- User Authentication ---
-def authenticate_user(db: Session, username: str, password: str):
-    user = crud.get_user_by_username(db, username=username)
+async def authenticate_user(db: Session, username: str, password: str):
+    user = await run_in_threadpool(crud.get_user_by_username, db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    is_valid, new_hash = await verify_and_update_password_async(password, user.hashed_password)
+    if not is_valid:
         return False
+    if new_hash:
+        await run_in_threadpool(crud.update_password_hash, db, user, new_hash)
     # --- MODIFIED: Check if the user is blocked ---
     if user.is_blocked:
         return "BLOCKED"
@@ -52,12 +133,15 @@ def authenticate_user(db: Session, username: str, password: str):
     return user
 
 # --- Dependency for Getting Current User ---
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _username_from_token(token: str) -> str:
+    credentials_exception = _credentials_exception()
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -66,19 +150,60 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = crud.get_user_by_username(db, username=token_data.username)
+    return token_data.username
+
+def _principal_for(user, version: int) -> schemas.UserPrincipal:
     if user is None:
-        raise credentials_exception
-    return user
+        raise _credentials_exception()
+    principal = schemas.UserPrincipal.model_validate(user)
+    _cache_user(principal, version)
+    return principal
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    username = _username_from_token(token)
+    if USER_CACHE_TTL_SECONDS <= 0:
+        return _principal_for(crud.get_user_by_username(db, username=username), 0)
+    # Read before the user row, so a change committed in between leaves the entry already stale
+    version = db.scalar(caching.version_query("users")) or 0
+    principal = _get_cached_user(username, version)
+    if principal is None:
+        principal = _principal_for(crud.get_user_by_username(db, username=username), version)
+    return principal
 
-def get_current_active_user(current_user: models.User = Depends(get_current_user)):
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    username = _username_from_token(token)
+    load = select(models.User).where(models.User.user_name == username)
+    if USER_CACHE_TTL_SECONDS <= 0:
+        return _principal_for(await db.scalar(load), 0)
+    version = await db.scalar(caching.version_query("users")) or 0
+    principal = _get_cached_user(username, version)
+    if principal is None:
+        principal = _principal_for(await db.scalar(load), version)
+    return principal
+
+async def verify_current_user_password(db: Session, current_user: schemas.UserPrincipal, password: str) -> bool:
+    # The cached principal carries no password hash, so re-check against the stored row
+    user = await run_in_threadpool(crud.get_user, db, current_user.id)
+    return user is not None and await verify_password_async(password, user.hashed_password)
+
+def _ensure_active(current_user: schemas.UserPrincipal) -> schemas.UserPrincipal:
     # --- MODIFIED: Added check for blocked status on every API call ---
     if current_user.is_blocked:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Your account is blocked.")
     return current_user
 
+def get_current_active_user(current_user: schemas.UserPrincipal = Depends(get_current_user)):
+    return _ensure_active(current_user)
+
+async def get_current_active_user_async(current_user: schemas.UserPrincipal = Depends(get_current_user_async)):
+    return _ensure_active(current_user)
+
+def active_user_dependency(route_name: str):
+    """get_current_active_user for the session stack configured for `route_name` (see database.ASYNC_ROUTES)."""
+    return get_current_active_user_async if uses_async(route_name) else get_current_active_user
+
 # --- Dependency for Admin-Only Routes ---
-def require_admin(current_user: models.User = Depends(get_current_active_user)):
+def require_admin(current_user: schemas.UserPrincipal = Depends(get_current_active_user)):
     if current_user.role != "admin":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -87,7 +212,7 @@ def require_admin(current_user: models.User = Depends(get_current_active_user)):
     return current_user
 
 # --- Dependency for Modify Access (Admin, Staff, Doctor) ---
-def require_modify_access(current_user: models.User = Depends(get_current_active_user)):
+def require_modify_access(current_user: schemas.UserPrincipal = Depends(get_current_active_user)):
     if current_user.role not in ["admin", "staff", "doctor"]:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -0,0 +1,80 @@
+"""
+Compares how 1000-row /patients/ and /history/ pages are rendered: the default
+path (ORM objects validated against the response_model, then encoded by
+JSONResponse) versus fast_json (Core rows assembled into dicts and encoded
+once with orjson). Each path is timed in two stages: loading the page from the
+database, and rendering what was loaded into the response body. The render
+speed-up compares serialization alone; the total compares the whole request.
+Both outputs are checked to decode to the same JSON.
+
+Run from the backend directory (uses a database generated by datagen.py):
+    python benchmarks/bench_fast_json.py --db /tmp/bench.db [--limit 1000] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def median_ms(call, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = call()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    # database.py binds its engine on import
+    os.environ["DATABASE_URL"] = f"sqlite:///{args.db}"
+
+    from fastapi.responses import JSONResponse
+    from pydantic import TypeAdapter
+    import crud, schemas, fast_json
+    from database import SessionLocal
+
+    limit = args.limit
+    cases = {
+        "patients": (crud.get_patients, TypeAdapter(List[schemas.Patient]),
+                     lambda db: fast_json.load_patient_rows(db, db.scalars(crud.patient_page_ids_query(0, limit, {})).all()),
+                     lambda rows: fast_json.render_patients(*rows)),
+        "history": (crud.get_history_logs, TypeAdapter(List[schemas.HistoryLog]),
+                    lambda db: fast_json.load_history_rows(db, 0, limit, {}),
+                    fast_json.render_history),
+    }
+    print(f"encoder: {'orjson' if fast_json.orjson else 'json'}")
+    print(f"{'page':<10}{'path':<10}{'load ms':>10}{'render ms':>11}{'total ms':>10}{'KiB':>8}")
+    for name, (load, adapter, fast_load, fast_render) in cases.items():
+        with SessionLocal() as db:
+            # Default path: what FastAPI's serialize_response + JSONResponse do with the handler's objects
+            load_ms, rows = median_ms(lambda: load(db, skip=0, limit=limit, filters={}), args.repeat)
+            render = lambda: JSONResponse(adapter.dump_python(adapter.validate_python(rows, from_attributes=True), mode="json")).body
+            render_ms, slow_body = median_ms(render, args.repeat)
+            print(f"{name:<10}{'default':<10}{load_ms:>10.1f}{render_ms:>11.1f}{load_ms + render_ms:>10.1f}{len(slow_body) / 1024:>8.0f}")
+
+            fast_load_ms, fast_rows = median_ms(lambda: fast_load(db), args.repeat)
+            fast_render_ms, fast_body = median_ms(lambda: fast_json.dumps(fast_render(fast_rows)), args.repeat)
+            print(f"{name:<10}{'fast':<10}{fast_load_ms:>10.1f}{fast_render_ms:>11.1f}{fast_load_ms + fast_render_ms:>10.1f}{len(fast_body) / 1024:>8.0f}")
+
+        slow, quick = json.loads(slow_body), json.loads(fast_body)
+        # Staff of a patient come back in no particular order from the ORM path
+        for item in slow + quick:
+            if "staff_assigned" in item:
+                item["staff_assigned"].sort(key=lambda user: user["id"])
+        print(f"{'':<10}{'same JSON' if slow == quick else 'OUTPUT DIFFERS'}  render speed-up {render_ms / fast_render_ms:.1f}x, "
+              f"total {(load_ms + render_ms) / (fast_load_ms + fast_render_ms):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
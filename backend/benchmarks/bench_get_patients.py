@@ -0,0 +1,95 @@
+"""
+Compares the old joinedload fan-out in crud.get_patients with the two-phase
+(id page + selectinload) loader.
+
+Run from the backend directory:
+    python benchmarks/bench_get_patients.py [--patients 10000] [--anex 100000]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, joinedload
+import crud, models
+import datagen
+
+
+def legacy_get_patients(db, skip=0, limit=100, filters=None):
+    """crud.get_patients as it was before the two-phase loader."""
+    query = db.query(models.Patient).options(
+        joinedload(models.Patient.staff_assigned),
+        joinedload(models.Patient.anex_records).joinedload(models.AnexRecord.doctor),
+        joinedload(models.Patient.anex_records).joinedload(models.AnexRecord.service),
+        joinedload(models.Patient.anex_records).joinedload(models.AnexRecord.finance),
+    )
+    if filters:
+        if filters.get("lastname"):
+            query = query.filter(models.Patient.last_name.ilike(f"%{filters['lastname']}%"))
+        if filters.get("research"):
+            query = query.join(models.Patient.anex_records).join(models.AnexRecord.service).filter(
+                models.Service.research_name.ilike(f"%{filters['research']}%")
+            )
+    return query.distinct().order_by(models.Patient.id).offset(skip).limit(limit).all()
+
+
+def measure(Session, db_path, loader, repeat, **kwargs):
+    statements = []
+    engine = Session.kw["bind"]
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    # One instrumented run to count the rows SQLite hands back
+    event.listen(engine, "before_cursor_execute", capture)
+    with Session() as db:
+        patients = loader(db, **kwargs)
+    event.remove(engine, "before_cursor_execute", capture)
+    raw = sqlite3.connect(db_path)
+    rows = sum(len(raw.execute(stmt, params).fetchall()) for stmt, params in statements)
+    raw.close()
+
+    timings = []
+    for _ in range(repeat):
+        with Session() as db:
+            start = time.perf_counter()
+            loader(db, **kwargs)
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {"patients": len(patients), "statements": len(statements), "rows": rows,
+            "median_ms": timings[len(timings) // 2] * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=10_000)
+    parser.add_argument("--anex", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    print(f"Seeding {args.patients} patients / {args.anex} anex records into {db_path} ...")
+    datagen.generate(f"sqlite:///{db_path}", {"patients": args.patients, "anex": args.anex, "history": 0})
+    engine = create_engine(f"sqlite:///{db_path}")
+    Session = sessionmaker(bind=engine)
+
+    cases = {
+        "first page": dict(skip=0, limit=100),
+        "deep page": dict(skip=args.patients - 200, limit=100),
+        "lastname filter": dict(skip=0, limit=100, filters={"lastname": datagen.LAST_NAMES[-3]}),
+        "research filter": dict(skip=0, limit=100, filters={"research": datagen.RESEARCH_NAMES[1]}),
+    }
+    print(f"{'case':<18}{'loader':<10}{'patients':>10}{'stmts':>8}{'rows':>10}{'median ms':>12}")
+    for name, kwargs in cases.items():
+        for label, loader in (("before", legacy_get_patients), ("after", crud.get_patients)):
+            r = measure(Session, db_path, loader, args.repeat, **kwargs)
+            print(f"{name:<18}{label:<10}{r['patients']:>10}{r['statements']:>8}{r['rows']:>10}{r['median_ms']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
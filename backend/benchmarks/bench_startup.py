@@ -0,0 +1,82 @@
+"""
+Time from process start to the first request served, the way a container
+starts the backend: `python migrations.py upgrade` once, then a uvicorn worker
+which is polled until it answers. The upgrade is timed twice, as the first
+run against the database and again once it is up to date; the worker start is
+measured --repeat times.
+
+Run from the backend directory (uses a copy of a database generated by datagen.py):
+    python benchmarks/bench_startup.py --db /tmp/bench.db [--repeat 5]
+
+--backend-dir points at another checkout's backend directory to time its
+startup instead, e.g. a `git worktree` of an older commit. Checkouts without
+migrations.py skip the upgrade step.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed_upgrade(backend_dir, env):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "migrations.py", "upgrade"], cwd=backend_dir, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def timed_worker_start(backend_dir, env, port, timeout=120):
+    """Seconds from spawning uvicorn until GET /docs returns 200."""
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                              cwd=backend_dir, env=env)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}") as client:
+            while time.perf_counter() - started < timeout:
+                if server.poll() is not None:
+                    raise RuntimeError(f"server exited with status {server.returncode}")
+                try:
+                    if client.get("/docs").status_code == 200:
+                        return time.perf_counter() - started
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+        raise RuntimeError("server did not start")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True, help="Copied first; the original is left untouched.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--backend-dir", default=BACKEND_DIR)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "startup.db")
+    shutil.copyfile(args.db, db_path)
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{db_path}", "METRICS_ENABLED": "off"}
+    has_migrations = os.path.exists(os.path.join(args.backend_dir, "migrations.py"))
+    try:
+        if has_migrations:
+            print(f"{'first upgrade':<24}{timed_upgrade(args.backend_dir, env) * 1000:>10.0f} ms")
+            print(f"{'upgrade, up to date':<24}{timed_upgrade(args.backend_dir, env) * 1000:>10.0f} ms")
+        timings = sorted(timed_worker_start(args.backend_dir, env, args.port) for _ in range(args.repeat))
+        print(f"{'worker to first request':<24}{timings[len(timings) // 2] * 1000:>10.0f} ms median"
+              f"  (min {timings[0] * 1000:.0f}, max {timings[-1] * 1000:.0f})")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
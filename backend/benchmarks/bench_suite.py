@@ -0,0 +1,210 @@
+"""
+Regression benchmark suite: drives the FastAPI app in-process against a
+generated database (see datagen.py) and records, per hot endpoint, latency
+percentiles, SQL statement count and response size. Results are written as
+JSON so runs can be compared between commits.
+
+Run from the backend directory:
+    python benchmarks/bench_suite.py --db /tmp/bench.db [--out results.json] [--compare baseline.json]
+
+Without --db a database is generated into a temporary directory first (the
+datagen scale flags apply). Mutating cases (the anex sync) change the data, so
+reuse a database only for runs you intend to compare. The /token rate limit is
+disabled for the run; everything else uses the current environment's settings.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+# Settings that change what is being measured, recorded with every run
+RECORDED_SETTINGS = ("BCRYPT_ROUNDS", "HISTORY_LOG_MODE", "FINANCE_SUMMARY", "USER_CACHE_TTL_SECONDS",
+                     "DB_JOURNAL_MODE", "DB_SYNCHRONOUS", "DB_CACHE_SIZE", "DB_MMAP_SIZE", "METRICS_ENABLED",
+                     "HISTORY_ARCHIVE_PATH")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def pick_filter_values(db_path):
+    """Filter terms that exist in the generated data, taken from the middle of each table."""
+    conn = sqlite3.connect(db_path)
+    one = lambda sql: conn.execute(sql).fetchone()
+    n_patients = one("SELECT count(*) FROM patients")[0]
+    patient = one(f"SELECT id, personal_number, first_name, last_name FROM patients WHERE id = {max(n_patients // 2, 1)}")
+    doctor = one("SELECT u.first_name || ' ' || u.last_name FROM anex_records a JOIN users u ON u.id = a.doctor_id LIMIT 1")
+    values = {
+        "patient_id": patient[0], "personal_number": patient[1], "firstname": patient[2], "lastname": patient[3],
+        "doctor": doctor[0] if doctor else "",
+        "funder": one("SELECT funder_name FROM finances ORDER BY id LIMIT 1 OFFSET 5")[0],
+        "research": one("SELECT research_name FROM services ORDER BY id LIMIT 1 OFFSET 7")[0],
+        "staff": one("SELECT user_name FROM users ORDER BY id LIMIT 1 OFFSET 10")[0],
+        "author": one("SELECT user_name FROM users ORDER BY id LIMIT 1 OFFSET 3")[0],
+        "date": (one("SELECT date(max(timestamp)) FROM history_logs")[0] or datetime.now(timezone.utc).date().isoformat()),
+        "counts": {table: one(f"SELECT count(*) FROM {table}")[0] for table in
+                   ("users", "patients", "anex_records", "history_logs", "services", "finances")},
+    }
+    conn.close()
+    return values
+
+
+def build_cases(client, headers, v, args, password):
+    """Returns {name: (callable(i) -> response, repeat)}; `i` is the iteration number."""
+    get = lambda path, **params: (lambda i: client.get(path, params=params, headers=headers))
+    cases = {
+        "token": (lambda i: client.post("/token", data={"username": "admin", "password": password}), args.token_repeat),
+        "patients first page": (get("/patients/"), args.repeat),
+        "patients deep page": (get("/patients/", skip=max(v["counts"]["patients"] - 200, 0)), args.repeat),
+        "patients cursor page": (get("/patients/", cursor=""), args.repeat),
+    }
+    for name in ("personal_number", "lastname", "firstname", "doctor", "funder", "research", "staff"):
+        cases[f"patients filter {name}"] = (get("/patients/", **{name: v[name]}), args.repeat)
+    cases["patients filter funder=self"] = (get("/patients/", funder="self"), args.repeat)
+    cases.update({
+        "history first page": (get("/history/"), args.repeat),
+        "history cursor page": (get("/history/", cursor=""), args.repeat),
+        "history filter author": (get("/history/", author=v["author"]), args.repeat),
+        "history filter date": (get("/history/", date=v["date"]), args.repeat),
+        "history filter patient": (get("/history/", patient=v["personal_number"]), args.repeat),
+        "finances list": (get("/finances/"), args.repeat),
+        "services list": (get("/services/"), args.repeat),
+        "users list": (get("/users/list"), args.repeat),
+        "finance report by funder": (get("/reports/finance", group_by="funder"), args.repeat),
+    })
+
+    # The sync flips one record's paid amount each iteration, so every call really writes
+    patient = client.get(f"/admin/find-patient/{v['personal_number']}", headers=headers).json()
+    fields = ("id", "doctor_id", "service_id", "finance_id", "payable_amount", "paid_amount")
+    records = [{key: record[key] for key in fields} for record in patient.get("anex_records", [])]
+
+    def sync(i):
+        body = [dict(record) for record in records]
+        if body:
+            body[0]["paid_amount"] = float(i % 2)
+        return client.put(f"/patients/{patient['id']}/anex", json=body, headers=headers)
+    cases["patient anex sync"] = (sync, args.repeat)
+    return cases
+
+
+def run_case(call, repeat, warmup, engine):
+    from sqlalchemy import event
+    statements = [0]
+
+    def count(*_args):
+        statements[0] += 1
+
+    # The first warm-up call is also the one whose statements are counted
+    event.listen(engine, "before_cursor_execute", count)
+    response = call(0)
+    event.remove(engine, "before_cursor_execute", count)
+    for i in range(1, warmup):
+        call(i)
+
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        call(warmup + i)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    pct = lambda p: timings[min(len(timings) - 1, int(round(p / 100 * (len(timings) - 1))))]
+    return {"status": response.status_code, "statements": statements[0], "bytes": len(response.content),
+            "repeat": repeat, "min_ms": timings[0], "median_ms": pct(50), "p95_ms": pct(95),
+            "mean_ms": sum(timings) / len(timings)}
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    print(f"\nCompared with {baseline_path}:")
+    print(f"{'case':<42}{'base ms':>10}{'now ms':>10}{'change':>9}{'stmts':>12}")
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"{name:<42}{'-':>10}{r['median_ms']:>10.2f}{'new':>9}")
+            continue
+        change = (r["median_ms"] / base["median_ms"] - 1) * 100 if base["median_ms"] else 0.0
+        print(f"{name:<42}{base['median_ms']:>10.2f}{r['median_ms']:>10.2f}{change:>+8.0f}%"
+              f"{base['statements']:>6} ->{r['statements']:>3}")
+
+
+def main():
+    # database.py binds the app's engine at import time, so DATABASE_URL has to point at the
+    # benchmark database before datagen (or anything else from the backend) is imported
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument("--db")
+    db_path = pre.parse_known_args()[0].db
+    generate = not db_path
+    if generate:
+        db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    import datagen
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="Existing database generated by datagen.py.")
+    parser.add_argument("--out", help="Results file (default: benchmarks/results/<revision>-<time>.json).")
+    parser.add_argument("--compare", help="Earlier results file to compare medians against.")
+    parser.add_argument("--only", help="Run only cases whose name contains this text.")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--token-repeat", type=int, default=5, help="Logins are bcrypt-bound, so fewer by default.")
+    datagen.add_scale_arguments(parser)
+    args = parser.parse_args()
+
+    if generate:
+        print(f"Generating {db_path} ...")
+        datagen.generate(f"sqlite:///{db_path}", {name: getattr(args, name) for name in datagen.DEFAULT_SCALE}, args.seed)
+    values = pick_filter_values(db_path)
+
+    from fastapi.testclient import TestClient
+    import database, main as app_module
+    app_module.limiter.enabled = False
+
+    results = {}
+    with TestClient(app_module.app) as client:
+        token = client.post("/token", data={"username": "admin", "password": datagen.BENCH_PASSWORD}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        cases = build_cases(client, headers, values, args, datagen.BENCH_PASSWORD)
+        print(f"{'case':<42}{'status':>7}{'stmts':>7}{'KiB':>9}{'median ms':>11}{'p95 ms':>9}")
+        for name, (call, repeat) in cases.items():
+            if args.only and args.only not in name:
+                continue
+            r = results[name] = run_case(call, repeat, args.warmup, database.engine)
+            print(f"{name:<42}{r['status']:>7}{r['statements']:>7}{r['bytes'] / 1024:>9.1f}{r['median_ms']:>11.2f}{r['p95_ms']:>9.2f}")
+
+    revision = git_revision()
+    report = {
+        "meta": {
+            "revision": revision, "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "platform": platform.platform(),
+            "database": db_path, "counts": values["counts"],
+            "settings": {name: os.environ[name] for name in RECORDED_SETTINGS if name in os.environ},
+            "repeat": args.repeat, "warmup": args.warmup,
+        },
+        "results": results,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"{revision or 'unknown'}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved {out}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
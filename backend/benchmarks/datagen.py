@@ -0,0 +1,228 @@
+"""
+Seeded synthetic data for benchmarks: fills every table in models.py at a
+configurable scale, then runs the migrations upgrade (schema version, search
+index) so the database is ready to serve. The same seed always produces the same database.
+
+Every user can log in with BENCH_PASSWORD; user 1 is the admin "admin".
+
+Run from the backend directory:
+    python benchmarks/datagen.py --out /tmp/bench.db [--patients 100000] [--anex 500000] [--history 2000000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, bindparam, String
+import auth, migrations, models
+from database import make_engine
+
+BENCH_PASSWORD = "bench-password"
+
+DEFAULT_SCALE = {
+    "users": 200,
+    "services": 500,
+    "finances": 100,
+    "patients": 100_000,
+    "anex": 500_000,
+    "history": 2_000_000,
+    "specialisations": 20,
+    "invitations": 50,
+    "staff_per_patient": 3,
+}
+
+FIRST_NAMES = ["გიორგი", "ნინო", "დავით", "მარიამ", "ლუკა", "ანა", "ნიკოლოზ", "თამარ", "ლაშა", "ეკატერინე",
+               "ირაკლი", "სალომე", "ზურაბ", "ნათია", "ლევან", "ქეთევან", "დათო", "ელენე", "გურამ", "მაია",
+               "Giorgi", "Nino", "David", "Mariam", "Luka", "Ana", "Irakli", "Tamar", "Levan", "Elene"]
+LAST_NAMES = ["ბერიძე", "მამედოვი", "კაპანაძე", "გელაშვილი", "მაისურაძე", "გიორგაძე", "ლომიძე", "წიკლაური",
+              "ბოლქვაძე", "ნოზაძე", "ხუციშვილი", "შენგელია", "აბულაძე", "ჯავახიშვილი", "ქავთარაძე",
+              "Beridze", "Kapanadze", "Gelashvili", "Maisuradze", "Giorgadze", "Lomidze", "Tsiklauri",
+              "Bolkvadze", "Nozadze", "Khutsishvili", "Shengelia", "Abuladze", "Javakhishvili", "Kavtaradze"]
+NATIONALITIES = ["GE"] * 8 + ["AZ", "AM", "UA", "TR", "RU", "DE"]
+STREETS = ["Rustaveli Ave", "Chavchavadze Ave", "Pekini St", "Kazbegi Ave", "Vazha-Pshavela Ave", "Tsereteli Ave"]
+RESEARCH_NAMES = ["Complete blood count", "Lipid panel", "HbA1c", "Thyroid panel", "Liver function test",
+                  "Kidney function test", "Vitamin D", "Ferritin", "CRP", "Coagulation panel",
+                  "Urinalysis", "PCR panel", "Allergy panel", "Hormone panel", "Tumor markers"]
+LABORATORIES = ["Central Lab", "Synevo", "Mrcheveli", "Neolab", "Unilab", "Aversi Lab", "Medi Club Lab", "Tbilisi Lab"]
+FUNDERS = ["Aldagi", "GPI Holding", "Imedi L", "Ardi", "Irao", "TBC Insurance", "State Program", "Unison", "Alpha"]
+SPECIALISATIONS = ["Cardiology", "Pediatrics", "Neurology", "Oncology", "Endocrinology", "Radiology", "Surgery",
+                   "Dermatology", "Gastroenterology", "Hematology", "Immunology", "Nephrology", "Pulmonology",
+                   "Rheumatology", "Urology", "Gynecology", "Psychiatry", "Ophthalmology", "Billing", "Reception"]
+
+# Relative frequency of (action, entity_type) pairs in the history table
+HISTORY_MIX = [
+    (("UPDATE", "AnexRecord"), 30), (("CREATE", "AnexRecord"), 25), (("UPDATE", "Patient"), 15),
+    (("CREATE", "Patient"), 10), (("SYNC_ANEX", "Patient"), 8), (("DELETE", "AnexRecord"), 5),
+    (("UPDATE", "Service"), 2), (("UPDATE", "Finance"), 2), (("CREATE", "Service"), 1),
+    (("BLOCK", "User"), 1), (("UPDATE", "User"), 1),
+]
+
+BATCH_SIZE = 20_000
+# History `changes` are serialized here once, so bind them as plain text like audit.py does
+_insert_history = insert(models.HistoryLog.__table__).values(changes=bindparam("changes_json", type_=String()))
+
+
+def _batched(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(conn, stmt, rows):
+    for batch in _batched(rows):
+        conn.execute(stmt, batch)
+
+
+# --- Table Generators ---
+def _users(rnd, n, hashed_password):
+    yield {"id": 1, "first_name": "Admin", "last_name": "User", "email": "admin@example.com", "phone_number": None,
+           "user_name": "admin", "hashed_password": hashed_password, "role": "admin", "is_approved": True, "is_blocked": False}
+    for i in range(2, n + 1):
+        yield {"id": i, "first_name": rnd.choice(FIRST_NAMES), "last_name": rnd.choice(LAST_NAMES),
+               "email": f"user{i}@example.com", "phone_number": f"5{rnd.randint(0, 99_999_999):08d}",
+               "user_name": f"user{i}", "hashed_password": hashed_password,
+               "role": "doctor" if rnd.random() < 0.6 else "staff",
+               "is_approved": rnd.random() > 0.05, "is_blocked": rnd.random() < 0.02}
+
+
+def _services(rnd, n, today):
+    for i in range(1, n + 1):
+        yield {"id": i, "service_number": f"S-{i:05d}", "research_name": f"{rnd.choice(RESEARCH_NAMES)} {i}",
+               "laboratory_name": rnd.choice(LABORATORIES), "deadline": today + timedelta(days=rnd.randint(-365, 365))}
+
+
+def _finances(rnd, n):
+    for i in range(1, n + 1):
+        yield {"id": i, "funder_name": f"{rnd.choice(FUNDERS)} {i}", "email": f"funder{i}@example.com",
+               "phone_number": f"32{rnd.randint(0, 9_999_999):07d}"}
+
+
+def _patients(rnd, n):
+    for i in range(1, n + 1):
+        yield {"id": i, "first_name": rnd.choice(FIRST_NAMES), "last_name": rnd.choice(LAST_NAMES),
+               "birth_date": date(1940, 1, 1) + timedelta(days=rnd.randint(0, 30_000)),
+               "nationality": rnd.choice(NATIONALITIES), "personal_number": f"{1_000_000_000 + i * 7:011d}",
+               "address": f"{rnd.choice(STREETS)} {rnd.randint(1, 200)}, Tbilisi" if rnd.random() < 0.7 else None}
+
+
+def _anex_records(rnd, scale):
+    for i in range(1, scale["anex"] + 1):
+        payable = float(rnd.choice((20, 35, 50, 80, 120, 250)))
+        yield {"id": i, "patient_id": rnd.randint(1, scale["patients"]),
+               "doctor_id": rnd.randint(2, scale["users"]) if rnd.random() < 0.9 else None,
+               "service_id": rnd.randint(1, scale["services"]),
+               "finance_id": rnd.randint(1, scale["finances"]) if rnd.random() < 0.7 else None,
+               "payable_amount": payable, "paid_amount": rnd.choice((0.0, payable / 2, payable))}
+
+
+def _history_changes(rnd, action, entity_type):
+    if entity_type == "AnexRecord" and action == "UPDATE":
+        before = float(rnd.choice((0, 25, 50)))
+        return {"paid_amount": {"before": before, "after": before + 25}}
+    if entity_type == "AnexRecord":
+        return {"doctor_id": rnd.randint(1, 200), "service_id": rnd.randint(1, 500), "finance_id": None,
+                "payable_amount": 50.0, "paid_amount": 0.0}
+    if action == "SYNC_ANEX":
+        return {"updated": {str(rnd.randint(1, 500_000)): {"paid_amount": {"before": 0.0, "after": 50.0}}}}
+    if entity_type == "Patient" and action == "UPDATE":
+        return {"address": {"before": None, "after": f"{rnd.choice(STREETS)} {rnd.randint(1, 200)}, Tbilisi"}}
+    if entity_type == "Patient":
+        return {"first_name": rnd.choice(FIRST_NAMES), "last_name": rnd.choice(LAST_NAMES), "nationality": "GE"}
+    if action == "BLOCK":
+        return {"is_blocked": {"before": False, "after": True}}
+    return {"phone_number": {"before": None, "after": f"5{rnd.randint(0, 99_999_999):08d}"}}
+
+
+def _history_logs(rnd, scale, now):
+    kinds = [kind for kind, _ in HISTORY_MIX]
+    weights = [weight for _, weight in HISTORY_MIX]
+    n = scale["history"]
+    start = now - timedelta(days=365)
+    step = timedelta(days=365) / max(n, 1)
+    for i in range(1, n + 1):
+        action, entity_type = rnd.choices(kinds, weights)[0]
+        if entity_type == "Patient":
+            entity_id = patient_id = rnd.randint(1, scale["patients"])
+        elif entity_type == "AnexRecord":
+            entity_id, patient_id = rnd.randint(1, scale["anex"]), rnd.randint(1, scale["patients"])
+        else:
+            entity_id, patient_id = rnd.randint(1, scale["services"]), None
+        yield {"id": i, "timestamp": start + step * i, "user_id": rnd.randint(1, scale["users"]),
+               "action": action, "entity_type": entity_type, "entity_id": entity_id, "patient_id": patient_id,
+               "changes_json": models.encode_changes(_history_changes(rnd, action, entity_type))}
+
+
+def generate(url: str, scale: dict = None, seed: int = 42, log=print):
+    """Creates the schema at `url` and fills it; `scale` overrides entries of DEFAULT_SCALE."""
+    scale = {**DEFAULT_SCALE, **(scale or {})}
+    rnd = random.Random(seed)
+    # Durability does not matter while bulk loading a throwaway database
+    engine = make_engine(url, pragmas={"journal_mode": "WAL", "synchronous": "OFF", "cache_size": -262144})
+    models.Base.metadata.create_all(bind=engine)
+    today = date.today()
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    hashed_password = auth.get_password_hash(BENCH_PASSWORD)
+
+    steps = [
+        ("users", lambda: _insert(conn, insert(models.User), _users(rnd, scale["users"], hashed_password))),
+        ("specialisations", lambda: _insert(conn, insert(models.Specialisation),
+                                            ({"id": i, "name": name} for i, name in enumerate(SPECIALISATIONS[:scale["specialisations"]], 1)))),
+        ("user specialisations", lambda: _insert(conn, insert(models.user_specialisation_association), (
+            {"user_id": u, "specialisation_id": s}
+            for u in range(2, scale["users"] + 1)
+            for s in rnd.sample(range(1, min(scale["specialisations"], len(SPECIALISATIONS)) + 1), 2)))),
+        ("services", lambda: _insert(conn, insert(models.Service), _services(rnd, scale["services"], today))),
+        ("finances", lambda: _insert(conn, insert(models.Finance), _finances(rnd, scale["finances"]))),
+        ("invitations", lambda: _insert(conn, insert(models.Invitation), (
+            {"email": f"invite{i}@example.com", "token": f"bench-token-{i}",
+             "expires_at": now + timedelta(days=rnd.randint(-30, 7)), "is_used": rnd.random() < 0.5}
+            for i in range(1, scale["invitations"] + 1)))),
+        ("patients", lambda: _insert(conn, insert(models.Patient), _patients(rnd, scale["patients"]))),
+        ("staff assignments", lambda: _insert(conn, insert(models.user_patient_association), (
+            {"user_id": u, "patient_id": p}
+            for p in range(1, scale["patients"] + 1)
+            for u in rnd.sample(range(1, scale["users"] + 1), min(scale["staff_per_patient"], scale["users"]))))),
+        ("anex records", lambda: _insert(conn, insert(models.AnexRecord), _anex_records(rnd, scale))),
+        ("history logs", lambda: _insert(conn, _insert_history, _history_logs(rnd, scale, now))),
+    ]
+    with engine.begin() as conn:
+        for name, step in steps:
+            started = time.perf_counter()
+            step()
+            log(f"  {name:<22}{time.perf_counter() - started:>8.1f}s")
+
+    # Stamps the schema version and builds the search index, so the app accepts the database as is
+    migrations.upgrade(engine, log=log)
+    engine.dispose()
+    return scale
+
+
+def add_scale_arguments(parser):
+    for name, value in DEFAULT_SCALE.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=value, dest=name)
+    parser.add_argument("--seed", type=int, default=42)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", required=True, help="Path of the SQLite file to create (must not exist).")
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+    if os.path.exists(args.out):
+        parser.error(f"{args.out} already exists")
+    scale = {name: getattr(args, name) for name in DEFAULT_SCALE}
+    print(f"Generating {args.out} with seed {args.seed}: {scale}")
+    generate(f"sqlite:///{args.out}", scale, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Concurrent readers against one uvicorn worker, with the read routes served
+from the sync stack (thread pool + Session) versus the async stack
+(ASYNC_ROUTES=all, AsyncSession on aiosqlite).
+
+Run from the backend directory (uses a database generated by datagen.py):
+    python benchmarks/load_async_routes.py --db /tmp/bench.db [--clients 200] [--seconds 10]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_PASSWORD = "bench-password"  # datagen.BENCH_PASSWORD; not imported so the app is never loaded here
+
+
+def start_server(db_path, port, async_routes):
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{db_path}", "ASYNC_ROUTES": async_routes,
+           "METRICS_ENABLED": "off"}
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=BACKEND_DIR, env=env)
+
+
+async def wait_until_up(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get("/docs")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+async def run_load(base_url, paths, clients, seconds):
+    async with httpx.AsyncClient(base_url=base_url, timeout=60,
+                                 limits=httpx.Limits(max_connections=clients)) as client:
+        token = (await client.post("/token", data={"username": "admin", "password": BENCH_PASSWORD})).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        latencies, errors = [], 0
+        deadline = time.monotonic() + seconds
+
+        async def worker(n):
+            nonlocal errors
+            i = n
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                response = await client.get(paths[i % len(paths)], headers=headers)
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+                i += 1
+
+        await asyncio.gather(*(worker(n) for n in range(clients)))
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000 if latencies else 0.0
+    return {"requests": len(latencies), "rps": len(latencies) / seconds, "p50": pct(50), "p95": pct(95), "errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    paths = ["/history/?limit=20", "/finances/", "/services/", "/users/list", "/patients/?limit=20"]
+    print(f"{'stack':<8}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}")
+    for label, async_routes in (("sync", ""), ("async", "all")):
+        server = start_server(args.db, args.port, async_routes)
+        try:
+            base_url = f"http://127.0.0.1:{args.port}"
+            asyncio.run(wait_until_up(base_url))
+            r = asyncio.run(run_load(base_url, paths, args.clients, args.seconds))
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{label:<8}{r['requests']:>10}{r['rps']:>10.1f}{r['p50']:>10.1f}{r['p95']:>10.1f}{r['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
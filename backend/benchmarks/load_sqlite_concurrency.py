@@ -0,0 +1,106 @@
+"""
+Read throughput while history logs are being written, with the plain SQLite
+engine (rollback journal, no busy timeout) versus database.make_engine()'s
+production profile (WAL, synchronous=NORMAL, busy_timeout, ...).
+
+Readers and the writer are separate processes, like uvicorn workers sharing
+one database file.
+
+Run from the backend directory:
+    python benchmarks/load_sqlite_concurrency.py [--readers 4] [--seconds 10]
+"""
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+import crud, models
+from database import make_engine
+
+
+def build_engine(profile, url):
+    if profile == "default":
+        return create_engine(url, connect_args={"check_same_thread": False})
+    return make_engine(url)
+
+
+def reader(profile, url, deadline, results):
+    Session = sessionmaker(bind=build_engine(profile, url))
+    reads = errors = 0
+    while time.time() < deadline:
+        try:
+            with Session() as db:
+                crud.get_history_logs(db, skip=0, limit=100, filters={})
+            reads += 1
+        except OperationalError:
+            errors += 1
+    results.put(("read", reads, errors))
+
+
+def writer(profile, url, deadline, results):
+    Session = sessionmaker(bind=build_engine(profile, url))
+    writes = errors = 0
+    while time.time() < deadline:
+        try:
+            with Session() as db:
+                # One history row per transaction, like a request-level commit
+                db.add(models.HistoryLog(user_id=1, action="UPDATE", entity_type="Patient", entity_id=1,
+                                         changes={"first_name": {"before": "a", "after": "b"}}))
+                db.commit()
+            writes += 1
+        except OperationalError:
+            errors += 1
+    results.put(("write", writes, errors))
+
+
+def run(profile, n_readers, seconds, seed_rows):
+    path = os.path.join(tempfile.mkdtemp(), "load.db")
+    url = f"sqlite:///{path}"
+    engine = build_engine(profile, url)
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"id": 1, "email": "load@example.com", "user_name": "load",
+                                            "hashed_password": "x", "role": "staff", "is_blocked": False}])
+        conn.execute(insert(models.HistoryLog), [
+            {"action": "CREATE", "entity_type": "Patient", "entity_id": i, "changes": {}} for i in range(seed_rows)
+        ])
+    engine.dispose()
+
+    results = mp.Queue()
+    deadline = time.time() + seconds
+    procs = [mp.Process(target=reader, args=(profile, url, deadline, results)) for _ in range(n_readers)]
+    procs.append(mp.Process(target=writer, args=(profile, url, deadline, results)))
+    for p in procs: p.start()
+    totals = {"read": [0, 0], "write": [0, 0]}
+    for _ in procs:
+        kind, ok, errors = results.get()
+        totals[kind][0] += ok
+        totals[kind][1] += errors
+    for p in procs: p.join()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--seed-rows", type=int, default=2_000)
+    args = parser.parse_args()
+
+    print(f"{args.readers} reader processes + 1 writer for {args.seconds:g}s each")
+    print(f"{'profile':<12}{'reads/s':>10}{'read errors':>13}{'writes/s':>10}{'write errors':>14}")
+    for profile in ("default", "production"):
+        t = run(profile, args.readers, args.seconds, args.seed_rows)
+        print(f"{profile:<12}{t['read'][0] / args.seconds:>10.0f}{t['read'][1]:>13}"
+              f"{t['write'][0] / args.seconds:>10.0f}{t['write'][1]:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+ETags and a rendered-body cache for the reference-data listings
+(/finances/, /services/, /users/list).
+
+crud bumps a per-table counter in table_versions inside the same transaction
+as every create/update/delete, so all workers see a change at the moment it
+commits. A listing request reads that one row; the ETag is derived from the
+version and the request's paging, so a matching If-None-Match gets a 304, and
+otherwise the JSON body rendered for that version is served from memory. Only
+a request for a version nobody has asked for yet touches the table and Pydantic.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import List
+from fastapi import Request, Response, status
+from pydantic import TypeAdapter
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import models, schemas
+
+LISTING_CACHE_SIZE = int(os.getenv("LISTING_CACHE_SIZE", "256"))
+
+LISTINGS = {
+    "finances": TypeAdapter(List[schemas.FinanceInDB]),
+    "services": TypeAdapter(List[schemas.ServiceInDB]),
+    "users": TypeAdapter(List[schemas.User]),
+}
+# Part of every ETag, so a change to a response schema never revalidates a body rendered by older code
+_SCHEMA_TAGS = {
+    table: hashlib.sha1(json.dumps(adapter.json_schema(), sort_keys=True).encode()).hexdigest()[:8]
+    for table, adapter in LISTINGS.items()
+}
+
+_bodies = OrderedDict()
+_bodies_lock = threading.Lock()
+
+
+# --- Table Versions ---
+def bump(db, *tables: str):
+    """Increments the version of `tables`; call before the transaction that changed them commits."""
+    version = models.TableVersion
+    stmt = sqlite_insert(version)
+    stmt = stmt.on_conflict_do_update(index_elements=[version.name], set_={"version": version.version + 1})
+    db.execute(stmt, [{"name": table, "version": 1} for table in tables])
+
+def version_query(table: str):
+    """SELECT of `table`'s current version; a table that was never bumped has none (treat as 0)."""
+    return select(models.TableVersion.version).where(models.TableVersion.name == table)
+
+
+# --- Rendered Bodies ---
+def _etag(table: str, version: int, key: tuple) -> str:
+    return '"' + "-".join(str(part) for part in (table, _SCHEMA_TAGS[table], version, *key)) + '"'
+
+def _not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # If-None-Match uses weak comparison, so a W/ prefix added by a proxy still matches
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or etag in tags
+
+def _cached_body(table: str, version: int, key: tuple):
+    with _bodies_lock:
+        body = _bodies.get((table, version, key))
+        if body is not None:
+            _bodies.move_to_end((table, version, key))
+        return body
+
+def _store_body(table: str, version: int, key: tuple, body: bytes):
+    with _bodies_lock:
+        # Bodies of older versions can never be served again
+        for stale in [k for k in _bodies if k[0] == table and k[1] < version]:
+            del _bodies[stale]
+        _bodies[(table, version, key)] = body
+        while len(_bodies) > LISTING_CACHE_SIZE:
+            _bodies.popitem(last=False)
+
+def _render(table: str, rows) -> bytes:
+    adapter = LISTINGS[table]
+    return adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
+
+def _response(status_code: int, etag: str, body: bytes = b"") -> Response:
+    # no-cache: browsers keep the body but revalidate with If-None-Match on every use
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if status_code == status.HTTP_304_NOT_MODIFIED:
+        return Response(status_code=status_code, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def listing_response(request: Request, db, table: str, key: tuple, load) -> Response:
+    """Serves a listing of `table` from a sync Session; `load()` fetches the rows on a cache miss."""
+    version = db.scalar(version_query(table)) or 0
+    etag = _etag(table, version, key)
+    if _not_modified(request, etag):
+        return _response(status.HTTP_304_NOT_MODIFIED, etag)
+    body = _cached_body(table, version, key)
+    if body is None:
+        body = _render(table, load())
+        _store_body(table, version, key, body)
+    return _response(status.HTTP_200_OK, etag, body)
+
+async def listing_response_async(request: Request, db, table: str, key: tuple, load) -> Response:
+    """listing_response for an AsyncSession; `load()` is awaited on a cache miss."""
+    version = await db.scalar(version_query(table)) or 0
+    etag = _etag(table, version, key)
+    if _not_modified(request, etag):
+        return _response(status.HTTP_304_NOT_MODIFIED, etag)
+    body = _cached_body(table, version, key)
+    if body is None:
+        body = _render(table, await load())
+        _store_body(table, version, key, body)
+    return _response(status.HTTP_200_OK, etag, body)
@@ -0,0 +1,116 @@
+"""
+Incremental change feed for GET /changes, built on history_logs.
+
+History ids only grow (the table is AUTOINCREMENT and SQLite commits one
+writer at a time), so the id of the last entry a client has seen is a complete
+cursor. A request without `since` returns no changes, only the current cursor:
+clients load the lists once, then ask for what changed since. Each change is an
+entity touched after the cursor, with its current state in the list
+endpoint's shape, or `deleted` when it no longer exists. For non-admins,
+`deleted` also covers a user who is no longer in /users/list. Several edits
+of one entity come back as one change, ordered by its latest edit.
+
+Patients embed copies of their staff, doctors, services and finances. A
+change to one of those arrives as a User/Service/Finance change only, and the
+client updates the embedded copies itself. A deleted doctor becomes a null
+doctor on the patient's anex records.
+
+With the history archive enabled, a cursor older than entries already moved
+to the archive is rejected ("EXPIRED"); the client then reloads its lists.
+"""
+from typing import Dict, Tuple
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+import crud, history_store, models, schemas
+
+# Anex records are served inside their patient; finances and services as their list endpoints render them
+_PATIENT_TYPES = ("Patient", "AnexRecord")
+_SCHEMAS = {"Finance": (models.Finance, schemas.FinanceInDB), "Service": (models.Service, schemas.ServiceInDB)}
+
+
+def parse_since(since: str):
+    """Returns the history id to read past (None without a cursor), or False if the cursor is malformed."""
+    key = crud.decode_cursor(since)
+    if key is None or len(key) > 1 or not all(crud.is_cursor_id(v) for v in key): return False
+    return key[0] if key else None
+
+
+def _touched(db: Session, rows, limit: int):
+    """
+    (entity_type, id) of every entity the history rows touched, in order of its latest change,
+    and how many rows were read before about `limit` entities were reached.
+    """
+    log = models.HistoryLog
+    bulk_ids = [row.id for row in rows if row.action == "BULK_CREATE"]
+    bulk = dict(db.execute(select(log.id, log.changes).where(log.id.in_(bulk_ids))).all()) if bulk_ids else {}
+    touched, consumed = {}, 0
+    for row in rows:
+        if len(touched) >= limit:
+            break
+        consumed += 1
+        if row.entity_type in _PATIENT_TYPES:
+            if row.id in bulk:
+                keys = [("Patient", int(patient_id)) for patient_id in bulk[row.id]["patients"]]
+            elif row.entity_type == "Patient":
+                # Deleting a patient clears patient_id on its history, so fall back to the entity id
+                keys = [("Patient", row.patient_id or row.entity_id)]
+            else:
+                keys = [("Patient", row.patient_id)] if row.patient_id else []
+        elif row.entity_type in _SCHEMAS or row.entity_type == "User":
+            keys = [(row.entity_type, row.entity_id)]
+        else:
+            keys = []
+        for key in keys:
+            touched.pop(key, None)
+            touched[key] = None
+    return touched, consumed
+
+
+def _states(db: Session, touched, is_admin: bool) -> Dict[Tuple[str, int], dict]:
+    """Current state of each touched entity that still exists (and, for users, is visible to the caller)."""
+    ids = {}
+    for entity_type, entity_id in touched:
+        ids.setdefault(entity_type, []).append(entity_id)
+    states = {}
+    if ids.get("Patient"):
+        for patient in db.scalars(crud.patients_by_ids_query(ids["Patient"])):
+            states["Patient", patient.id] = schemas.Patient.model_validate(patient).model_dump(mode="json")
+    for entity_type, (model, schema) in _SCHEMAS.items():
+        if ids.get(entity_type):
+            for entity in db.scalars(select(model).where(model.id.in_(ids[entity_type]))):
+                states[entity_type, entity.id] = schema.model_validate(entity).model_dump(mode="json")
+    if ids.get("User"):
+        # Admins see users as /admin/users/ shows them, everyone else as /users/list does
+        stmt = select(models.User).where(models.User.id.in_(ids["User"]))
+        schema = schemas.UserInDB if is_admin else schemas.User
+        if not is_admin:
+            stmt = stmt.where(models.User.is_approved == True)
+        for user in db.scalars(stmt):
+            states["User", user.id] = schema.model_validate(user).model_dump(mode="json")
+    return states
+
+
+def get_changes(db: Session, since: str = "", limit: int = 500, is_admin: bool = False):
+    """
+    The feed page after `since`, reading history until about `limit` entities were
+    touched (a bulk import entry is never split). Returns None for a malformed
+    cursor and "EXPIRED" for one that reaches into archived history.
+    """
+    after = parse_since(since)
+    if after is False: return None
+    log = models.HistoryLog
+    if after is None:
+        return {"changes": [], "cursor": crud.encode_cursor(db.scalar(select(func.max(log.id))) or 0), "has_more": False}
+    if history_store.ARCHIVE_ENABLED:
+        archived = history_store.archive_table.c.id
+        if db.scalar(select(archived).where(archived > after).limit(1)) is not None:
+            return "EXPIRED"
+
+    rows = db.execute(select(log.id, log.action, log.entity_type, log.entity_id, log.patient_id)
+                      .where(log.id > after).order_by(log.id).limit(limit)).all()
+    touched, consumed = _touched(db, rows, limit)
+    states = _states(db, touched, is_admin)
+    changes = [{"entity_type": entity_type, "entity_id": entity_id, "deleted": (entity_type, entity_id) not in states,
+                "data": states.get((entity_type, entity_id))} for entity_type, entity_id in touched]
+    cursor = rows[consumed - 1].id if consumed else after
+    return {"changes": changes, "cursor": crud.encode_cursor(cursor), "has_more": len(rows) == limit or consumed < len(rows)}
@@ -1,37 +1,67 @@
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import or_, inspect
-from sqlalchemy.sql.functions import concat
-import models, schemas, auth
+from sqlalchemy.orm import Session, joinedload, selectinload, aliased
+from sqlalchemy import or_, and_, inspect, select, insert, update, delete, func
+from sqlalchemy.exc import IntegrityError
+from pydantic import ValidationError
+import models, schemas, auth, search, audit, reports, caching, history_store, history_snapshots, events
+from database import json_default
 import secrets
-from datetime import datetime, timedelta, timezone, date
+import base64
+from datetime import datetime, timedelta, timezone
 from typing import Optional, List, Dict
 import json
 
 # --- History Log Helper ---
-def json_serializer(obj):
-    """Custom JSON serializer for objects not serializable by default json code"""
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError(f"Type {type(obj)} not serializable")
-
-def create_history_log(db: Session, user_id: int, action: str, entity, changes: dict):
-    # Sanitize changes to ensure they are JSON-serializable
-    sanitized_changes = json.loads(json.dumps(changes, default=json_serializer))
-
-    db_log = models.HistoryLog(
-        user_id=user_id,
-        action=action,
-        entity_type=entity.__class__.__name__,
-        entity_id=entity.id,
-        changes=sanitized_changes
-    )
+def create_history_log(db: Session, user_id: int, action: str, entity, changes: dict, durable: bool = False):
+    entry = {
+        "user_id": user_id,
+        "action": action,
+        "entity_type": entity.__class__.__name__,
+        "entity_id": entity.id,
+        "patient_id": None,
+    }
     # If the entity is a Patient or has a patient_id, link it for easy filtering
     if isinstance(entity, models.Patient):
-        db_log.patient_id = entity.id
+        entry["patient_id"] = entity.id
     elif hasattr(entity, 'patient_id') and entity.patient_id:
-        db_log.patient_id = entity.patient_id
-    
-    db.add(db_log)
+        entry["patient_id"] = entity.patient_id
+    _write_history_entry(db, entry, changes, durable)
+
+def create_summary_history_log(db: Session, user_id: int, action: str, entity_type: str, entity_id: int, changes: dict, patient_id: int = None):
+    """One history entry standing for a set-based change to many rows (e.g. a bulk import chunk or an anex sync)."""
+    entry = {"user_id": user_id, "action": action, "entity_type": entity_type, "entity_id": entity_id, "patient_id": patient_id}
+    _write_history_entry(db, entry, changes)
+
+def _write_history_entry(db: Session, entry: dict, changes: dict, durable: bool = False):
+    entry["timestamp"] = datetime.now(timezone.utc)
+    if audit.is_running() and not durable:
+        # Batched mode: serialize once and hand the row to the background writer after commit
+        entry["changes_json"] = models.encode_changes(changes)
+        audit.enqueue_after_commit(db, entry)
+    else:
+        # The column type encodes the dict (dates included) on insert
+        db.add(models.HistoryLog(**entry, changes=changes))
+        events.publish_after_commit(db)
+    history_snapshots.record_change(db, entry)
+
+# --- Cursor Pagination Helpers ---
+def encode_cursor(*values) -> str:
+    """Packs the sort key of the last row on a page into an opaque, URL-safe token."""
+    raw = json.dumps(values, default=json_default, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Optional[list]:
+    """Returns the sort key stored in a cursor, [] for the first page, or None if the cursor is malformed."""
+    if not cursor:
+        return []
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        return None
+    return key if isinstance(key, list) else None
+
+def is_cursor_id(value) -> bool:
+    """Whether a decoded cursor value is a usable row id: an int (not a bool) that fits SQLite's INTEGER."""
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 2**63
 
 # --- User Functions ---
 def get_user(db: Session, user_id: int): return db.query(models.User).filter(models.User.id == user_id).first()
@@ -56,9 +86,13 @@ def create_user(db: Session, user: schemas.UserCreate, token: Optional[str] = No
         role=role_to_set, is_approved=is_approved_status
     )
     db.add(db_user); db.flush()
+    search.index_user(db, db_user)
 
     if current_user: # Admin manual creation
         create_history_log(db, current_user.id, "CREATE", db_user, user.model_dump(exclude={'password'}))
+    else: # Registration leaves no history entry to rebuild the user from
+        history_snapshots.snapshot_entity(db, "User", db_user.id)
+    caching.bump(db, "users")
 
     db.commit(); db.refresh(db_user)
     return db_user
@@ -66,6 +100,7 @@ def create_user(db: Session, user: schemas.UserCreate, token: Optional[str] = No
 def update_user(db: Session, user_id: int, user_update: schemas.UserUpdate, current_user: models.User):
     db_user = get_user(db, user_id)
     if not db_user: return None
+    previous_user_name = db_user.user_name
     
     changes = {}
     update_data = user_update.model_dump(exclude_unset=True)
@@ -73,6 +108,8 @@ def update_user(db: Session, user_id: int, user_update: schemas.UserUpdate, curr
     if "password" in update_data and update_data["password"]:
         db_user.hashed_password = auth.get_password_hash(update_data["password"])
         changes["password"] = {"before": "********", "after": "********"}
+        # Sessions started with the old password end when their access token expires
+        revoke_user_refresh_tokens(db, db_user.id)
 
     for key, value in update_data.items():
         if key != "password":
@@ -82,8 +119,17 @@ def update_user(db: Session, user_id: int, user_update: schemas.UserUpdate, curr
             setattr(db_user, key, value)
     
     if changes:
-        create_history_log(db, current_user.id, "UPDATE", db_user, changes)
+        create_history_log(db, current_user.id, "UPDATE", db_user, changes, durable=True)
+        search.index_user(db, db_user)
+        caching.bump(db, "users")
+
+    db.commit(); db.refresh(db_user)
+    auth.invalidate_cached_user(previous_user_name, db_user.user_name)
+    return db_user
 
+def update_password_hash(db: Session, db_user: models.User, hashed_password: str):
+    # Silent re-hash after a bcrypt cost change; the password itself is unchanged, so no history entry
+    db_user.hashed_password = hashed_password
     db.commit(); db.refresh(db_user)
     return db_user
 
@@ -92,9 +138,15 @@ def delete_user(db: Session, user_id: int, current_user: models.User):
     if db_user:
         inspector = inspect(db_user)
         state = {c.key: getattr(db_user, c.key) for c in inspector.mapper.column_attrs if c.key != 'hashed_password'}
-        create_history_log(db, current_user.id, "DELETE", db_user, state)
+        create_history_log(db, current_user.id, "DELETE", db_user, state, durable=True)
+        search.unindex_user(db, db_user.id)
+        reports.detach_doctor(db, db_user.id)
+        history_store.detach_archived(db, user_id=db_user.id)
+        caching.bump(db, "users")
+        # The database detaches the user's history and doctor records and drops the links and refresh tokens
         db.delete(db_user)
         db.commit()
+        auth.invalidate_cached_user(db_user.user_name)
     return db_user
 
 def approve_user(db: Session, user_id: int, role: str, current_user: models.User):
@@ -106,9 +158,11 @@ def approve_user(db: Session, user_id: int, role: str, current_user: models.User
         }
         db_user.is_approved = True
         db_user.role = role
-        create_history_log(db, current_user.id, "UPDATE", db_user, changes)
+        create_history_log(db, current_user.id, "UPDATE", db_user, changes, durable=True)
+        caching.bump(db, "users")
         db.commit()
         db.refresh(db_user)
+        auth.invalidate_cached_user(db_user.user_name)
     return db_user
 
 # --- MODIFIED: Added block_user function ---
@@ -120,9 +174,13 @@ def block_user(db: Session, user_id: int, is_blocked: bool, current_user: models
         }
         db_user.is_blocked = is_blocked
         action = "BLOCK" if is_blocked else "UNBLOCK"
-        create_history_log(db, current_user.id, action, db_user, changes)
+        if is_blocked:
+            revoke_user_refresh_tokens(db, db_user.id)
+        create_history_log(db, current_user.id, action, db_user, changes, durable=True)
+        caching.bump(db, "users")
         db.commit()
         db.refresh(db_user)
+        auth.invalidate_cached_user(db_user.user_name)
     return db_user
 
 # --- Invitation Functions ---
@@ -133,41 +191,182 @@ def create_invitation(db: Session, email: str):
 def get_invitation_by_token(db: Session, token: str): return db.query(models.Invitation).filter(models.Invitation.token == token).first()
 def get_invitation_by_email(db: Session, email: str): return db.query(models.Invitation).filter(models.Invitation.email == email).first()
 
+# --- Refresh Token Functions ---
+def create_refresh_token(db: Session, user_id: int, family: Optional[str] = None) -> str:
+    """Stores a new refresh token for the user (starting a new family unless given) and returns the raw token."""
+    token, now = secrets.token_urlsafe(32), datetime.now(timezone.utc)
+    db.add(models.RefreshToken(user_id=user_id, token_hash=auth.hash_refresh_token(token), family=family or secrets.token_hex(16),
+                               created_at=now, expires_at=now + timedelta(days=auth.REFRESH_TOKEN_EXPIRE_DAYS)))
+    db.commit()
+    return token
+
+def rotate_refresh_token(db: Session, token: str):
+    """
+    Exchanges a refresh token for (user, successor token). Returns "INVALID", "BLOCKED" or
+    "NOT_APPROVED" instead when no access token may be issued.
+    """
+    rt, token_hash, now = models.RefreshToken, auth.hash_refresh_token(token), datetime.now(timezone.utc)
+    # Claiming the token and revoking it is one statement, so two concurrent exchanges cannot both succeed
+    claimed = db.execute(update(rt).where(rt.token_hash == token_hash, rt.revoked_at.is_(None), rt.expires_at > now)
+                         .values(revoked_at=now).returning(rt.user_id, rt.family)).first()
+    if claimed is None:
+        reused = db.execute(select(rt.family).where(rt.token_hash == token_hash, rt.revoked_at.is_not(None))).first()
+        if reused:
+            # A revoked token came back, so it may have leaked: end every session descended from it
+            db.execute(update(rt).where(rt.family == reused.family, rt.revoked_at.is_(None)).values(revoked_at=now))
+        db.commit()
+        return "INVALID"
+    user = get_user(db, claimed.user_id)
+    if user.is_blocked or not user.is_approved:
+        db.commit()
+        return "BLOCKED" if user.is_blocked else "NOT_APPROVED"
+    return user, create_refresh_token(db, user.id, claimed.family)
+
+def revoke_refresh_token(db: Session, token: str):
+    rt = models.RefreshToken
+    db.execute(update(rt).where(rt.token_hash == auth.hash_refresh_token(token), rt.revoked_at.is_(None))
+               .values(revoked_at=datetime.now(timezone.utc)))
+    db.commit()
+
+def revoke_user_refresh_tokens(db: Session, user_id: int):
+    """Revokes every refresh token of the user, in the caller's transaction."""
+    rt = models.RefreshToken
+    db.execute(update(rt).where(rt.user_id == user_id, rt.revoked_at.is_(None)).values(revoked_at=datetime.now(timezone.utc)))
+
 # --- Patient Functions ---
 def get_patient(db: Session, patient_id: int): return db.query(models.Patient).filter(models.Patient.id == patient_id).first()
 def get_patient_by_personal_number(db: Session, personal_number: str): return db.query(models.Patient).filter(models.Patient.personal_number == personal_number).first()
-def get_patients(db: Session, skip: int = 0, limit: int = 100, filters: Dict[str, Optional[str]] = None):
-    query = db.query(models.Patient).options(
-        joinedload(models.Patient.staff_assigned),
-        joinedload(models.Patient.anex_records).joinedload(models.AnexRecord.doctor),
-        joinedload(models.Patient.anex_records).joinedload(models.AnexRecord.service),
-        joinedload(models.Patient.anex_records).joinedload(models.AnexRecord.finance),
+def patient_filter_clauses(filters: Dict[str, Optional[str]] = None) -> list:
+    """
+    Translates the /patients/ filters into WHERE clauses on the patients table.
+    Relationship filters become uncorrelated `id IN (SELECT patient_id ...)` semi-joins,
+    which SQLite evaluates once instead of probing anex_records for every patient.
+    """
+    clauses = []
+    if not filters:
+        return clauses
+    # Text filters are answered from the trigram index when possible (see search.py)
+    for key, column in (("personal_number", models.Patient.personal_number),
+                        ("lastname", models.Patient.last_name), ("firstname", models.Patient.first_name)):
+        term = filters.get(key)
+        if not term:
+            continue
+        if search.usable(term):
+            clauses.append(models.Patient.id.in_(search.patient_ids_matching(term, column.key)))
+        else:
+            clauses.append(column.ilike(f"%{term}%"))
+    if filters.get("doctor"):
+        if search.usable(filters["doctor"]):
+            doctor_match = models.AnexRecord.doctor_id.in_(search.user_ids_matching(filters["doctor"], "full_name"))
+            clauses.append(models.Patient.id.in_(select(models.AnexRecord.patient_id).where(doctor_match)))
+        else:
+            clauses.append(models.Patient.id.in_(
+                select(models.AnexRecord.patient_id).join(models.AnexRecord.doctor).where(
+                    (models.User.first_name + ' ' + models.User.last_name).ilike(f"%{filters['doctor']}%")
+                )
+            ))
+    if filters.get("funder"):
+        funder_search = filters["funder"].lower()
+        if 'self' in funder_search:
+            clauses.append(models.Patient.id.in_(
+                select(models.AnexRecord.patient_id).where(models.AnexRecord.finance_id.is_(None))
+            ))
+        else:
+            clauses.append(models.Patient.id.in_(
+                select(models.AnexRecord.patient_id).join(models.AnexRecord.finance).where(
+                    models.Finance.funder_name.ilike(f"%{filters['funder']}%")
+                )
+            ))
+    if filters.get("research"):
+        clauses.append(models.Patient.id.in_(
+            select(models.AnexRecord.patient_id).join(models.AnexRecord.service).where(
+                models.Service.research_name.ilike(f"%{filters['research']}%")
+            )
+        ))
+    if filters.get("staff"):
+        if search.usable(filters["staff"]):
+            staff_match = models.user_patient_association.c.user_id.in_(search.user_ids_matching(filters["staff"], "user_name"))
+            clauses.append(models.Patient.id.in_(select(models.user_patient_association.c.patient_id).where(staff_match)))
+        else:
+            clauses.append(models.Patient.id.in_(
+                select(models.user_patient_association.c.patient_id).join(
+                    models.User, models.User.id == models.user_patient_association.c.user_id
+                ).where(models.User.user_name.ilike(f"%{filters['staff']}%"))
+            ))
+    return clauses
+
+def patient_response_options():
+    """Loader options covering everything schemas.Patient serializes, one batched IN query per relationship."""
+    return (
+        selectinload(models.Patient.staff_assigned),
+        selectinload(models.Patient.anex_records).selectinload(models.AnexRecord.doctor),
+        selectinload(models.Patient.anex_records).selectinload(models.AnexRecord.service),
+        selectinload(models.Patient.anex_records).selectinload(models.AnexRecord.finance),
     )
 
-    if filters:
-        if filters.get("personal_number"):
-            query = query.filter(models.Patient.personal_number.ilike(f"%{filters['personal_number']}%"))
-        if filters.get("lastname"):
-            query = query.filter(models.Patient.last_name.ilike(f"%{filters['lastname']}%"))
-        if filters.get("firstname"):
-            query = query.filter(models.Patient.first_name.ilike(f"%{filters['firstname']}%"))
-        if filters.get("doctor"):
-            search_like = f"%{filters['doctor']}%"
-            query = query.join(models.Patient.anex_records).join(models.AnexRecord.doctor).filter(
-                concat(models.User.first_name, ' ', models.User.last_name).ilike(search_like)
-            )
-        if filters.get("funder"):
-            funder_search = filters["funder"].lower()
-            if 'self' in funder_search:
-                query = query.join(models.Patient.anex_records).filter(models.AnexRecord.finance_id.is_(None))
-            else:
-                query = query.join(models.Patient.anex_records).join(models.AnexRecord.finance).filter(models.Finance.funder_name.ilike(f"%{filters['funder']}%"))
-        if filters.get("research"):
-            query = query.join(models.Patient.anex_records).join(models.AnexRecord.service).filter(models.Service.research_name.ilike(f"%{filters['research']}%"))
-        if filters.get("staff"):
-            query = query.join(models.Patient.staff_assigned).filter(models.User.user_name.ilike(f"%{filters['staff']}%"))
-    
-    return query.distinct().order_by(models.Patient.id).offset(skip).limit(limit).all()
+def patient_page_ids_query(skip: int = 0, limit: int = 100, filters: Dict[str, Optional[str]] = None, after_id: Optional[int] = None):
+    # Phase 1: pick the page of patient ids on the patients table alone, so LIMIT counts patients, not joined rows
+    stmt = select(models.Patient.id).where(*patient_filter_clauses(filters))
+    if after_id is not None:
+        # Keyset mode: seek past the last id of the previous page instead of scanning skipped rows
+        stmt = stmt.where(models.Patient.id > after_id)
+        skip = 0
+    return stmt.order_by(models.Patient.id).offset(skip).limit(limit)
+
+def patients_by_ids_query(page_ids: List[int]):
+    # Phase 2: load the page and fill its relationships with one batched IN query per relationship
+    return select(models.Patient).options(*patient_response_options()).where(models.Patient.id.in_(page_ids)).order_by(models.Patient.id)
+
+def get_patients(db: Session, skip: int = 0, limit: int = 100, filters: Dict[str, Optional[str]] = None, after_id: Optional[int] = None):
+    page_ids = db.scalars(patient_page_ids_query(skip, limit, filters, after_id)).all()
+    if not page_ids:
+        return []
+    return db.scalars(patients_by_ids_query(page_ids)).all()
+
+def parse_patients_cursor(cursor: str):
+    """Returns the id to seek past (None for the first page), or False if the cursor is malformed."""
+    key = decode_cursor(cursor)
+    if key is None or len(key) > 1 or not all(is_cursor_id(v) for v in key): return False
+    return key[0] if key else None
+
+def patients_page(patients: list, limit: int) -> dict:
+    # Callers fetch one extra row to know whether another page exists
+    next_cursor = encode_cursor(patients[limit - 1].id) if len(patients) > limit else None
+    return {"items": patients[:limit], "next_cursor": next_cursor}
+
+def get_patients_page(db: Session, limit: int = 100, filters: Dict[str, Optional[str]] = None, cursor: str = ""):
+    after_id = parse_patients_cursor(cursor)
+    if after_id is False: return None
+    return patients_page(get_patients(db, limit=limit + 1, filters=filters, after_id=after_id), limit)
+
+def iter_patient_export_rows(db: Session, filters: Dict[str, Optional[str]] = None, batch_size: int = 1000):
+    """
+    Yields one flat row per (patient, anex record), or one row with empty anex columns for a
+    patient without records. Rows are streamed from the cursor `batch_size` at a time, so
+    memory stays flat however many patients match.
+    """
+    doctor = aliased(models.User)
+    stmt = (
+        select(
+            models.Patient.id.label("patient_id"), models.Patient.personal_number, models.Patient.first_name,
+            models.Patient.last_name, models.Patient.birth_date, models.Patient.nationality, models.Patient.address,
+            models.AnexRecord.id.label("anex_id"), models.AnexRecord.doctor_id,
+            (doctor.first_name + ' ' + doctor.last_name).label("doctor_name"),
+            models.AnexRecord.service_id, models.Service.service_number, models.Service.research_name,
+            models.Service.laboratory_name, models.Service.deadline,
+            models.AnexRecord.finance_id, models.Finance.funder_name,
+            models.AnexRecord.payable_amount, models.AnexRecord.paid_amount,
+        )
+        .select_from(models.Patient)
+        .outerjoin(models.AnexRecord, models.AnexRecord.patient_id == models.Patient.id)
+        .outerjoin(doctor, doctor.id == models.AnexRecord.doctor_id)
+        .outerjoin(models.Service, models.Service.id == models.AnexRecord.service_id)
+        .outerjoin(models.Finance, models.Finance.id == models.AnexRecord.finance_id)
+        .where(*patient_filter_clauses(filters))
+        .order_by(models.Patient.id, models.AnexRecord.id)
+    )
+    for row in db.execute(stmt, execution_options={"yield_per": batch_size}):
+        yield row._asdict()
 
 def create_patient(db: Session, patient: schemas.PatientCreate, user_id: int):
     db_patient = models.Patient(**patient.model_dump())
@@ -177,10 +376,87 @@ def create_patient(db: Session, patient: schemas.PatientCreate, user_id: int):
         db_patient.staff_assigned.append(current_user)
 
     db.add(db_patient); db.flush()
+    search.index_patient(db, db_patient)
     create_history_log(db, user_id, "CREATE", db_patient, patient.model_dump())
     db.commit(); db.refresh(db_patient)
     return db_patient
 
+def bulk_create_patients(db: Session, records, current_user: models.User, chunk_size: int = 1000):
+    """
+    Imports (row_number, record) pairs from importers.iter_records in chunks of `chunk_size`.
+    Each chunk costs one duplicate lookup, one multi-row insert per table, one history entry
+    and one commit; rows that fail validation or duplicate a personal number are reported, not inserted.
+    A chunk that still hits a constraint at insert time is rolled back and retried row by row.
+    """
+    report = {"created": 0, "errors": []}
+    seen_personal_numbers = set()
+
+    def flush_chunk(chunk):
+        if not chunk: return
+        numbers = [p.personal_number for _, p in chunk]
+        existing = set(db.scalars(select(models.Patient.personal_number).where(models.Patient.personal_number.in_(numbers))))
+        pending = []
+        for row_number, patient in chunk:
+            if patient.personal_number in existing:
+                report["errors"].append({"row": row_number, "personal_number": patient.personal_number,
+                                         "error": "Patient with this personal number already exists."})
+            else:
+                pending.append((row_number, patient))
+        if not pending: return
+        to_insert = [patient.model_dump() for _, patient in pending]
+
+        try:
+            created = db.execute(insert(models.Patient).returning(models.Patient.id, models.Patient.personal_number,
+                                                                  models.Patient.first_name, models.Patient.last_name),
+                                 to_insert).all()
+            db.execute(insert(models.user_patient_association),
+                       [{"user_id": current_user.id, "patient_id": row.id} for row in created])
+            search.index_patient_rows(db, created)
+            fields = {patient["personal_number"]: patient for patient in to_insert}
+            history_snapshots.snapshot_bulk_created(db, [(row.id, fields[row.personal_number]) for row in created])
+            create_summary_history_log(db, current_user.id, "BULK_CREATE", "Patient", created[0].id, {
+                "count": len(created),
+                "patients": {row.id: row.personal_number for row in created},
+            })
+            db.commit()
+        except IntegrityError as exc:
+            # Another writer took one of the numbers after the lookup; retry row by row so only the
+            # conflicting rows are reported and earlier chunks stay committed
+            db.rollback()
+            if len(pending) > 1:
+                for row in pending: flush_chunk([row])
+                return
+            row_number, patient = pending[0]
+            report["errors"].append({"row": row_number, "personal_number": patient.personal_number,
+                                     "error": f"Could not be inserted: {exc.orig}"})
+            return
+        report["created"] += len(created)
+
+    chunk = []
+    for row_number, record in records:
+        if isinstance(record, str):
+            report["errors"].append({"row": row_number, "personal_number": None, "error": record})
+            continue
+        try:
+            patient = schemas.PatientCreate.model_validate(record)
+        except ValidationError as exc:
+            message = "; ".join(f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in exc.errors())
+            # Only a string fits the report's personal_number; anything else is what failed validation
+            personal_number = record.get("personal_number")
+            report["errors"].append({"row": row_number, "error": message,
+                                     "personal_number": personal_number if isinstance(personal_number, str) else None})
+            continue
+        if patient.personal_number in seen_personal_numbers:
+            report["errors"].append({"row": row_number, "personal_number": patient.personal_number,
+                                     "error": "Duplicate personal number within the upload."})
+            continue
+        seen_personal_numbers.add(patient.personal_number)
+        chunk.append((row_number, patient))
+        if len(chunk) >= chunk_size:
+            flush_chunk(chunk); chunk = []
+    flush_chunk(chunk)
+    return report
+
 def update_patient(db: Session, patient_id: int, patient_update: schemas.PatientUpdate, current_user: models.User):
     db_patient = get_patient(db, patient_id)
     if not db_patient: return None
@@ -195,6 +471,7 @@ def update_patient(db: Session, patient_id: int, patient_update: schemas.Patient
 
     if changes:
         create_history_log(db, current_user.id, "UPDATE", db_patient, changes)
+        search.index_patient(db, db_patient)
 
     db.commit(); db.refresh(db_patient)
     return db_patient
@@ -204,7 +481,11 @@ def delete_patient(db: Session, patient_id: int, current_user: models.User):
     if db_patient:
         inspector = inspect(db_patient)
         state = {c.key: getattr(db_patient, c.key) for c in inspector.mapper.column_attrs}
-        create_history_log(db, current_user.id, "DELETE", db_patient, state)
+        create_history_log(db, current_user.id, "DELETE", db_patient, state, durable=True)
+        search.unindex_patient(db, db_patient.id)
+        reports.remove_patient(db, db_patient.id)
+        history_store.detach_archived(db, patient_id=patient_id)
+        # One DELETE: the database removes the anex records and staff links and detaches the history
         db.delete(db_patient)
         db.commit()
     return db_patient
@@ -217,47 +498,60 @@ def delete_patient_by_personal_number(db: Session, personal_number: str, current
     return None
 
 def sync_anex_records(db: Session, patient_id: int, records: List[schemas.AnexRecordUpdate], current_user: models.User):
-    db_patient = db.query(models.Patient).options(joinedload(models.Patient.anex_records)).filter(models.Patient.id == patient_id).first()
-    if not db_patient: return None
-
-    existing_records_map = {r.id: r for r in db_patient.anex_records}
+    """
+    Makes the patient's anex records match `records` set-wise: one DELETE (admins only),
+    one executemany UPDATE, one multi-row INSERT and one aggregated history entry, so the
+    number of queries does not grow with the size of the payload.
+    """
+    if not db.query(models.Patient.id).filter(models.Patient.id == patient_id).first(): return None
+
+    anex = models.AnexRecord
+    columns = [c.key for c in anex.__table__.columns]
+    existing_records_map = {row.id: row._asdict() for row in db.execute(select(anex.__table__).where(anex.patient_id == patient_id))}
     incoming_record_ids = {r.id for r in records if r.id is not None}
+    deleted, updated, created = {}, {}, {}
+    # Old/new values of every touched record, folded into the finance summary at the end
+    removed_values, added_values = [], []
 
     if current_user.role == 'admin':
         ids_to_delete = set(existing_records_map.keys()) - incoming_record_ids
         if ids_to_delete:
-            records_to_delete = db.query(models.AnexRecord).filter(models.AnexRecord.id.in_(ids_to_delete)).all()
-            for rec in records_to_delete:
-                inspector = inspect(rec)
-                state = {c.key: getattr(rec, c.key) for c in inspector.mapper.column_attrs}
-                create_history_log(db, current_user.id, "DELETE", rec, state)
-            db.query(models.AnexRecord).filter(models.AnexRecord.id.in_(ids_to_delete)).delete(synchronize_session=False)
+            for record_id in ids_to_delete:
+                deleted[record_id] = existing_records_map[record_id]
+                removed_values.append(existing_records_map[record_id])
+            db.execute(delete(anex).where(anex.id.in_(ids_to_delete)))
 
+    update_mappings, new_records = [], []
     for record_data in records:
         record_dict = record_data.model_dump()
         record_id = record_dict.pop('id', None)
-        
+
         if record_id is not None and record_id in existing_records_map:
-            # Update
             existing_record = existing_records_map[record_id]
-            changes = {}
-            for key, value in record_dict.items():
-                old_value = getattr(existing_record, key)
-                if old_value != value:
-                    changes[key] = {"before": old_value, "after": value}
-            
+            changes = {key: {"before": existing_record[key], "after": value}
+                       for key, value in record_dict.items() if existing_record[key] != value}
             if changes:
-                db.query(models.AnexRecord).filter(models.AnexRecord.id == record_id).update(record_dict, synchronize_session=False)
-                create_history_log(db, current_user.id, "UPDATE", existing_record, changes)
+                update_mappings.append({"id": record_id, **record_dict})
+                updated[record_id] = changes
+                removed_values.append(existing_record)
+                added_values.append(record_dict)
         else:
-            # Add new record
-            new_record = models.AnexRecord(**record_dict, patient_id=patient_id)
-            db.add(new_record); db.flush()
-            create_history_log(db, current_user.id, "CREATE", new_record, record_dict)
-    
+            new_records.append({**record_dict, "patient_id": patient_id})
+
+    if update_mappings:
+        db.bulk_update_mappings(anex, update_mappings)
+    if new_records:
+        for row in db.execute(insert(anex).returning(*(getattr(anex, c) for c in columns)), new_records):
+            created[row.id] = row._asdict()
+        added_values.extend(new_records)
+
+    if deleted or updated or created:
+        summary = {key: value for key, value in (("created", created), ("updated", updated), ("deleted", deleted)) if value}
+        create_summary_history_log(db, current_user.id, "SYNC_ANEX", "Patient", patient_id, summary, patient_id=patient_id)
+    reports.apply_anex_changes(db, removed=removed_values, added=added_values)
     db.commit()
-    
-    return db.query(models.Patient).options(joinedload(models.Patient.anex_records)).filter(models.Patient.id == patient_id).first()
+
+    return db.query(models.Patient).options(*patient_response_options()).filter(models.Patient.id == patient_id).first()
 
 
 # --- Finance Functions ---
@@ -267,6 +561,7 @@ def create_finance(db: Session, finance: schemas.FinanceCreate, current_user: mo
     db_finance = models.Finance(**finance.model_dump())
     db.add(db_finance); db.flush()
     create_history_log(db, current_user.id, "CREATE", db_finance, finance.model_dump())
+    caching.bump(db, "finances")
     db.commit(); db.refresh(db_finance)
     return db_finance
 
@@ -282,15 +577,20 @@ def update_finance(db: Session, finance_id: int, finance_update: schemas.Finance
         setattr(db_finance, key, value)
     if changes:
         create_history_log(db, current_user.id, "UPDATE", db_finance, changes)
+        caching.bump(db, "finances")
     db.commit(); db.refresh(db_finance)
     return db_finance
 
 def delete_finance(db: Session, finance_id: int, current_user: models.User):
     db_finance = get_finance(db, finance_id)
     if db_finance:
+        # Foreign keys are enforced, so a funder still referenced by anex records cannot be removed
+        if db.query(models.AnexRecord.id).filter(models.AnexRecord.finance_id == finance_id).first():
+            return "IN_USE"
         inspector = inspect(db_finance)
         state = {c.key: getattr(db_finance, c.key) for c in inspector.mapper.column_attrs}
         create_history_log(db, current_user.id, "DELETE", db_finance, state)
+        caching.bump(db, "finances")
         db.delete(db_finance)
         db.commit()
     return db_finance
@@ -302,6 +602,7 @@ def create_service(db: Session, service: schemas.ServiceCreate, current_user: mo
     db_service = models.Service(**service.model_dump())
     db.add(db_service); db.flush()
     create_history_log(db, current_user.id, "CREATE", db_service, service.model_dump())
+    caching.bump(db, "services")
     db.commit(); db.refresh(db_service)
     return db_service
 
@@ -317,42 +618,106 @@ def update_service(db: Session, service_id: int, service_update: schemas.Service
         setattr(db_service, key, value)
     if changes:
         create_history_log(db, current_user.id, "UPDATE", db_service, changes)
+        caching.bump(db, "services")
     db.commit(); db.refresh(db_service)
     return db_service
 
 def delete_service(db: Session, service_id: int, current_user: models.User):
     db_service = get_service(db, service_id)
     if db_service:
+        if db.query(models.AnexRecord.id).filter(models.AnexRecord.service_id == service_id).first():
+            return "IN_USE"
         inspector = inspect(db_service)
         state = {c.key: getattr(db_service, c.key) for c in inspector.mapper.column_attrs}
         create_history_log(db, current_user.id, "DELETE", db_service, state)
+        caching.bump(db, "services")
         db.delete(db_service); db.commit()
     return db_service
 
 # --- History Log Functions ---
-def get_history_logs(db: Session, skip: int, limit: int, filters: Dict[str, Optional[str]]):
-    query = db.query(models.HistoryLog).options(
-        joinedload(models.HistoryLog.user),
-        joinedload(models.HistoryLog.patient)
+def history_logs_query(skip: int, limit: int, filters: Dict[str, Optional[str]], after: Optional[tuple] = None, base=None,
+                       log=models.HistoryLog):
+    """
+    Filtered, ordered page of history logs; `base` replaces the default ORM select (e.g. plain columns)
+    and `log` the entity it reads, e.g. history_store.ArchivedLog.
+    """
+    query = base if base is not None else select(log).options(
+        joinedload(log.user),
+        joinedload(log.patient)
     )
 
     if filters:
         if filters.get("author"):
-            query = query.join(models.User).filter(models.User.user_name.ilike(f"%{filters['author']}%"))
+            if search.usable(filters["author"]):
+                query = query.where(log.user_id.in_(search.user_ids_matching(filters["author"], "user_name")))
+            else:
+                query = query.join(models.User, models.User.id == log.user_id).where(models.User.user_name.ilike(f"%{filters['author']}%"))
         if filters.get("date"):
             # Filter for the entire day, assuming date is a datetime.date object
             start_of_day = datetime.combine(filters['date'], datetime.min.time()).replace(tzinfo=timezone.utc)
             end_of_day = start_of_day + timedelta(days=1)
-            query = query.filter(models.HistoryLog.timestamp >= start_of_day, models.HistoryLog.timestamp < end_of_day)
+            query = query.where(log.timestamp >= start_of_day, log.timestamp < end_of_day)
         if filters.get("patient"):
-            search_like = f"%{filters['patient']}%"
-            # Use outer join in case a log is not associated with a patient (e.g., User creation)
-            query = query.outerjoin(models.HistoryLog.patient).filter(
-                or_(
-                    models.Patient.personal_number.ilike(search_like),
-                    concat(models.Patient.first_name, ' ', models.Patient.last_name).ilike(search_like)
+            if search.usable(filters["patient"]):
+                query = query.where(log.patient_id.in_(
+                    search.patient_ids_matching(filters["patient"], "personal_number", "full_name")
+                ))
+            else:
+                search_like = f"%{filters['patient']}%"
+                # Use outer join in case a log is not associated with a patient (e.g., User creation)
+                query = query.outerjoin(models.Patient, models.Patient.id == log.patient_id).where(
+                    or_(
+                        models.Patient.personal_number.ilike(search_like),
+                        (models.Patient.first_name + ' ' + models.Patient.last_name).ilike(search_like)
+                    )
                 )
-            )
 
-    return query.order_by(models.HistoryLog.timestamp.desc()).offset(skip).limit(limit).all()
+    if after is not None:
+        # Keyset mode: rows strictly older than (timestamp, id) of the previous page's last row
+        after_ts, after_id = after
+        query = query.where(or_(
+            log.timestamp < after_ts,
+            and_(log.timestamp == after_ts, log.id < after_id)
+        ))
+        skip = 0
+
+    return query.order_by(log.timestamp.desc(), log.id.desc()).offset(skip).limit(limit)
+
+def history_count_query(filters: Dict[str, Optional[str]], after: Optional[tuple] = None):
+    """Number of main-table entries matching `filters`, to know how far an offset reaches into the archive."""
+    page = history_logs_query(0, None, filters, after, base=select(models.HistoryLog.id))
+    return select(func.count()).select_from(page.subquery())
+
+def get_history_logs(db: Session, skip: int, limit: int, filters: Dict[str, Optional[str]], after: Optional[tuple] = None):
+    logs = db.scalars(history_logs_query(skip, limit, filters, after)).all()
+    if history_store.ARCHIVE_ENABLED and len(logs) < limit:
+        # Archived entries are all older than the main table's, so the page continues there;
+        # a page that starts past the end of the main table skips what is left of the offset
+        archive_skip = 0 if logs or not skip else skip - db.scalar(history_count_query(filters, after))
+        logs += db.scalars(history_logs_query(archive_skip, limit - len(logs), filters, after,
+                                              log=history_store.ArchivedLog)).all()
+    return logs
+
+def parse_history_cursor(cursor: str):
+    """Returns the (timestamp, id) to continue after (None for the first page), or False if the cursor is malformed."""
+    key = decode_cursor(cursor)
+    if key is None or len(key) not in (0, 2): return False
+    if not key: return None
+    if not is_cursor_id(key[1]): return False
+    try:
+        return (datetime.fromisoformat(key[0]), key[1])
+    except (TypeError, ValueError):
+        return False
+
+def history_logs_page(logs: list, limit: int) -> dict:
+    next_cursor = None
+    if len(logs) > limit:
+        last = logs[limit - 1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+    return {"items": logs[:limit], "next_cursor": next_cursor}
+
+def get_history_logs_page(db: Session, limit: int, filters: Dict[str, Optional[str]], cursor: str = ""):
+    after = parse_history_cursor(cursor)
+    if after is False: return None
+    return history_logs_page(get_history_logs(db, skip=0, limit=limit + 1, filters=filters, after=after), limit)
 
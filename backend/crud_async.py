@@ -0,0 +1,54 @@
+"""
+AsyncSession versions of the read-side crud functions, used by routes served
+from the async stack (see database.ASYNC_ROUTES). They execute the same
+statements as their crud counterparts, so both stacks return the same rows.
+"""
+from typing import Dict, Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud, models, reports, history_store
+
+
+# --- User Functions ---
+async def get_all_users_basic(db: AsyncSession):
+    return (await db.scalars(select(models.User).where(models.User.is_approved == True))).all()
+
+
+# --- Patient Functions ---
+async def get_patients(db: AsyncSession, skip: int = 0, limit: int = 100, filters: Dict[str, Optional[str]] = None, after_id: Optional[int] = None):
+    page_ids = (await db.scalars(crud.patient_page_ids_query(skip, limit, filters, after_id))).all()
+    if not page_ids:
+        return []
+    return (await db.scalars(crud.patients_by_ids_query(page_ids))).all()
+
+async def get_patients_page(db: AsyncSession, limit: int = 100, filters: Dict[str, Optional[str]] = None, cursor: str = ""):
+    after_id = crud.parse_patients_cursor(cursor)
+    if after_id is False: return None
+    return crud.patients_page(await get_patients(db, limit=limit + 1, filters=filters, after_id=after_id), limit)
+
+
+# --- Finance & Service Functions ---
+async def get_finances(db: AsyncSession, skip: int = 0, limit: int = 100):
+    return (await db.scalars(select(models.Finance).offset(skip).limit(limit))).all()
+
+async def get_services(db: AsyncSession, skip: int = 0, limit: int = 100):
+    return (await db.scalars(select(models.Service).offset(skip).limit(limit))).all()
+
+async def finance_report(db: AsyncSession, **kwargs):
+    # The report only issues Core statements, so it runs as-is on the session's sync facade
+    return await db.run_sync(reports.finance_report, **kwargs)
+
+
+# --- History Log Functions ---
+async def get_history_logs(db: AsyncSession, skip: int, limit: int, filters: Dict[str, Optional[str]], after: Optional[tuple] = None):
+    logs = (await db.scalars(crud.history_logs_query(skip, limit, filters, after))).all()
+    if history_store.ARCHIVE_ENABLED and len(logs) < limit:
+        archive_skip = 0 if logs or not skip else skip - await db.scalar(crud.history_count_query(filters, after))
+        logs += (await db.scalars(crud.history_logs_query(archive_skip, limit - len(logs), filters, after,
+                                                          log=history_store.ArchivedLog))).all()
+    return logs
+
+async def get_history_logs_page(db: AsyncSession, limit: int, filters: Dict[str, Optional[str]], cursor: str = ""):
+    after = crud.parse_history_cursor(cursor)
+    if after is False: return None
+    return crud.history_logs_page(await get_history_logs(db, skip=0, limit=limit + 1, filters=filters, after=after), limit)
@@ -1,13 +1,142 @@
 # /database.py
-from sqlalchemy import create_engine
+import os
+import json
+import time
+from datetime import datetime, date
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+import metrics
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./lab_app.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./lab_app.db")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# --- SQLite Production Profile ---
+# Applied to every new connection. WAL lets readers proceed while a writer commits,
+# busy_timeout makes writers queue instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("DB_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("DB_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")),
+    "cache_size": int(os.getenv("DB_CACHE_SIZE", "-65536")),  # negative = KiB, i.e. 64 MiB per connection
+    "mmap_size": int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024))),
+    # Keep ON: deleting a patient or user relies on the ON DELETE actions declared in models.py
+    "foreign_keys": os.getenv("DB_FOREIGN_KEYS", "ON"),
+}
+
+# Sync routes run on AnyIO's worker threads (40 by default), so size + overflow
+# covers every thread of one uvicorn worker without making requests wait on the pool.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# SQLite file holding archived history logs (see history_store.py), attached to every app connection as `archive`
+HISTORY_ARCHIVE_PATH = os.getenv("HISTORY_ARCHIVE_PATH", "")
+
+
+def json_default(obj):
+    """Custom JSON serializer for objects not serializable by default json code"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+def json_serializer(value):
+    # Used by JSON columns, so history `changes` dicts may hold dates without a pre-pass
+    return json.dumps(value, default=json_default)
+
+
+# --- Query Instrumentation ---
+# Every engine reports each statement and its duration to the current request's metrics collector.
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.record_query(statement, time.perf_counter() - conn.info["query_start_time"].pop())
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute, so drop its start time here
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start_time"):
+        conn.info["query_start_time"].pop()
+
+def instrument(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+    return engine
+
+
+def _apply_pragmas(engine, pragmas: dict, in_memory: bool):
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if in_memory and name == "journal_mode":
+                continue
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def attach_archive(engine, path: str):
+    @event.listens_for(engine, "connect")
+    def attach_history_archive(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("ATTACH DATABASE ? AS archive", (path,))
+        cursor.close()
+
+
+def make_engine(url: str = SQLALCHEMY_DATABASE_URL, pragmas: dict = None, **engine_kwargs):
+    """
+    Builds an engine for `url`. File-backed SQLite databases get the pragmas
+    above (or `pragmas`) on every connection and a pool sized for the worker
+    threads; any other URL is passed through to create_engine unchanged.
+    """
+    parsed = make_url(url)
+    engine_kwargs.setdefault("json_serializer", json_serializer)
+    if parsed.get_backend_name() != "sqlite":
+        return instrument(create_engine(url, **engine_kwargs))
+
+    in_memory = parsed.database in (None, "", ":memory:")
+    if not in_memory:
+        engine_kwargs.setdefault("pool_size", DB_POOL_SIZE)
+        engine_kwargs.setdefault("max_overflow", DB_MAX_OVERFLOW)
+        engine_kwargs.setdefault("pool_timeout", DB_POOL_TIMEOUT)
+    engine = create_engine(url, connect_args={"check_same_thread": False}, **engine_kwargs)
+
+    _apply_pragmas(engine, SQLITE_PRAGMAS if pragmas is None else pragmas, in_memory)
+    return instrument(engine)
+
+
+def make_async_engine(url: str = SQLALCHEMY_DATABASE_URL, pragmas: dict = None, **engine_kwargs):
+    """
+    Async counterpart of make_engine. A plain sqlite:// URL is switched to the
+    aiosqlite driver and gets the same pragmas and pool sizing; other URLs must
+    already name an async driver.
+    """
+    parsed = make_url(url)
+    engine_kwargs.setdefault("json_serializer", json_serializer)
+    if parsed.get_backend_name() != "sqlite":
+        engine = create_async_engine(parsed, **engine_kwargs)
+        instrument(engine.sync_engine)
+        return engine
+
+    if parsed.get_driver_name() == "pysqlite":
+        parsed = parsed.set(drivername="sqlite+aiosqlite")
+    in_memory = parsed.database in (None, "", ":memory:")
+    if not in_memory:
+        engine_kwargs.setdefault("pool_size", DB_POOL_SIZE)
+        engine_kwargs.setdefault("max_overflow", DB_MAX_OVERFLOW)
+        engine_kwargs.setdefault("pool_timeout", DB_POOL_TIMEOUT)
+    engine = create_async_engine(parsed, **engine_kwargs)
+    _apply_pragmas(engine.sync_engine, SQLITE_PRAGMAS if pragmas is None else pragmas, in_memory)
+    instrument(engine.sync_engine)
+    return engine
+
+
+engine = make_engine()
+if HISTORY_ARCHIVE_PATH:
+    attach_archive(engine, HISTORY_ARCHIVE_PATH)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -18,3 +147,20 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# --- Async Stack (optional, needs aiosqlite) ---
+# Routes named in ASYNC_ROUTES (comma-separated endpoint names, or "all") take an AsyncSession
+# instead of a Session, so a request waiting on the database does not hold a thread-pool worker.
+ASYNC_ROUTES = {name.strip() for name in os.getenv("ASYNC_ROUTES", "").split(",") if name.strip()}
+
+async_engine = make_async_engine() if ASYNC_ROUTES else None
+if async_engine and HISTORY_ARCHIVE_PATH:
+    attach_archive(async_engine.sync_engine, HISTORY_ARCHIVE_PATH)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False) if async_engine else None
+
+def uses_async(route_name: str) -> bool:
+    return "all" in ASYNC_ROUTES or route_name in ASYNC_ROUTES
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,246 @@
+"""
+Server push of data changes: GET /events streams change feed pages (see
+change_feed.py) as Server-Sent Events.
+
+history_logs is the outbox. Every crud mutation writes its history entry in
+its own transaction (or through audit's batched writer), and history ids only
+grow, so the table already holds every change, in order, for all workers. Each
+worker runs one poller. The poller reads the entries past the last id it has
+seen and renders the touched entities once per role. It then fans them out to
+that worker's streams. A commit in this worker that wrote history wakes the
+poller at once. Other workers' changes, and entries from the batched history
+writer, arrive within EVENTS_POLL_INTERVAL seconds of being written. The poller
+only reads while a stream is open.
+
+The SSE event id is the change feed cursor. A client reconnecting with
+Last-Event-ID (or ?since=) first receives what it missed. A stream closes in
+two cases, and the client reconnects and catches up the same way:
+- after EVENTS_MAX_STREAM_SECONDS, so token expiry, blocking and role changes
+  take effect;
+- when the client falls EVENTS_QUEUE_SIZE pages behind.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import change_feed, crud, fast_json
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "0.25"))
+EVENTS_KEEPALIVE_SECONDS = float(os.getenv("EVENTS_KEEPALIVE_SECONDS", "15"))
+EVENTS_MAX_STREAM_SECONDS = float(os.getenv("EVENTS_MAX_STREAM_SECONDS", "300"))
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+
+# Entity types a change can carry (anex records arrive inside their patient)
+ENTITY_TYPES = ("Patient", "Finance", "Service", "User")
+_PAGE_SIZE = 500
+_WROTE_HISTORY_KEY = "events_wrote_history"
+_CLOSE = object()
+
+_subscribers = set()
+_loop = None
+_wake = None
+_task = None
+_cursor = None # last history id fanned out, None until the poller has read it
+
+
+# --- Publishing ---
+def publish_after_commit(db: Session):
+    """Wakes this worker's poller once `db` commits; called by crud for every history entry."""
+    db.info[_WROTE_HISTORY_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_poller(session):
+    if session.info.pop(_WROTE_HISTORY_KEY, False):
+        notify()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_wake(session):
+    session.info.pop(_WROTE_HISTORY_KEY, None)
+
+
+def notify():
+    """Makes the poller read now instead of at its next interval. Safe from any thread."""
+    if _loop is not None:
+        try:
+            _loop.call_soon_threadsafe(_wake.set)
+        except RuntimeError: # loop already closed
+            pass
+
+
+# --- Poller ---
+class _Page:
+    """One change feed page, each change pre-rendered per role as (entity_type, JSON)."""
+    def __init__(self, after: int, cursor: int, changes: dict):
+        self.after, self.cursor, self.changes = after, cursor, changes
+
+
+def _cursor_of(feed) -> int:
+    return crud.decode_cursor(feed["cursor"])[0]
+
+
+def _rendered(feed):
+    return [(change["entity_type"], fast_json.dumps(change)) for change in feed["changes"]]
+
+
+def _read_pages(after, roles):
+    """Pages past history id `after` for each role in `roles` (is_admin flags), and the new cursor."""
+    pages = []
+    with SessionLocal() as db:
+        if after is None:
+            return pages, _cursor_of(change_feed.get_changes(db))
+        while True:
+            feeds = {is_admin: change_feed.get_changes(db, crud.encode_cursor(after), _PAGE_SIZE, is_admin) for is_admin in roles}
+            if any(feed == "EXPIRED" for feed in feeds.values()):
+                # Archived past the poller, which only happens if it stalled; streams resync themselves
+                return pages, _cursor_of(change_feed.get_changes(db))
+            feed = next(iter(feeds.values()))
+            cursor = _cursor_of(feed)
+            if cursor == after:
+                return pages, after
+            # Which entries a page consumes does not depend on the role, so every role's page ends at `cursor`
+            pages.append(_Page(after, cursor, {is_admin: _rendered(feed) for is_admin, feed in feeds.items()}))
+            after = cursor
+            if not feed["has_more"]:
+                return pages, after
+
+
+async def _poll():
+    global _cursor
+    while True:
+        try:
+            await asyncio.wait_for(_wake.wait(), EVENTS_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+        if not _subscribers:
+            _cursor = None
+            continue
+        try:
+            pages, _cursor = await run_in_threadpool(_read_pages, _cursor, {sub.is_admin for sub in _subscribers})
+        except Exception:
+            logger.exception("Reading history for /events failed")
+            continue
+        for page in pages:
+            for sub in list(_subscribers):
+                sub.offer(page)
+
+
+def _ensure_poller():
+    global _loop, _wake, _task
+    loop = asyncio.get_running_loop()
+    if _task is not None and _loop is loop and not _task.done():
+        return
+    _loop, _wake = loop, asyncio.Event()
+    # A fresh context, so the poller's queries are not counted against the request that started it
+    _task = loop.create_task(_poll(), context=contextvars.Context())
+
+
+async def stop():
+    """Stops the poller; open streams end with their connections."""
+    global _task, _loop
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+    _task = _loop = None
+
+
+# --- Streams ---
+class _Subscriber:
+    def __init__(self, is_admin: bool, types):
+        self.is_admin, self.types = is_admin, types
+        self.queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.cursor = None
+
+    def offer(self, page):
+        try:
+            self.queue.put_nowait(page)
+        except asyncio.QueueFull:
+            # Too far behind: end the stream, the client resumes from its last event id
+            _subscribers.discard(self)
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(_CLOSE)
+
+    def message(self, changes, cursor: int) -> bytes:
+        """The SSE event for a page of rendered changes, or b"" if none is of a subscribed type."""
+        self.cursor = max(self.cursor, cursor)
+        data = [rendered for entity_type, rendered in changes if entity_type in self.types]
+        if not data: return b""
+        encoded = crud.encode_cursor(cursor).encode()
+        return (b"id: " + encoded + b"\nevent: changes\ndata: {\"changes\":[" + b",".join(data)
+                + b"],\"cursor\":\"" + encoded + b"\"}\n\n")
+
+
+def _read_feed(since: str, is_admin: bool):
+    with SessionLocal() as db:
+        return change_feed.get_changes(db, since, _PAGE_SIZE, is_admin)
+
+
+async def _catch_up(sub):
+    """Messages for everything after sub.cursor, read directly like /changes."""
+    while True:
+        feed = await run_in_threadpool(_read_feed, crud.encode_cursor(sub.cursor), sub.is_admin)
+        if feed == "EXPIRED":
+            current = await run_in_threadpool(_read_feed, "", sub.is_admin)
+            sub.cursor = _cursor_of(current)
+            yield b"id: " + current["cursor"].encode() + b"\nevent: reload\ndata: {}\n\n"
+            return
+        yield sub.message(_rendered(feed), _cursor_of(feed))
+        if not feed["has_more"]: return
+
+
+async def _stream(sub):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + EVENTS_MAX_STREAM_SECONDS
+    try:
+        # Reconnect after one second, resuming from here even if no change arrives before that
+        yield b"retry: 1000\nid: " + crud.encode_cursor(sub.cursor).encode() + b"\n\n"
+        async for message in _catch_up(sub):
+            if message: yield message
+        while True:
+            timeout = min(EVENTS_KEEPALIVE_SECONDS, deadline - loop.time())
+            if timeout <= 0: return
+            try:
+                page = await asyncio.wait_for(sub.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if page is _CLOSE: return
+            if page.cursor <= sub.cursor: continue
+            if page.after > sub.cursor or sub.is_admin not in page.changes:
+                # Joined between two polls (or the page was read before this role subscribed): read directly
+                async for message in _catch_up(sub):
+                    if message: yield message
+                continue
+            message = sub.message(page.changes[sub.is_admin], page.cursor)
+            if message: yield message
+    finally:
+        _subscribers.discard(sub)
+
+
+async def subscribe(since: str, types: str, is_admin: bool):
+    """
+    The SSE body for one client: changes after `since` (from now without it) to entities of the
+    comma-separated `types` (all without it). Returns None for a malformed cursor or unknown type.
+    """
+    wanted = {name.strip() for name in types.split(",") if name.strip()} or set(ENTITY_TYPES)
+    if not wanted <= set(ENTITY_TYPES): return None
+    after = change_feed.parse_since(since)
+    if after is False: return None
+    sub = _Subscriber(is_admin, wanted)
+    # Without a cursor, or with the empty one a first page carries, the stream starts from now
+    sub.cursor = after if after is not None else _cursor_of(await run_in_threadpool(_read_feed, "", is_admin))
+    _ensure_poller()
+    _subscribers.add(sub)
+    return _stream(sub)
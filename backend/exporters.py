@@ -0,0 +1,51 @@
+"""
+Streaming writers for GET /patients/export.
+
+Rows from crud.iter_patient_export_rows are rendered into text chunks of
+roughly CHUNK_SIZE characters, so the response is sent piece by piece and
+never held in memory as a whole.
+"""
+import csv
+import io
+import json
+from typing import Iterable, Iterator
+from database import json_default
+
+SUPPORTED_FORMATS = ("csv", "jsonl")
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson"}
+CHUNK_SIZE = 64 * 1024
+
+EXPORT_COLUMNS = [
+    "patient_id", "personal_number", "first_name", "last_name", "birth_date", "nationality", "address",
+    "anex_id", "doctor_id", "doctor_name", "service_id", "service_number", "research_name",
+    "laboratory_name", "deadline", "finance_id", "funder_name", "payable_amount", "paid_amount",
+]
+
+
+def iter_csv(rows: Iterable[dict]) -> Iterator[str]:
+    buffer = io.StringIO()
+    # BOM so spreadsheet tools detect UTF-8 (Georgian names)
+    buffer.write("\ufeff")
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0); buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl(rows: Iterable[dict]) -> Iterator[str]:
+    parts, size = [], 0
+    for row in rows:
+        line = json.dumps(row, default=json_default, ensure_ascii=False) + "\n"
+        parts.append(line); size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(parts)
+            parts, size = [], 0
+    yield "".join(parts)
+
+
+def render(rows: Iterable[dict], fmt: str) -> Iterator[str]:
+    return iter_jsonl(rows) if fmt == "jsonl" else iter_csv(rows)
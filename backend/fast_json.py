@@ -0,0 +1,169 @@
+"""
+Fast JSON rendering for large /patients/ and /history/ pages.
+
+With FAST_JSON_RESPONSES enabled these routes skip the ORM and response_model:
+the page is read as plain Core rows, assembled into dicts with the field names
+and order of schemas.Patient / schemas.HistoryLog, and encoded once with orjson
+(stdlib json when orjson is not installed). Rows are trusted as stored, so
+nothing is validated twice; the output matches the validated path's JSON.
+"""
+import json
+import os
+from collections import defaultdict
+from fastapi import Response
+from sqlalchemy import select, type_coerce, String
+from sqlalchemy.orm import Session, aliased
+import crud, models, schemas, history_store
+from database import json_default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FAST_JSON_RESPONSES = os.getenv("FAST_JSON_RESPONSES", "off").lower() in ("1", "true", "on")
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=json_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+def response(body: bytes) -> Response:
+    return Response(body, media_type="application/json")
+
+
+def _scalar_fields(model, *nested):
+    # Nested fields come last in every schema used here, so scalars + nested keeps the schema's order
+    return [name for name in model.model_fields if name not in nested]
+
+PATIENT_FIELDS = _scalar_fields(schemas.Patient, "staff_assigned", "anex_records")
+ANEX_FIELDS = _scalar_fields(schemas.AnexRecord, "doctor", "service", "finance")
+USER_FIELDS = _scalar_fields(schemas.User)
+SERVICE_FIELDS = _scalar_fields(schemas.Service)
+FINANCE_FIELDS = _scalar_fields(schemas.Finance)
+HISTORY_FIELDS = _scalar_fields(schemas.HistoryLog, "changes", "user", "patient")
+HISTORY_USER_FIELDS = _scalar_fields(schemas.UserForHistory)
+HISTORY_PATIENT_FIELDS = _scalar_fields(schemas.PatientForHistory)
+
+
+def _columns(entity, fields):
+    return [getattr(entity, name) for name in fields]
+
+def _split(row, *widths):
+    start = 0
+    for width in widths:
+        yield row[start:start + width]
+        start += width
+
+def _nested(fields, values):
+    # An outer-joined row that did not match comes back as all NULLs
+    return dict(zip(fields, values)) if values[0] is not None else None
+
+
+# --- Patients ---
+# Each page is built in two stages, loading rows and rendering them, so the two can be timed apart
+def load_patient_rows(db: Session, ids: list):
+    """Staff, anex record and patient rows of the patients in `ids`, each ordered by patient."""
+    if not ids:
+        return [], [], []
+    patient, anex, assoc = models.Patient, models.AnexRecord, models.user_patient_association
+    staff_rows = db.execute(select(assoc.c.patient_id, *_columns(models.User, USER_FIELDS))
+                            .join(models.User, models.User.id == assoc.c.user_id)
+                            .where(assoc.c.patient_id.in_(ids)).order_by(assoc.c.patient_id, models.User.id)).all()
+    doctor = aliased(models.User)
+    record_rows = db.execute(select(anex.patient_id, *_columns(anex, ANEX_FIELDS), *_columns(doctor, USER_FIELDS),
+                                    *_columns(models.Service, SERVICE_FIELDS), *_columns(models.Finance, FINANCE_FIELDS))
+                             .select_from(anex)
+                             .outerjoin(doctor, doctor.id == anex.doctor_id)
+                             .outerjoin(models.Service, models.Service.id == anex.service_id)
+                             .outerjoin(models.Finance, models.Finance.id == anex.finance_id)
+                             .where(anex.patient_id.in_(ids)).order_by(anex.patient_id, anex.id)).all()
+    patient_rows = db.execute(select(*_columns(patient, PATIENT_FIELDS)).where(patient.id.in_(ids)).order_by(patient.id)).all()
+    return staff_rows, record_rows, patient_rows
+
+def render_patients(staff_rows, record_rows, patient_rows) -> list:
+    staff = defaultdict(list)
+    for row in staff_rows:
+        staff[row[0]].append(dict(zip(USER_FIELDS, row[1:])))
+
+    records = defaultdict(list)
+    widths = (len(ANEX_FIELDS), len(USER_FIELDS), len(SERVICE_FIELDS), len(FINANCE_FIELDS))
+    for row in record_rows:
+        values, doctor_values, service_values, finance_values = _split(row[1:], *widths)
+        record = dict(zip(ANEX_FIELDS, values))
+        record["doctor"] = _nested(USER_FIELDS, doctor_values)
+        record["service"] = _nested(SERVICE_FIELDS, service_values)
+        record["finance"] = _nested(FINANCE_FIELDS, finance_values)
+        records[row[0]].append(record)
+
+    items = []
+    for row in patient_rows:
+        item = dict(zip(PATIENT_FIELDS, row))
+        item["staff_assigned"] = staff.get(item["id"], [])
+        item["anex_records"] = records.get(item["id"], [])
+        items.append(item)
+    return items
+
+def _patients(db: Session, ids: list) -> list:
+    return render_patients(*load_patient_rows(db, ids))
+
+def patients_json(db: Session, skip: int, limit: int, filters: dict, cursor: str = None):
+    """JSON body of a /patients/ page (a PatientPage when `cursor` is given), or None for a malformed cursor."""
+    if cursor is None:
+        return dumps(_patients(db, db.scalars(crud.patient_page_ids_query(skip, limit, filters)).all()))
+    after_id = crud.parse_patients_cursor(cursor)
+    if after_id is False: return None
+    ids = db.scalars(crud.patient_page_ids_query(0, limit + 1, filters, after_id)).all()
+    next_cursor = crud.encode_cursor(ids[limit - 1]) if len(ids) > limit else None
+    return dumps({"items": _patients(db, ids[:limit]), "next_cursor": next_cursor})
+
+
+# --- History ---
+def _history_rows(db: Session, skip: int, limit: int, filters: dict, after, log) -> list:
+    author, patient = aliased(models.User), aliased(models.Patient)
+    # `changes` is read as stored text and decoded once here rather than by the column type
+    base = (select(*_columns(log, HISTORY_FIELDS), type_coerce(log.changes, String),
+                   *_columns(author, HISTORY_USER_FIELDS), *_columns(patient, HISTORY_PATIENT_FIELDS))
+            .select_from(log)
+            .outerjoin(author, author.id == log.user_id)
+            .outerjoin(patient, patient.id == log.patient_id))
+    return db.execute(crud.history_logs_query(skip, limit, filters, after, base=base, log=log)).all()
+
+def load_history_rows(db: Session, skip: int, limit: int, filters: dict, after=None) -> list:
+    """The page's history rows, continuing into the archive when it is enabled."""
+    rows = _history_rows(db, skip, limit, filters, after, models.HistoryLog)
+    if history_store.ARCHIVE_ENABLED and len(rows) < limit:
+        archive_skip = 0 if rows or not skip else skip - db.scalar(crud.history_count_query(filters, after))
+        rows += _history_rows(db, archive_skip, limit - len(rows), filters, after, history_store.ArchivedLog)
+    return rows
+
+def render_history(rows) -> list:
+    widths = (len(HISTORY_FIELDS), 1, len(HISTORY_USER_FIELDS), len(HISTORY_PATIENT_FIELDS))
+    items = []
+    for row in rows:
+        values, (changes,), user_values, patient_values = _split(row, *widths)
+        item = dict(zip(HISTORY_FIELDS, values))
+        item["changes"] = models.expand_changes(_loads(changes)) if changes is not None else None
+        item["user"] = _nested(HISTORY_USER_FIELDS, user_values)
+        item["patient"] = _nested(HISTORY_PATIENT_FIELDS, patient_values)
+        items.append(item)
+    return items
+
+def _history(db: Session, skip: int, limit: int, filters: dict, after=None) -> list:
+    return render_history(load_history_rows(db, skip, limit, filters, after))
+
+def history_json(db: Session, skip: int, limit: int, filters: dict, cursor: str = None):
+    """JSON body of a /history/ page (a HistoryLogPage when `cursor` is given), or None for a malformed cursor."""
+    if cursor is None:
+        return dumps(_history(db, skip, limit, filters))
+    after = crud.parse_history_cursor(cursor)
+    if after is False: return None
+    items = _history(db, 0, limit + 1, filters, after)
+    next_cursor = None
+    if len(items) > limit:
+        last = items[limit - 1]
+        next_cursor = crud.encode_cursor(last["timestamp"], last["id"])
+    return dumps({"items": items[:limit], "next_cursor": next_cursor})
@@ -0,0 +1,274 @@
+"""
+Point-in-time state of an entity, rebuilt from the history log.
+
+GET /history/{entity_type}/{entity_id}/as-of?ts= starts from the newest
+snapshot taken at or before `ts` and replays the entity's later entries up to
+`ts`. What each entry carries:
+- CREATE and DELETE: the full state;
+- UPDATE, BLOCK and UNBLOCK: the changed fields;
+- SYNC_ANEX: the anex records a sync created, updated and deleted.
+A patient's state includes its anex records. Staff assignments are not in the
+history.
+
+crud takes a snapshot of an entity's current state once HISTORY_SNAPSHOT_EVERY
+of its entries have accumulated since the last one. Each worker counts the
+entries it writes per entity in memory. Only when that count reaches
+HISTORY_SNAPSHOT_EVERY does it count the entity's entries in the database,
+which include other workers' entries. Most history writes therefore add no
+query. A rebuild replays fewer than HISTORY_SNAPSHOT_EVERY entries for each
+worker that wrote to the entity since its snapshot, however long the entity's
+history grows.
+Migration 6 takes the same snapshots for existing history. Two kinds of
+creation leave no full state in the history, so crud snapshots them as they
+happen: patients from a bulk import, whose single entry lists only personal
+numbers, and users who register themselves, which writes no entry at all.
+
+Entities whose history still starts without a full state have no base to
+replay from, e.g. users who registered before snapshots existed. Their rebuilt
+state holds only the changed fields and is reported as incomplete until their
+first snapshot.
+"""
+import copy
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+from sqlalchemy import select, insert, func, and_, or_, inspect, bindparam
+from sqlalchemy.orm import Session
+import history_store, models
+
+HISTORY_SNAPSHOT_EVERY = int(os.getenv("HISTORY_SNAPSHOT_EVERY", "20"))
+# Entities whose count this worker keeps; forgetting one only delays its next snapshot
+_COUNTED_ENTITIES = 10000
+
+_MODELS = {"Patient": models.Patient, "User": models.User, "Finance": models.Finance, "Service": models.Service}
+ENTITY_TYPES = tuple(_MODELS)
+_HIDDEN_FIELDS = ("hashed_password", "password")
+# Columns a CREATE entry leaves out but crud always sets the same way (an admin-created user is approved)
+_CREATE_DEFAULTS = {"User": {"is_approved": True, "is_blocked": False}}
+# Entries whose own state a snapshot cannot follow: the entity is gone, or the entry is not about it alone
+_NOT_SNAPSHOTTED = ("DELETE", "BULK_CREATE")
+
+
+# --- Current State ---
+def current_state(db: Session, entity_type: str, entity_id: int) -> Optional[dict]:
+    """The entity as stored now (pending changes in `db` included), in the shape replay produces."""
+    entity = db.get(_MODELS[entity_type], entity_id)
+    if entity is None: return None
+    state = {c.key: getattr(entity, c.key) for c in inspect(entity).mapper.column_attrs if c.key not in _HIDDEN_FIELDS}
+    if entity_type == "Patient":
+        anex = models.AnexRecord.__table__
+        state["anex_records"] = [row._asdict() for row in db.execute(select(anex).where(anex.c.patient_id == entity_id).order_by(anex.c.id))]
+    return state
+
+
+def _snapshot_row(entity_type: str, entity_id: int, timestamp: datetime, state: dict) -> dict:
+    return {"entity_type": entity_type, "entity_id": entity_id, "timestamp": timestamp, "state": state}
+
+
+def _entries_since_snapshot():
+    # The entity's entries after its latest snapshot, counted from the index only as far as `limit`
+    snapshot, log = models.HistorySnapshot, models.HistoryLog
+    last = (select(func.max(snapshot.timestamp))
+            .where(snapshot.entity_type == bindparam("entity_type"), snapshot.entity_id == bindparam("entity_id"))
+            .scalar_subquery())
+    since = (select(log.id)
+             .where(log.entity_type == bindparam("entity_type"), log.entity_id == bindparam("entity_id"),
+                    log.timestamp > func.coalesce(last, datetime.min))
+             .limit(bindparam("limit")))
+    return select(func.count()).select_from(since.subquery())
+
+_ENTRIES_SINCE_SNAPSHOT = _entries_since_snapshot()
+
+# Entries this worker wrote per (entity_type, entity_id) since the entity's last snapshot, least recently used first
+_since_snapshot = OrderedDict()
+_since_snapshot_lock = threading.Lock()
+
+
+def _count_entry(key) -> int:
+    with _since_snapshot_lock:
+        count = _since_snapshot.pop(key, 0) + 1
+        _since_snapshot[key] = count
+        if len(_since_snapshot) > _COUNTED_ENTITIES:
+            _since_snapshot.popitem(last=False)
+    return count
+
+
+def record_change(db: Session, entry: dict):
+    """
+    Called by crud for every history entry: snapshots the entity once HISTORY_SNAPSHOT_EVERY
+    of its entries have accumulated since its last snapshot. Only every HISTORY_SNAPSHOT_EVERY-th
+    entry a worker writes for an entity queries the database.
+    """
+    entity_type, entity_id = entry["entity_type"], entry["entity_id"]
+    if HISTORY_SNAPSHOT_EVERY <= 0 or entity_type not in _MODELS or entry["action"] in _NOT_SNAPSHOTTED: return
+    key = (entity_type, entity_id)
+    if _count_entry(key) < HISTORY_SNAPSHOT_EVERY: return
+    # The new entry is not flushed yet (nor, with the batched writer, are earlier ones still queued), so it is counted
+    # here; entries still queued only delay the snapshot
+    earlier = db.scalar(_ENTRIES_SINCE_SNAPSHOT, {"entity_type": entity_type, "entity_id": entity_id, "limit": HISTORY_SNAPSHOT_EVERY - 1})
+    count = earlier + 1
+    if count >= HISTORY_SNAPSHOT_EVERY:
+        snapshot_entity(db, entity_type, entity_id, entry["timestamp"])
+        count = 0
+    with _since_snapshot_lock:
+        _since_snapshot[key] = count
+
+
+def snapshot_entity(db: Session, entity_type: str, entity_id: int, timestamp: Optional[datetime] = None):
+    """Snapshots the entity's current state, e.g. a user registering, which writes no history entry."""
+    state = current_state(db, entity_type, entity_id)
+    if state is not None:
+        db.execute(insert(models.HistorySnapshot),
+                   [_snapshot_row(entity_type, entity_id, timestamp or datetime.now(timezone.utc), state)])
+
+
+def snapshot_bulk_created(db: Session, patients):
+    """Snapshots patients created by a bulk import; `patients` are (id, fields) pairs as inserted."""
+    timestamp = datetime.now(timezone.utc)
+    db.execute(insert(models.HistorySnapshot),
+               [_snapshot_row("Patient", patient_id, timestamp, {"id": patient_id, **fields, "anex_records": []})
+                for patient_id, fields in patients])
+
+
+# --- Replay ---
+def _timeline_queries(entity_type: str, entity_id: int, after: Optional[datetime], until: Optional[datetime]):
+    """One query per history table (the archive too when it is enabled) for the entity's entries in (after, until]."""
+    tables = [models.HistoryLog.__table__]
+    if history_store.ARCHIVE_ENABLED:
+        tables.insert(0, history_store.archive_table)
+    for table in tables:
+        c = table.c
+        owned = and_(c.entity_type == entity_type, c.entity_id == entity_id)
+        if entity_type == "Patient":
+            # Anex records were logged one by one before SYNC_ANEX, found through their patient
+            owned = or_(owned, and_(c.entity_type == "AnexRecord", c.patient_id == entity_id))
+        stmt = select(c.id, c.timestamp, c.action, c.entity_type, c.entity_id, c.patient_id, c.changes).where(owned)
+        if after is not None:
+            stmt = stmt.where(c.timestamp > after)
+        if until is not None:
+            stmt = stmt.where(c.timestamp <= until)
+        yield stmt
+
+
+def _timeline(db: Session, entity_type: str, entity_id: int, after: Optional[datetime], until: Optional[datetime]):
+    """The entity's history entries in (after, until], oldest first."""
+    entries = [entry for stmt in _timeline_queries(entity_type, entity_id, after, until) for entry in db.execute(stmt)]
+    return sorted(entries, key=lambda entry: (entry.timestamp, entry.id))
+
+
+def _visible(fields: dict) -> dict:
+    return {field: value for field, value in fields.items() if field not in _HIDDEN_FIELDS}
+
+
+def _after(diff: dict) -> dict:
+    return {field: values["after"] for field, values in diff.items() if field not in _HIDDEN_FIELDS}
+
+
+def _from_stored(state: dict) -> dict:
+    """A stored state with its anex records keyed by id, as replay keeps them."""
+    state = copy.deepcopy(state)
+    if "anex_records" in state:
+        state["anex_records"] = {record["id"]: record for record in state["anex_records"]}
+    return state
+
+
+def _to_stored(state: Optional[dict]) -> Optional[dict]:
+    if state is None: return None
+    state = copy.deepcopy(state)
+    if "anex_records" in state:
+        state["anex_records"] = [state["anex_records"][record_id] for record_id in sorted(state["anex_records"])]
+    return state
+
+
+def _step(state: Optional[dict], complete: bool, entry, entity_type: str, entity_id: int):
+    """(state, complete) after one history entry; state is None while the entity does not exist."""
+    action, changes = entry.action, entry.changes or {}
+    if action == "BULK_CREATE":
+        return state, complete
+    if action == "CREATE" and entry.entity_type == entity_type:
+        state = {"id": entity_id, **_CREATE_DEFAULTS.get(entity_type, {}), **_visible(changes)}
+        if entity_type == "Patient": state["anex_records"] = {}
+        return state, True
+    if action == "DELETE" and entry.entity_type == entity_type:
+        return None, True
+    if state is None:
+        # A change to something with no known base: keep what the changes tell
+        state, complete = {"id": entity_id}, False
+        if entity_type == "Patient": state["anex_records"] = {}
+    records = state.get("anex_records")
+    if entry.entity_type == "AnexRecord":
+        if action == "CREATE":
+            records[entry.entity_id] = {"id": entry.entity_id, "patient_id": entity_id, **changes}
+        elif action == "DELETE":
+            records.pop(entry.entity_id, None)
+        else:
+            records.setdefault(entry.entity_id, {"id": entry.entity_id}).update(_after(changes))
+    elif action == "SYNC_ANEX":
+        # In the order the sync ran them, since a record it deletes may free the id of one it creates.
+        # JSON turned the record ids into strings
+        for record_id in changes.get("deleted", {}):
+            records.pop(int(record_id), None)
+        for record_id, diff in changes.get("updated", {}).items():
+            records.setdefault(int(record_id), {"id": int(record_id)}).update(_after(diff))
+        for record_id, record in changes.get("created", {}).items():
+            records[int(record_id)] = dict(record)
+    else:
+        state.update(_after(changes))
+    return state, complete
+
+
+def as_of(db: Session, entity_type: str, entity_id: int, ts: datetime):
+    """
+    The entity's state at `ts`, or None when it has no history. "INVALID" for an entity
+    type without point-in-time support.
+    """
+    entity_type = {name.lower(): name for name in ENTITY_TYPES}.get(entity_type.lower())
+    if entity_type is None: return "INVALID"
+    if ts.tzinfo is not None:
+        # Timestamps are stored as naive UTC
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    snapshot = models.HistorySnapshot
+    base = db.execute(select(snapshot.timestamp, snapshot.state)
+                      .where(snapshot.entity_type == entity_type, snapshot.entity_id == entity_id, snapshot.timestamp <= ts)
+                      .order_by(snapshot.timestamp.desc()).limit(1)).first()
+    entries = _timeline(db, entity_type, entity_id, base.timestamp if base else None, ts)
+    if base is None and not entries and not any(db.execute(stmt.limit(1)).first()
+                                                 for stmt in _timeline_queries(entity_type, entity_id, None, None)):
+        return None
+    state, complete = (_from_stored(base.state), True) if base else (None, True)
+    for entry in entries:
+        state, complete = _step(state, complete, entry, entity_type, entity_id)
+    return {"entity_type": entity_type, "entity_id": entity_id, "as_of": ts, "exists": state is not None,
+            "complete": complete, "replayed": len(entries), "state": _to_stored(state)}
+
+
+# --- Backfill ---
+def backfill_snapshots(engine):
+    """
+    Replays existing history and snapshots every entity with HISTORY_SNAPSHOT_EVERY entries or more,
+    the way crud would have (migration 6). Entities that already have a snapshot are skipped.
+    """
+    models.HistorySnapshot.__table__.create(bind=engine, checkfirst=True)
+    # The per-entity reads below need the history index that the refresh steps would otherwise add later
+    for index in models.HistoryLog.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    if HISTORY_SNAPSHOT_EVERY <= 0: return
+    log, snapshot = models.HistoryLog, models.HistorySnapshot
+    with Session(bind=engine) as db:
+        busy = db.execute(select(log.entity_type, log.entity_id).where(log.entity_type.in_(ENTITY_TYPES))
+                          .group_by(log.entity_type, log.entity_id).having(func.count() >= HISTORY_SNAPSHOT_EVERY)).all()
+        for entity_type, entity_id in busy:
+            if db.scalar(select(snapshot.id).where(snapshot.entity_type == entity_type, snapshot.entity_id == entity_id).limit(1)):
+                continue
+            state, complete, since, rows = None, True, 0, []
+            for entry in _timeline(db, entity_type, entity_id, None, None):
+                state, complete = _step(state, complete, entry, entity_type, entity_id)
+                since += 1
+                if since >= HISTORY_SNAPSHOT_EVERY and state is not None and complete and entry.action not in _NOT_SNAPSHOTTED:
+                    rows.append(_snapshot_row(entity_type, entity_id, entry.timestamp, _to_stored(state)))
+                    since = 0
+            if rows:
+                db.execute(insert(snapshot), rows)
+        db.commit()
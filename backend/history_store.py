@@ -0,0 +1,204 @@
+"""
+Storage upkeep for history logs.
+
+history_logs stores action and entity_type as small integer codes and
+`changes` in a compact encoding (see "History Encoding" in models.py), so the
+API sees the same values as before. convert_legacy_history converts a table
+written by earlier versions in place and ensure_history_schema keeps the
+history_logs_readable view, which shows the names, for ad-hoc SQL. Both run
+from `python migrations.py upgrade`.
+
+With HISTORY_ARCHIVE_PATH set, every app connection attaches that SQLite file
+as `archive` and archive_history() moves entries older than a cutoff into
+archive.history_logs. Archived entries are always older than everything left
+in the main table, so a /history/ page that runs past the main table continues
+in the archive (see crud.get_history_logs). Run the job from the backend
+directory, e.g. monthly:
+    HISTORY_ARCHIVE_PATH=history_archive.db python history_store.py archive --months 12
+"""
+import argparse
+import json
+import logging
+from datetime import datetime, timezone
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import Column, Index, MetaData, Table, select, insert, delete, update
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.orm import Session, declarative_base, foreign, relationship
+import models
+import database
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_ENABLED = bool(database.HISTORY_ARCHIVE_PATH)
+HISTORY_ARCHIVE_BATCH_SIZE = 2000
+
+_log_table = models.HistoryLog.__table__
+# Same columns as history_logs without the foreign keys, which cannot point across databases
+archive_table = Table("history_logs", MetaData(), *(Column(c.name, c.type, primary_key=c.primary_key) for c in _log_table.columns),
+                      schema="archive")
+Index("ix_history_logs_timestamp_id", archive_table.c.timestamp, archive_table.c.id)
+Index("ix_history_logs_patient_id_timestamp", archive_table.c.patient_id, archive_table.c.timestamp)
+Index("ix_history_logs_user_id_timestamp", archive_table.c.user_id, archive_table.c.timestamp)
+Index("ix_history_logs_entity_type_entity_id_timestamp", archive_table.c.entity_type, archive_table.c.entity_id, archive_table.c.timestamp)
+
+
+class ArchivedLog(declarative_base(metadata=archive_table.metadata)):
+    """A history log in the archive, loaded like models.HistoryLog by queries that continue past the main table."""
+    __table__ = archive_table
+    user = relationship(models.User, primaryjoin=lambda: foreign(archive_table.c.user_id) == models.User.id, viewonly=True)
+    patient = relationship(models.Patient, primaryjoin=lambda: foreign(archive_table.c.patient_id) == models.Patient.id, viewonly=True)
+
+
+# --- Schema ---
+def _code_case(column: str, names: tuple, to_code: bool) -> str:
+    # The names are fixed identifiers from models.py, so they are inlined rather than bound
+    pairs = " ".join(f"WHEN '{name}' THEN {code}" if to_code else f"WHEN {code} THEN '{name}'"
+                     for code, name in enumerate(names, 1))
+    return f"CASE {column} {pairs} END"
+
+def _readable_view_sql() -> str:
+    return ("CREATE VIEW history_logs_readable AS SELECT id, timestamp, user_id, "
+            f"{_code_case('action', models.HISTORY_ACTIONS, False)} AS action, "
+            f"{_code_case('entity_type', models.HISTORY_ENTITY_TYPES, False)} AS entity_type, "
+            "entity_id, patient_id, changes FROM history_logs")
+
+def _compact_changes(value):
+    return models.encode_changes(json.loads(value)) if value is not None else None
+
+def _create_statements(dialect):
+    yield str(CreateTable(_log_table).compile(dialect=dialect))
+    for index in _log_table.indexes:
+        yield str(CreateIndex(index).compile(dialect=dialect))
+
+def _convert_legacy_table(engine):
+    """Rewrites a history_logs table with text action/entity_type columns and JSON changes, in one transaction."""
+    raw = engine.raw_connection()
+    sqlite_conn = raw.driver_connection
+    isolation_level = sqlite_conn.isolation_level
+    sqlite_conn.isolation_level = None  # manage the transaction explicitly, DDL included
+    try:
+        cursor = sqlite_conn.cursor()
+        for column, names in (("action", models.HISTORY_ACTIONS), ("entity_type", models.HISTORY_ENTITY_TYPES)):
+            unknown = [row[0] for row in cursor.execute(f"SELECT DISTINCT {column} FROM history_logs")
+                       if row[0] is not None and row[0] not in names]
+            if unknown:
+                raise RuntimeError(f"history_logs.{column} holds values without a code: {unknown}; add them to models.py")
+        sqlite_conn.create_function("compact_changes", 1, _compact_changes, deterministic=True)
+        legacy_indexes = [row[1] for row in cursor.execute("PRAGMA index_list(history_logs)") if row[3] == "c"]
+
+        # Rows may reference users or patients deleted before foreign keys were enforced; copy them as they are.
+        # The pragma is a no-op inside a transaction, so it is switched before BEGIN (SQLite's table-rebuild procedure)
+        foreign_keys = cursor.execute("PRAGMA foreign_keys").fetchone()[0]
+        cursor.execute("PRAGMA foreign_keys = OFF")
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("DROP VIEW IF EXISTS history_logs_readable")
+            for name in legacy_indexes:
+                cursor.execute(f'DROP INDEX "{name}"')
+            cursor.execute("ALTER TABLE history_logs RENAME TO history_logs_legacy")
+            for ddl in _create_statements(engine.dialect):
+                cursor.execute(ddl)
+            cursor.execute(
+                "INSERT INTO history_logs (id, timestamp, user_id, action, entity_type, entity_id, patient_id, changes) "
+                f"SELECT id, timestamp, user_id, {_code_case('action', models.HISTORY_ACTIONS, True)}, "
+                f"{_code_case('entity_type', models.HISTORY_ENTITY_TYPES, True)}, entity_id, patient_id, "
+                "compact_changes(changes) FROM history_logs_legacy")
+            cursor.execute("DROP TABLE history_logs_legacy")
+            cursor.execute("COMMIT")
+        except BaseException:
+            if sqlite_conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.execute(f"PRAGMA foreign_keys = {foreign_keys}")
+        cursor.close()
+    finally:
+        sqlite_conn.isolation_level = isolation_level
+        raw.close()
+
+
+def convert_legacy_history(engine):
+    """Converts a history_logs table with text action/entity_type columns; a no-op once converted (migration 3)."""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.connect() as conn:
+        columns = {row[1]: row[2] for row in conn.exec_driver_sql("PRAGMA table_info(history_logs)")}
+    if columns.get("action", "").upper() in ("", "SMALLINT"):
+        return
+    logger.warning("Converting history_logs to coded actions and compact changes, this may take a while")
+    _convert_legacy_table(engine)
+    # The rewrite leaves the old table's pages free; hand them back once instead of keeping a file twice the size
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("VACUUM main")
+
+
+def ensure_history_schema(engine):
+    """Refreshes the readable view and creates the archive table if enabled (run by every migrations upgrade)."""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        # Recreated on every upgrade so names appended in models.py show up
+        conn.exec_driver_sql("DROP VIEW IF EXISTS history_logs_readable")
+        conn.exec_driver_sql(_readable_view_sql())
+        if ARCHIVE_ENABLED:
+            archive_table.create(conn, checkfirst=True)
+            # Archives created before an index was declared get it here
+            for index in archive_table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+# --- Archive ---
+def detach_archived(db: Session, **references):
+    """Clears user_id / patient_id in archived entries, as the main table does when a user or patient is deleted."""
+    if not ARCHIVE_ENABLED: return
+    for column, value in references.items():
+        db.execute(update(archive_table).where(archive_table.c[column] == value).values({column: None}))
+
+def archive_history(engine, before: datetime, batch_size: int = HISTORY_ARCHIVE_BATCH_SIZE, log=print) -> int:
+    """
+    Moves history entries older than `before` into the archive, one batch per
+    transaction. Copies are idempotent, so an interrupted run can simply be repeated.
+    """
+    if not ARCHIVE_ENABLED:
+        raise RuntimeError("HISTORY_ARCHIVE_PATH is not set")
+    columns = [c.name for c in _log_table.columns]
+    moved = 0
+    while True:
+        with engine.begin() as conn:
+            ids = conn.scalars(select(_log_table.c.id).where(_log_table.c.timestamp < before)
+                               .order_by(_log_table.c.id).limit(batch_size)).all()
+            if not ids:
+                break
+            batch = select(*_log_table.columns).where(_log_table.c.id.in_(ids))
+            conn.execute(insert(archive_table).prefix_with("OR IGNORE").from_select(columns, batch))
+            conn.execute(delete(_log_table).where(_log_table.c.id.in_(ids)))
+        moved += len(ids)
+        log(f"  archived {moved} entries")
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    archive = commands.add_parser("archive", help="Move entries older than --months into the archive database.")
+    archive.add_argument("--months", type=int, required=True)
+    archive.add_argument("--batch-size", type=int, default=HISTORY_ARCHIVE_BATCH_SIZE)
+    archive.add_argument("--vacuum", action="store_true", help="Rebuild the main database afterwards to return the freed pages.")
+    args = parser.parse_args()
+
+    if not ARCHIVE_ENABLED:
+        parser.error("set HISTORY_ARCHIVE_PATH to the archive database file")
+    import migrations
+    migrations.check_schema(database.engine)
+    ensure_history_schema(database.engine)
+    before = datetime.now(timezone.utc) - relativedelta(months=args.months)
+    print(f"Archiving history entries older than {before:%Y-%m-%d %H:%M} into {database.HISTORY_ARCHIVE_PATH}")
+    moved = archive_history(database.engine, before, args.batch_size)
+    print(f"Moved {moved} entries")
+    if args.vacuum and moved:
+        with database.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM main")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Streaming readers for bulk patient uploads.
+
+Each reader yields (row_number, record) pairs one line at a time, so an upload
+is never loaded into memory whole. `record` is a dict of raw field values, or
+an error message string when the line itself could not be parsed.
+"""
+import csv
+import json
+from typing import BinaryIO, Iterator, Tuple, Union
+
+SUPPORTED_FORMATS = ("csv", "jsonl")
+
+
+def detect_format(filename: str = None, content_type: str = None) -> str:
+    name = (filename or "").lower()
+    if name.endswith((".jsonl", ".ndjson")) or (content_type or "").endswith(("jsonl", "ndjson")):
+        return "jsonl"
+    return "csv"
+
+
+def _blank_to_none(record: dict) -> dict:
+    # Empty CSV cells mean "not provided", e.g. an optional address
+    return {key: (None if value == "" else value) for key, value in record.items() if key}
+
+
+def _decoded_lines(stream: BinaryIO, bad_lines: list) -> Iterator[str]:
+    """
+    Decodes the upload one line at a time, so a stray non-UTF-8 byte costs only its own row
+    instead of aborting the stream. Undecodable lines are passed on with replacement characters
+    and their line numbers appended to `bad_lines` for the caller to report.
+    """
+    for line_number, raw in enumerate(stream, start=1):
+        try:
+            yield raw.decode("utf-8-sig" if line_number == 1 else "utf-8")
+        except UnicodeDecodeError:
+            bad_lines.append(line_number)
+            yield raw.decode("utf-8", errors="replace")
+
+
+def iter_csv(stream: BinaryIO) -> Iterator[Tuple[int, Union[dict, str]]]:
+    bad_lines = []
+    reader = csv.DictReader(_decoded_lines(stream, bad_lines))
+    row_number = 0
+    while True:
+        try:
+            record = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as exc:
+            # The reader resets after an error and carries on with the next line
+            row_number += 1
+            yield row_number, f"Invalid CSV: {exc}"
+            continue
+        row_number += 1
+        if bad_lines:
+            # A quoted field can span lines, so any bad line read since the last row belongs to this one
+            bad_lines.clear()
+            yield row_number, "Row is not valid UTF-8."
+            continue
+        if None in record:
+            yield row_number, "Row has more fields than the header."
+            continue
+        yield row_number, _blank_to_none(record)
+
+
+def iter_jsonl(stream: BinaryIO) -> Iterator[Tuple[int, Union[dict, str]]]:
+    bad_lines = []
+    for row_number, line in enumerate(_decoded_lines(stream, bad_lines), start=1):
+        if bad_lines:
+            bad_lines.clear()
+            yield row_number, "Row is not valid UTF-8."
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield row_number, f"Invalid JSON: {exc}"
+            continue
+        if not isinstance(record, dict):
+            yield row_number, "Each line must be a JSON object."
+            continue
+        yield row_number, record
+
+
+def iter_records(stream: BinaryIO, fmt: str) -> Iterator[Tuple[int, Union[dict, str]]]:
+    return iter_jsonl(stream) if fmt == "jsonl" else iter_csv(stream)
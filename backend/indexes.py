@@ -0,0 +1,199 @@
+"""
+Index upkeep and the index advisor.
+
+The index set is declared in models.py: composite indexes shaped after the
+statements crud runs, and no single-column indexes on primary keys (SQLite's
+rowid already is one) or on columns that are only ever searched with
+'%term%' patterns, which cannot use them. sync_indexes() brings an existing
+database in line on every `python migrations.py upgrade`: `ix_` indexes the
+models no longer declare are dropped, missing ones are created, and ANALYZE
+refreshes the planner's statistics when anything changed.
+
+The advisor replays crud.get_patients / get_history_logs for every
+combination of their filters, runs EXPLAIN QUERY PLAN over each distinct
+statement they issued (loader queries included) and lists full scans of
+tables larger than --min-rows. Scans that stop at a LIMIT, scans of small
+reference tables and temporary sorts are only listed with --verbose. The exit
+status is 1 when anything was flagged. Run it from the backend directory
+against a populated database, e.g. one made by benchmarks/datagen.py:
+    python indexes.py report [--db /tmp/bench.db] [--all] [--min-rows 1000] [--verbose]
+"""
+import argparse
+import itertools
+import re
+import sys
+from datetime import date
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+import crud, fast_json, models, search
+
+_PREFIX = "ix_"
+
+
+# --- Upkeep ---
+def sync_indexes(engine) -> dict:
+    """Drops undeclared `ix_` indexes on model tables and creates missing declared ones."""
+    if engine.dialect.name != "sqlite":
+        return {"dropped": [], "created": []}
+    tables = models.Base.metadata.tables
+    declared = {index.name: index for table in tables.values() for index in table.indexes}
+    with engine.begin() as conn:
+        existing = dict(conn.exec_driver_sql("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'").all())
+        dropped = [name for name, table in existing.items()
+                   if name.startswith(_PREFIX) and table in tables and name not in declared]
+        for name in dropped:
+            conn.exec_driver_sql(f'DROP INDEX "{name}"')
+        created = [name for name in declared if name not in existing]
+        for name in created:
+            declared[name].create(conn)
+        if dropped or created:
+            conn.exec_driver_sql("ANALYZE")
+    return {"dropped": dropped, "created": created}
+
+
+# --- Advisor ---
+PATIENT_FILTERS = ("personal_number", "lastname", "firstname", "doctor", "funder", "research", "staff")
+HISTORY_FILTERS = ("author", "date", "patient")
+
+
+def _terms(db: Session) -> dict:
+    """A filter value per filter that matches something in the database, taken from the middle of each table."""
+    one = lambda sql: db.execute(text(sql)).first()
+    patient = one("SELECT personal_number, first_name, last_name FROM patients ORDER BY id "
+                  "LIMIT 1 OFFSET (SELECT count(*) / 2 FROM patients)") or ("000", "nobody", "nobody")
+    doctor = one("SELECT u.first_name || ' ' || u.last_name FROM anex_records a JOIN users u ON u.id = a.doctor_id LIMIT 1")
+    funder = one("SELECT funder_name FROM finances LIMIT 1")
+    research = one("SELECT research_name FROM services LIMIT 1")
+    user = one("SELECT user_name FROM users ORDER BY id DESC LIMIT 1")
+    day = one("SELECT date(max(timestamp)) FROM history_logs")
+    return {
+        "personal_number": patient[0], "firstname": patient[1], "lastname": patient[2],
+        "doctor": doctor[0] if doctor else "nobody", "funder": funder[0] if funder else "nobody",
+        "research": research[0] if research else "nothing", "staff": user[0] if user else "nobody",
+        "author": user[0] if user else "nobody", "patient": patient[0],
+        "date": date.fromisoformat(day[0]) if day and day[0] else date.today(),
+    }
+
+
+def _value(terms: dict, name: str, kind: str):
+    # Short terms fall below search.MIN_TERM_LENGTH and take the LIKE path
+    value = terms[name]
+    return value if kind == "long" or not isinstance(value, str) else value[:2]
+
+
+def _cases(terms: dict, everything: bool):
+    """(label, callable(db)) for each request shape to replay."""
+    sizes = range(len(PATIENT_FILTERS) + 1) if everything else range(3)
+    for size in sizes:
+        for names in itertools.combinations(PATIENT_FILTERS, size):
+            for kind in (("long", "short") if names else ("-",)):
+                filters = {name: _value(terms, name, kind) for name in names}
+                label = f"patients {kind} " + "+".join(names) if names else "patients unfiltered"
+                yield label, lambda db, f=filters: crud.get_patients(db, filters=f)
+                yield label + " (cursor)", lambda db, f=filters: crud.get_patients_page(db, filters=f, cursor="")
+    yield "patients funder=self", lambda db: crud.get_patients(db, filters={"funder": "self"})
+    yield "patients deep offset", lambda db: crud.get_patients(db, skip=5000)
+    yield "patients fast_json", lambda db: fast_json.patients_json(db, 0, 100, {})
+
+    for size in range(len(HISTORY_FILTERS) + 1):
+        for names in itertools.combinations(HISTORY_FILTERS, size):
+            for kind in (("long", "short") if names else ("-",)):
+                filters = {name: _value(terms, name, kind) for name in names}
+                label = f"history {kind} " + "+".join(names) if names else "history unfiltered"
+                yield label, lambda db, f=filters: crud.get_history_logs(db, skip=0, limit=100, filters=f)
+                yield label + " (cursor)", lambda db, f=filters: crud.get_history_logs_page(db, limit=100, filters=f, cursor="")
+    yield "history fast_json", lambda db: fast_json.history_json(db, 0, 100, {})
+
+
+def _classify(plan: list, statement: str, sizes: dict, min_rows: int):
+    """Splits the plan's scans and sorts into (problems, notes)."""
+    aliases = dict((alias, table) for table, alias in re.findall(r"\b(\w+) AS (\w+)\b", statement))
+    # An outer scan in ORDER BY order under a LIMIT reads only as many rows as the page needs
+    limited = " LIMIT " in statement and not any("FOR ORDER BY" in row[3] for row in plan if row[1] == 0)
+    problems, notes = [], []
+    for _, parent, _, detail in plan:
+        if "USE TEMP B-TREE" in detail:
+            notes.append(detail)
+        if not detail.startswith("SCAN ") or "VIRTUAL TABLE" in detail or detail.startswith(("SCAN (", "SCAN CONSTANT")):
+            continue
+        name = detail.split()[1]
+        table = aliases.get(name, name)
+        if limited and parent == 0:
+            notes.append(detail + "  (ordered, stops at LIMIT)")
+        elif sizes.get(table, 0) < min_rows:
+            notes.append(detail + f"  ({sizes.get(table, 0)} rows)")
+        else:
+            problems.append(detail + ("  ('%term%' filter)" if " LIKE " in statement else ""))
+    return problems, notes
+
+
+def report(engine, everything: bool = False, min_rows: int = 1000, verbose: bool = False, out=sys.stdout) -> int:
+    """Prints the statements whose plans fully scan a large table; returns how many there were."""
+    search.ensure_search_index(engine)
+    statements, current = {}, [None]
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.setdefault(statement, (parameters, []))[1].append(current[0])
+
+    with Session(bind=engine) as db:
+        cases = list(_cases(_terms(db), everything))
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            for current[0], call in cases:
+                call(db)
+                db.rollback()
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+
+    sizes = _table_sizes(engine)
+    flagged, noted = 0, 0
+    with engine.connect() as conn:
+        for statement, (parameters, labels) in statements.items():
+            plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+            problems, notes = _classify(plan, statement, sizes, min_rows)
+            noted += bool(notes)
+            if not problems and not (verbose and notes):
+                continue
+            flagged += bool(problems)
+            shown = ", ".join(dict.fromkeys(labels[:3])) + (f" and {len(labels) - 3} more" if len(labels) > 3 else "")
+            print(f"\n{'SCAN' if problems else 'note'}: {shown}", file=out)
+            print("    " + " ".join(statement.split())[:400], file=out)
+            for problem in problems:
+                print(f"    !! {problem}", file=out)
+            for note in notes if verbose else ():
+                print(f"    -- {note}", file=out)
+    print(f"\n{len(cases)} request shapes, {len(statements)} distinct statements: {flagged} with full scans of "
+          f"tables over {min_rows} rows, {noted} with bounded scans, small-table scans or sorts"
+          f"{'' if verbose else ' (--verbose lists them)'}", file=out)
+    return flagged
+
+
+def _table_sizes(engine) -> dict:
+    with engine.connect() as conn:
+        return {name: conn.exec_driver_sql(f'SELECT count(*) FROM "{name}"').scalar()
+                for name in models.Base.metadata.tables}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    report_parser = commands.add_parser("report", help="EXPLAIN every statement the list endpoints issue and flag scans.")
+    report_parser.add_argument("--db", help="SQLite file to analyse (default: the app's DATABASE_URL).")
+    report_parser.add_argument("--all", action="store_true", help="Every combination of patient filters, not just up to two at a time.")
+    report_parser.add_argument("--min-rows", type=int, default=1000, help="Scans of smaller tables are only noted.")
+    report_parser.add_argument("--verbose", action="store_true", help="Also list bounded scans, small-table scans and sorts.")
+    sync_parser = commands.add_parser("sync", help="Apply the index set declared in models.py.")
+    sync_parser.add_argument("--db")
+    args = parser.parse_args()
+
+    import database
+    engine = database.make_engine(f"sqlite:///{args.db}") if args.db else database.engine
+    if args.command == "sync":
+        print(sync_indexes(engine))
+    else:
+        sys.exit(1 if report(engine, args.all, args.min_rows, args.verbose) else 0)
+
+
+if __name__ == "__main__":
+    main()
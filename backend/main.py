@@ -1,49 +1,84 @@
-import os
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Depends, HTTPException, status, Query, Request
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request, UploadFile, File, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import List, Optional, Union
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from dotenv import load_dotenv
 from datetime import datetime, timezone, date
 
-import crud, models, schemas, auth
-from database import SessionLocal, engine, get_db
+import crud, crud_async, schemas, auth, search, audit, importers, exporters, reports, metrics, caching, fast_json, migrations, rate_limits, change_feed, events, history_snapshots
+from database import SessionLocal, engine, get_db, get_async_db, uses_async
 
 load_dotenv()
-models.Base.metadata.create_all(bind=engine)
-limiter = Limiter(key_func=get_remote_address)
+# Schema changes are applied by `python migrations.py upgrade` before the workers start; a worker only checks the version
+if migrations.AUTO_MIGRATE:
+    migrations.upgrade(engine)
+migrations.check_schema(engine)
+search.detect_search_index(engine)
+# Counters live in RATE_LIMIT_STORAGE_URI, shared by all workers when there are several (see rate_limits.py)
+limiter = Limiter(key_func=get_remote_address, storage_uri=rate_limits.RATE_LIMIT_STORAGE_URI)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    db = SessionLocal()
-    if not crud.get_user_by_username(db, username="admin"):
-        ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
-        if ADMIN_PASSWORD:
-            admin_schema = schemas.UserCreate(first_name="Admin", last_name="User", email="admin@example.com", user_name="admin", password=ADMIN_PASSWORD, role="admin")
-            crud.create_user(db=db, user=admin_schema)
-    db.close()
+    if audit.HISTORY_LOG_MODE == "batched":
+        audit.start()
     yield
+    # Flush queued history entries before the worker exits
+    audit.stop()
+    await events.stop()
 
 app = FastAPI(lifespan=lifespan)
+# Routes declared below record when their endpoint returns (see metrics.TimedRoute)
+app.router.route_class = metrics.TimedRoute
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, lambda req, exc: HTTPException(429, "Too Many Requests"))
+app.add_exception_handler(RateLimitExceeded, lambda req, exc: JSONResponse({"detail": "Too Many Requests"}, status_code=status.HTTP_429_TOO_MANY_REQUESTS))
+app.add_exception_handler(auth.PasswordHasherBusy, lambda req, exc: JSONResponse({"detail": "Server is busy, please retry."}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "1"}))
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(metrics.RequestMetricsMiddleware)
+
+# --- Metrics ---
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(): return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# --- Sync/Async Route Selection ---
+def async_variant(async_endpoint):
+    """Serves a route with `async_endpoint` instead when the sync endpoint's name is listed in ASYNC_ROUTES."""
+    def choose(endpoint):
+        return async_endpoint if uses_async(endpoint.__name__) else endpoint
+    return choose
 
 # --- Auth & Registration ---
 @app.post("/token", response_model=schemas.Token)
 @limiter.limit("5/minute")
-def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = auth.authenticate_user(db, form_data.username, form_data.password)
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    user = await auth.authenticate_user(db, form_data.username, form_data.password)
     # --- MODIFIED: Handle new authentication statuses ---
     if user == "BLOCKED": raise HTTPException(status.HTTP_403_FORBIDDEN, "This account has been blocked.")
     if user == "NOT_APPROVED": raise HTTPException(status.HTTP_403_FORBIDDEN, "Account not approved by admin.")
     if not user: raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Incorrect username or password")
-    return {"access_token": auth.create_access_token({"sub": user.user_name, "role": user.role}), "token_type": "bearer"}
+    refresh_token = await run_in_threadpool(crud.create_refresh_token, db, user.id)
+    return {"access_token": auth.create_access_token({"sub": user.user_name, "role": user.role}), "token_type": "bearer", "refresh_token": refresh_token}
+
+# Not rate limited like /token: nothing is hashed, and a refresh token cannot be guessed
+@app.post("/token/refresh", response_model=schemas.Token)
+def refresh_access_token(payload: schemas.RefreshTokenRequest, db: Session = Depends(get_db)):
+    result = crud.rotate_refresh_token(db, payload.refresh_token)
+    if result == "BLOCKED": raise HTTPException(status.HTTP_403_FORBIDDEN, "This account has been blocked.")
+    if result == "NOT_APPROVED": raise HTTPException(status.HTTP_403_FORBIDDEN, "Account not approved by admin.")
+    if result == "INVALID": raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Invalid or expired refresh token.", headers={"WWW-Authenticate": "Bearer"})
+    user, refresh_token = result
+    return {"access_token": auth.create_access_token({"sub": user.user_name, "role": user.role}), "token_type": "bearer", "refresh_token": refresh_token}
+
+@app.post("/token/revoke", status_code=status.HTTP_204_NO_CONTENT)
+def revoke_refresh_token(payload: schemas.RefreshTokenRequest, db: Session = Depends(get_db)):
+    crud.revoke_refresh_token(db, payload.refresh_token)
 
 @app.post("/users/", response_model=schemas.UserInDB)
 def register(user: schemas.UserCreate, token: str = Query(...), db: Session = Depends(get_db)):
@@ -53,38 +88,38 @@ def register(user: schemas.UserCreate, token: str = Query(...), db: Session = De
 
 # --- User Management (Admin Only) ---
 @app.post("/admin/verify-password", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(auth.require_admin)])
-def verify_admin_password(payload: schemas.PasswordVerify, current_user: models.User = Depends(auth.require_admin)):
-    if not auth.verify_password(payload.password, current_user.hashed_password): raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Incorrect password.")
+async def verify_admin_password(payload: schemas.PasswordVerify, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
+    if not await auth.verify_current_user_password(db, current_user, payload.password): raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Incorrect password.")
 
 @app.get("/admin/users/", response_model=List[schemas.UserInDB], dependencies=[Depends(auth.require_admin)])
 def get_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)): return crud.get_users(db, skip, limit)
 
 @app.post("/admin/users/", response_model=schemas.UserInDB)
-def create_user_manual(user: schemas.UserCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.require_admin)):
+def create_user_manual(user: schemas.UserCreate, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
     if crud.get_user_by_email(db, user.email) or crud.get_user_by_username(db, user.user_name): raise HTTPException(status.HTTP_400_BAD_REQUEST, "Email or username already registered.")
     return crud.create_user(db=db, user=user, current_user=current_user)
 
 @app.put("/admin/users/{user_id}", response_model=schemas.UserInDB)
-def update_user(user_id: int, user_update: schemas.UserUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.require_admin)):
+def update_user(user_id: int, user_update: schemas.UserUpdate, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
     db_user = crud.update_user(db, user_id, user_update, current_user)
     if not db_user: raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
     return db_user
 
 @app.delete("/admin/users/{user_id}", response_model=schemas.UserInDB)
-def delete_user(user_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.require_admin)):
+def delete_user(user_id: int, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
     db_user = crud.delete_user(db, user_id, current_user)
     if not db_user: raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
     return db_user
 
 @app.post("/admin/users/{user_id}/approve", response_model=schemas.UserInDB)
-def approve_user(user_id: int, approval_data: schemas.UserApprove, db: Session = Depends(get_db), current_user: models.User = Depends(auth.require_admin)):
+def approve_user(user_id: int, approval_data: schemas.UserApprove, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
     db_user = crud.approve_user(db, user_id, role=approval_data.role, current_user=current_user)
     if not db_user: raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
     return db_user
 
 # --- MODIFIED: Added block/unblock endpoint ---
 @app.post("/admin/users/{user_id}/block", response_model=schemas.UserInDB)
-def block_user_endpoint(user_id: int, block_data: schemas.UserBlock, db: Session = Depends(get_db), current_user: models.User = Depends(auth.require_admin)):
+def block_user_endpoint(user_id: int, block_data: schemas.UserBlock, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
     db_user = crud.block_user(db, user_id, is_blocked=block_data.is_blocked, current_user=current_user)
     if not db_user:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
@@ -103,27 +138,28 @@ def find_patient_for_deletion(personal_number: str, db: Session = Depends(get_db
     return db_patient
 
 @app.post("/admin/delete-patient", status_code=status.HTTP_204_NO_CONTENT)
-def centralized_patient_delete(payload: schemas.AdminPatientDelete, db: Session = Depends(get_db), current_user: models.User = Depends(auth.require_admin)):
-    if not auth.verify_password(payload.password, current_user.hashed_password):
+async def centralized_patient_delete(payload: schemas.AdminPatientDelete, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
+    if not await auth.verify_current_user_password(db, current_user, payload.password):
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Incorrect admin password.")
     
-    deleted_patient = crud.delete_patient_by_personal_number(db, payload.personal_number, current_user)
+    deleted_patient = await run_in_threadpool(crud.delete_patient_by_personal_number, db, payload.personal_number, current_user)
     if not deleted_patient:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "Patient with this personal number not found.")
     
     return None
 
 # --- General User List (for selection) ---
-@app.get("/users/list", response_model=List[schemas.User], dependencies=[Depends(auth.get_current_active_user)])
-def get_users_for_selection(db: Session = Depends(get_db)):
-    return crud.get_all_users_basic(db)
+# Reference-data listings answer with an ETag and serve rendered bodies from caching.py
+async def get_users_for_selection_async(request: Request, db: AsyncSession = Depends(get_async_db)):
+    return await caching.listing_response_async(request, db, "users", (), lambda: crud_async.get_all_users_basic(db))
+
+@app.get("/users/list", response_model=List[schemas.User], dependencies=[Depends(auth.active_user_dependency("get_users_for_selection"))])
+@async_variant(get_users_for_selection_async)
+def get_users_for_selection(request: Request, db: Session = Depends(get_db)):
+    return caching.listing_response(request, db, "users", (), lambda: crud.get_all_users_basic(db))
 
 # --- Patient Routes ---
-@app.get("/patients/", response_model=List[schemas.Patient], dependencies=[Depends(auth.get_current_active_user)])
-def get_patients(
-    db: Session = Depends(get_db),
-    skip: int = 0, 
-    limit: int = 100, 
+def patient_filters(
     personal_number: Optional[str] = None,
     lastname: Optional[str] = None,
     firstname: Optional[str] = None,
@@ -132,25 +168,75 @@ def get_patients(
     research: Optional[str] = None,
     staff: Optional[str] = None
 ):
-    filters = {
+    return {
         "personal_number": personal_number, "lastname": lastname, "firstname": firstname,
         "doctor": doctor, "funder": funder, "research": research, "staff": staff
     }
+
+async def get_patients_async(db: AsyncSession = Depends(get_async_db), skip: int = 0, limit: int = 100, cursor: Optional[str] = None, filters: dict = Depends(patient_filters)):
+    if fast_json.FAST_JSON_RESPONSES:
+        body = await db.run_sync(fast_json.patients_json, skip, limit, filters, cursor)
+        if body is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        return fast_json.response(body)
+    if cursor is not None:
+        page = await crud_async.get_patients_page(db, limit=limit, filters=filters, cursor=cursor)
+        if page is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        return page
+    return await crud_async.get_patients(db, skip=skip, limit=limit, filters=filters)
+
+@app.get("/patients/", response_model=Union[List[schemas.Patient], schemas.PatientPage], dependencies=[Depends(auth.active_user_dependency("get_patients"))])
+@async_variant(get_patients_async)
+def get_patients(db: Session = Depends(get_db), skip: int = 0, limit: int = 100, cursor: Optional[str] = None, filters: dict = Depends(patient_filters)):
+    # Fast mode renders straight from rows, bypassing the ORM and response_model validation
+    if fast_json.FAST_JSON_RESPONSES:
+        body = fast_json.patients_json(db, skip, limit, filters, cursor)
+        if body is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        return fast_json.response(body)
+    # Passing `cursor` (empty for the first page) switches to keyset pagination and a paged response
+    if cursor is not None:
+        page = crud.get_patients_page(db, limit=limit, filters=filters, cursor=cursor)
+        if page is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        return page
     return crud.get_patients(db, skip=skip, limit=limit, filters=filters)
 
+@app.get("/patients/export", dependencies=[Depends(auth.get_current_active_user)])
+def export_patients(format: str = Query("csv", pattern="^(csv|jsonl)$"), filters: dict = Depends(patient_filters)):
+    def stream():
+        # The session must outlive the handler (get_db closes before streaming), so it is owned here
+        db = SessionLocal()
+        try:
+            yield from exporters.render(crud.iter_patient_export_rows(db, filters), format)
+        finally:
+            db.close()
+
+    return StreamingResponse(stream(), media_type=exporters.MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="patients.{format}"'})
+
 @app.post("/patients/", response_model=schemas.Patient, dependencies=[Depends(auth.require_modify_access)])
-def create_patient(patient: schemas.PatientCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
+def create_patient(patient: schemas.PatientCreate, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.get_current_active_user)):
     if crud.get_patient_by_personal_number(db, patient.personal_number): raise HTTPException(status.HTTP_400_BAD_REQUEST, "Patient with this personal number already exists.")
     return crud.create_patient(db, patient, user_id=current_user.id)
 
+@app.post("/patients/bulk", response_model=schemas.BulkImportReport, dependencies=[Depends(auth.require_modify_access)])
+def bulk_create_patients(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern="^(csv|jsonl)$"),
+    chunk_size: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db),
+    current_user: schemas.UserPrincipal = Depends(auth.get_current_active_user)
+):
+    fmt = format or importers.detect_format(file.filename, file.content_type)
+    records = importers.iter_records(file.file, fmt)
+    return crud.bulk_create_patients(db, records, current_user, chunk_size=chunk_size)
+
 @app.put("/patients/{patient_id}", response_model=schemas.Patient, dependencies=[Depends(auth.require_modify_access)])
-def update_patient(patient_id: int, patient_update: schemas.PatientUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
+def update_patient(patient_id: int, patient_update: schemas.PatientUpdate, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.get_current_active_user)):
     db_patient = crud.update_patient(db, patient_id, patient_update, current_user)
     if not db_patient: raise HTTPException(status.HTTP_404_NOT_FOUND, "Patient not found")
     return db_patient
 
 @app.delete("/patients/{patient_id}", status_code=status.HTTP_204_NO_CONTENT, deprecated=True)
-def delete_patient(patient_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.require_admin)):
+def delete_patient(patient_id: int, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
     # This endpoint is maintained for now but deprecated in favor of the centralized one.
     # It could be removed in the future. The frontend will no longer use it.
     db_patient = crud.delete_patient(db, patient_id, current_user)
@@ -159,60 +245,140 @@ def delete_patient(patient_id: int, db: Session = Depends(get_db), current_user:
     return None
 
 @app.put("/patients/{patient_id}/anex", response_model=schemas.Patient, dependencies=[Depends(auth.require_modify_access)])
-def sync_patient_anex_records(patient_id: int, records: List[schemas.AnexRecordUpdate], db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
+def sync_patient_anex_records(patient_id: int, records: List[schemas.AnexRecordUpdate], db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.get_current_active_user)):
     db_patient = crud.sync_anex_records(db, patient_id, records, current_user)
     if not db_patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     return db_patient
 
 # --- Finance Routes ---
-@app.get("/finances/", response_model=List[schemas.FinanceInDB], dependencies=[Depends(auth.get_current_active_user)])
-def get_finances(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)): return crud.get_finances(db, skip, limit)
+async def get_finances_async(request: Request, skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_db)):
+    return await caching.listing_response_async(request, db, "finances", (skip, limit), lambda: crud_async.get_finances(db, skip, limit))
+
+@app.get("/finances/", response_model=List[schemas.FinanceInDB], dependencies=[Depends(auth.active_user_dependency("get_finances"))])
+@async_variant(get_finances_async)
+def get_finances(request: Request, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    return caching.listing_response(request, db, "finances", (skip, limit), lambda: crud.get_finances(db, skip, limit))
 
 @app.post("/finances/", response_model=schemas.FinanceInDB, dependencies=[Depends(auth.require_modify_access)])
-def create_finance(finance: schemas.FinanceCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)): return crud.create_finance(db, finance, current_user)
+def create_finance(finance: schemas.FinanceCreate, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.get_current_active_user)): return crud.create_finance(db, finance, current_user)
 
 @app.put("/finances/{finance_id}", response_model=schemas.FinanceInDB, dependencies=[Depends(auth.require_modify_access)])
-def update_finance(finance_id: int, finance_update: schemas.FinanceUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
+def update_finance(finance_id: int, finance_update: schemas.FinanceUpdate, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.get_current_active_user)):
     db_finance = crud.update_finance(db, finance_id, finance_update, current_user)
     if not db_finance: raise HTTPException(status.HTTP_404_NOT_FOUND, "Finance record not found")
     return db_finance
 
 @app.delete("/finances/{finance_id}", response_model=schemas.FinanceInDB, dependencies=[Depends(auth.require_admin)])
-def delete_finance(finance_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.require_admin)):
+def delete_finance(finance_id: int, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
     db_finance = crud.delete_finance(db, finance_id, current_user)
+    if db_finance == "IN_USE": raise HTTPException(status.HTTP_409_CONFLICT, "Finance record is still referenced by anex records.")
     if not db_finance: raise HTTPException(status.HTTP_404_NOT_FOUND, "Finance record not found")
     return db_finance
 
 # --- Service Routes ---
-@app.get("/services/", response_model=List[schemas.ServiceInDB], dependencies=[Depends(auth.get_current_active_user)])
-def get_services(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)): return crud.get_services(db, skip, limit)
+async def get_services_async(request: Request, skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_db)):
+    return await caching.listing_response_async(request, db, "services", (skip, limit), lambda: crud_async.get_services(db, skip, limit))
+
+@app.get("/services/", response_model=List[schemas.ServiceInDB], dependencies=[Depends(auth.active_user_dependency("get_services"))])
+@async_variant(get_services_async)
+def get_services(request: Request, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    return caching.listing_response(request, db, "services", (skip, limit), lambda: crud.get_services(db, skip, limit))
 
 @app.post("/services/", response_model=schemas.ServiceInDB, dependencies=[Depends(auth.require_modify_access)])
-def create_service(service: schemas.ServiceCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)): return crud.create_service(db, service, current_user)
+def create_service(service: schemas.ServiceCreate, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.get_current_active_user)): return crud.create_service(db, service, current_user)
 
 @app.put("/services/{service_id}", response_model=schemas.ServiceInDB, dependencies=[Depends(auth.require_modify_access)])
-def update_service(service_id: int, service_update: schemas.ServiceUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
+def update_service(service_id: int, service_update: schemas.ServiceUpdate, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.get_current_active_user)):
     db_service = crud.update_service(db, service_id, service_update, current_user)
     if not db_service: raise HTTPException(status.HTTP_404_NOT_FOUND, "Service record not found")
     return db_service
 
 @app.delete("/services/{service_id}", response_model=schemas.ServiceInDB, dependencies=[Depends(auth.require_admin)])
-def delete_service(service_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.require_admin)):
+def delete_service(service_id: int, db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.require_admin)):
     db_service = crud.delete_service(db, service_id, current_user)
+    if db_service == "IN_USE": raise HTTPException(status.HTTP_409_CONFLICT, "Service record is still referenced by anex records.")
     if not db_service: raise HTTPException(status.HTTP_404_NOT_FOUND, "Service record not found")
     return db_service
 
-# --- History of Changes Route ---
-@app.get("/history/", response_model=List[schemas.HistoryLog], dependencies=[Depends(auth.get_current_active_user)])
-def get_history(
-    db: Session = Depends(get_db),
-    skip: int = 0,
-    limit: int = 100,
-    author: Optional[str] = None,
-    date: Optional[date] = None,
-    patient: Optional[str] = None
+# --- Report Routes ---
+def finance_report_params(
+    group_by: str = Query("none", pattern="^(" + "|".join(reports.GROUPINGS) + ")$"),
+    bucket: str = Query("month", pattern="^(" + "|".join(reports.DEADLINE_BUCKETS) + ")$"),
+    deadline_from: Optional[date] = None,
+    deadline_to: Optional[date] = None
 ):
-    filters = {"author": author, "date": date, "patient": patient}
+    return {"group_by": group_by, "bucket": bucket, "deadline_from": deadline_from, "deadline_to": deadline_to}
+
+async def get_finance_report_async(db: AsyncSession = Depends(get_async_db), params: dict = Depends(finance_report_params)):
+    return await crud_async.finance_report(db, **params)
+
+@app.get("/reports/finance", response_model=schemas.FinanceReport, dependencies=[Depends(auth.active_user_dependency("get_finance_report"))])
+@async_variant(get_finance_report_async)
+def get_finance_report(db: Session = Depends(get_db), params: dict = Depends(finance_report_params)):
+    return reports.finance_report(db, **params)
+
+# --- History of Changes Route ---
+def history_filters(author: Optional[str] = None, date: Optional[date] = None, patient: Optional[str] = None):
+    return {"author": author, "date": date, "patient": patient}
+
+async def get_history_async(db: AsyncSession = Depends(get_async_db), skip: int = 0, limit: int = 100, cursor: Optional[str] = None, filters: dict = Depends(history_filters)):
+    if fast_json.FAST_JSON_RESPONSES:
+        body = await db.run_sync(fast_json.history_json, skip, limit, filters, cursor)
+        if body is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        return fast_json.response(body)
+    if cursor is not None:
+        page = await crud_async.get_history_logs_page(db, limit=limit, filters=filters, cursor=cursor)
+        if page is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        return page
+    return await crud_async.get_history_logs(db, skip=skip, limit=limit, filters=filters)
+
+@app.get("/history/", response_model=Union[List[schemas.HistoryLog], schemas.HistoryLogPage], dependencies=[Depends(auth.active_user_dependency("get_history"))])
+@async_variant(get_history_async)
+def get_history(db: Session = Depends(get_db), skip: int = 0, limit: int = 100, cursor: Optional[str] = None, filters: dict = Depends(history_filters)):
+    if fast_json.FAST_JSON_RESPONSES:
+        body = fast_json.history_json(db, skip, limit, filters, cursor)
+        if body is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        return fast_json.response(body)
+    if cursor is not None:
+        page = crud.get_history_logs_page(db, limit=limit, filters=filters, cursor=cursor)
+        if page is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        return page
     return crud.get_history_logs(db, skip=skip, limit=limit, filters=filters)
 
+def _entity_as_of(result):
+    if result == "INVALID": raise HTTPException(status.HTTP_400_BAD_REQUEST, "Unsupported entity type.")
+    if result is None: raise HTTPException(status.HTTP_404_NOT_FOUND, "No history for this entity.")
+    return result
+
+async def get_entity_as_of_async(entity_type: str, entity_id: int, ts: datetime, db: AsyncSession = Depends(get_async_db)):
+    return _entity_as_of(await db.run_sync(history_snapshots.as_of, entity_type, entity_id, ts))
+
+@app.get("/history/{entity_type}/{entity_id}/as-of", response_model=schemas.EntityAsOf, dependencies=[Depends(auth.active_user_dependency("get_entity_as_of"))])
+@async_variant(get_entity_as_of_async)
+def get_entity_as_of(entity_type: str, entity_id: int, ts: datetime, db: Session = Depends(get_db)):
+    return _entity_as_of(history_snapshots.as_of(db, entity_type, entity_id, ts))
+
+
+# --- Change Feed ---
+def _change_feed(feed):
+    if feed is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+    if feed == "EXPIRED": raise HTTPException(status.HTTP_410_GONE, "Cursor is older than the kept history; reload the lists.")
+    return feed
+
+async def get_changes_async(since: str = "", limit: int = Query(500, ge=1, le=5000), db: AsyncSession = Depends(get_async_db), current_user: schemas.UserPrincipal = Depends(auth.active_user_dependency("get_changes"))):
+    return _change_feed(await db.run_sync(change_feed.get_changes, since, limit, current_user.role == "admin"))
+
+@app.get("/changes", response_model=schemas.ChangeFeed)
+@async_variant(get_changes_async)
+def get_changes(since: str = "", limit: int = Query(500, ge=1, le=5000), db: Session = Depends(get_db), current_user: schemas.UserPrincipal = Depends(auth.active_user_dependency("get_changes"))):
+    return _change_feed(change_feed.get_changes(db, since, limit, current_user.role == "admin"))
+
+# --- Event Stream ---
+# Streams read the feed with their own short sessions, so an open stream holds no connection (see events.py)
+@app.get("/events")
+async def get_events(since: str = "", types: str = "", last_event_id: str = Header(""), current_user: schemas.UserPrincipal = Depends(auth.get_current_active_user)):
+    # EventSource sends the last id it received when it reconnects
+    stream = await events.subscribe(last_event_id or since, types, current_user.role == "admin")
+    if stream is None: raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor or entity type.")
+    return StreamingResponse(stream, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
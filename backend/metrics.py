@@ -0,0 +1,197 @@
+"""
+Per-route request instrumentation, exposed in Prometheus text format.
+
+RequestMetricsMiddleware opens a collector for every HTTP request; the engine
+hooks in database.py add each SQL statement and its duration to it, and
+TimedRoute marks the moment the endpoint returns so the time spent validating
+and rendering the response can be told apart from the handler itself.
+
+Requests that run more than METRICS_QUERY_BUDGET statements are logged along
+with the statements they ran. Metrics are kept per process.
+"""
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from fastapi.routing import APIRoute
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "on").lower() in ("1", "true", "on")
+METRICS_QUERY_BUDGET = int(os.getenv("METRICS_QUERY_BUDGET", "25"))
+# Statements kept per request for the over-budget log line
+METRICS_STATEMENT_LOG_LIMIT = int(os.getenv("METRICS_STATEMENT_LOG_LIMIT", "100"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+
+class RequestCollector:
+    __slots__ = ("query_count", "db_seconds", "statements", "handler_done")
+
+    def __init__(self):
+        self.query_count = 0
+        self.db_seconds = 0.0
+        self.statements = []
+        self.handler_done = None
+
+
+# Sync endpoints and dependencies run on worker threads with a copy of the request's
+# context, so they all see (and add to) the same collector object.
+_current = ContextVar("request_metrics", default=None)
+
+
+def record_query(statement: str, seconds: float):
+    """Called by the engine hooks after every cursor execution."""
+    collector = _current.get()
+    if collector is None: return
+    collector.query_count += 1
+    collector.db_seconds += seconds
+    if len(collector.statements) < METRICS_STATEMENT_LOG_LIMIT:
+        collector.statements.append(statement)
+
+
+def mark_handler_done():
+    collector = _current.get()
+    if collector is not None:
+        collector.handler_done = time.perf_counter()
+
+
+# --- Registry ---
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets):
+        self.name, self.help_text, self.buckets = name, help_text, buckets
+        self.series = {}
+
+    def observe(self, labels: tuple, value: float):
+        counts, total = self.series.get(labels, (None, 0))
+        if counts is None:
+            counts = [0] * (len(self.buckets) + 1)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self.series[labels] = (counts, total + value)
+
+    def render(self, label_names):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.series.items()):
+            base = _format_labels(label_names, labels)
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {counts[-1]}')
+            lines.append(f"{self.name}_sum{{{base}}} {total}")
+            lines.append(f"{self.name}_count{{{base}}} {counts[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help_text = name, help_text
+        self.series = {}
+
+    def inc(self, labels: tuple, amount: int = 1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self, label_names):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{{{_format_labels(label_names, labels)}}} {value}")
+        return lines
+
+
+def _format_labels(names, values):
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+_lock = threading.Lock()
+ROUTE_LABELS = ("method", "route")
+requests_total = Counter("http_requests_total", "HTTP requests by route and status code.")
+request_seconds = Histogram("http_request_duration_seconds", "End-to-end request latency, until the last body chunk is sent.", SECONDS_BUCKETS)
+db_seconds = Histogram("http_request_db_seconds", "Time spent executing SQL per request.", SECONDS_BUCKETS)
+serialization_seconds = Histogram("http_request_serialization_seconds", "Time from the endpoint returning to the response headers being sent.", SECONDS_BUCKETS)
+query_count = Histogram("http_request_queries", "SQL statements executed per request.", QUERY_BUCKETS)
+over_budget_total = Counter("http_request_query_budget_exceeded_total", "Requests that ran more statements than METRICS_QUERY_BUDGET.")
+
+
+def observe(method: str, route: str, status_code: int, collector: RequestCollector, started: float, headers_sent: float, finished: float):
+    labels = (method, route)
+    serialization = headers_sent - collector.handler_done if collector.handler_done and headers_sent else 0.0
+    with _lock:
+        requests_total.inc((method, route, status_code))
+        request_seconds.observe(labels, finished - started)
+        db_seconds.observe(labels, collector.db_seconds)
+        serialization_seconds.observe(labels, max(serialization, 0.0))
+        query_count.observe(labels, collector.query_count)
+        if collector.query_count > METRICS_QUERY_BUDGET:
+            over_budget_total.inc(labels)
+    if collector.query_count > METRICS_QUERY_BUDGET:
+        logger.warning("%s %s ran %d SQL statements (budget %d, %.1f ms in the database):\n%s",
+                       method, route, collector.query_count, METRICS_QUERY_BUDGET, collector.db_seconds * 1000,
+                       "\n".join(collector.statements))
+
+
+def render() -> str:
+    with _lock:
+        lines = requests_total.render(("method", "route", "status"))
+        for histogram in (request_seconds, db_seconds, serialization_seconds, query_count):
+            lines += histogram.render(ROUTE_LABELS)
+        lines += over_budget_total.render(ROUTE_LABELS)
+    return "\n".join(lines) + "\n"
+
+
+# --- ASGI Integration ---
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+
+        collector = RequestCollector()
+        token = _current.set(collector)
+        started = time.perf_counter()
+        timings = {"status": 500, "headers_sent": None}
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                timings["status"] = message["status"]
+                timings["headers_sent"] = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            # Label by the path template, not the concrete URL, to keep series bounded
+            route_label = getattr(route, "path", None) or "unmatched"
+            observe(scope["method"], route_label, timings["status"], collector,
+                    started, timings["headers_sent"], time.perf_counter())
+
+
+class TimedRoute(APIRoute):
+    """APIRoute whose endpoint notes when it returns, splitting handler time from serialization."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if inspect.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def timed_endpoint(*args, **kw):
+                try:
+                    return await endpoint(*args, **kw)
+                finally:
+                    mark_handler_done()
+        else:
+            @functools.wraps(endpoint)
+            def timed_endpoint(*args, **kw):
+                try:
+                    return endpoint(*args, **kw)
+                finally:
+                    mark_handler_done()
+        super().__init__(path, timed_endpoint, **kwargs)
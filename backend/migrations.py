@@ -0,0 +1,218 @@
+"""
+Versioned schema migrations.
+
+The schema version is kept in SQLite's `PRAGMA user_version`. Run the upgrade
+once per deploy, before any worker starts:
+    python migrations.py upgrade [--db lab_app.db]
+    python migrations.py status [--db lab_app.db]
+
+upgrade applies every migration above the stored version in order, recording
+each one as it succeeds. It then runs the refresh steps, which rebuild derived
+objects and are no-ops when nothing changed: the history view and archive
+table, the index set, the search index and the finance summary. Finally it
+creates the admin user from ADMIN_PASSWORD if there is none. Workers only call
+check_schema() at import, which is a single PRAGMA read with no DDL.
+
+Migration 1 creates every table as models.py declares it today, and databases
+made before versioning start at version 0 with whatever create_all gave them.
+A migration may therefore find its change already in place, so each one checks
+before it alters anything. Append new migrations to MIGRATIONS; never renumber
+or edit one that has shipped.
+
+AUTO_MIGRATE=on makes the app run the upgrade itself at import. It is meant for
+local development and single-process test runs, not for multi-worker deploys.
+"""
+import argparse
+import os
+import sys
+import time
+from sqlalchemy import MetaData, inspect
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.orm import Session
+import crud, history_snapshots, history_store, indexes, models, reports, schemas, search
+
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "off").lower() in ("1", "true", "on")
+
+
+class SchemaOutOfDate(RuntimeError):
+    """The database has not been upgraded to the schema this code needs."""
+
+
+# --- Migrations ---
+def _create_tables(engine):
+    models.Base.metadata.create_all(bind=engine)
+
+def _add_user_is_blocked(engine):
+    # create_all never alters an existing table, so users tables from before the column lack it
+    if "is_blocked" not in {column["name"] for column in inspect(engine).get_columns("users")}:
+        with engine.begin() as conn:
+            conn.exec_driver_sql("ALTER TABLE users ADD COLUMN is_blocked BOOLEAN NOT NULL DEFAULT 0")
+
+def _create_refresh_tokens(engine):
+    models.RefreshToken.__table__.create(bind=engine, checkfirst=True)
+
+def _stale_foreign_keys(cursor, table) -> bool:
+    """Whether the stored table's foreign keys lack the ON DELETE actions models.py declares."""
+    stored = {(row[3], row[2]): row[6] for row in cursor.execute(f'PRAGMA foreign_key_list("{table.name}")')}
+    declared = {(fk.parent.name, fk.column.table.name): (fk.ondelete or "NO ACTION").upper() for fk in table.foreign_keys}
+    return stored != declared
+
+def _rebuild_foreign_keys(engine):
+    """
+    Recreates every table whose foreign keys predate their ON DELETE actions, which SQLite
+    cannot alter in place. Follows SQLite's table-rebuild procedure in one transaction: views
+    are dropped and restored around it and AUTOINCREMENT counters carried over. References to
+    rows deleted before foreign keys were enforced are then cleared where the action is SET NULL,
+    as it would have done; other dangling references are kept as they are.
+    """
+    raw = engine.raw_connection()
+    sqlite_conn = raw.driver_connection
+    isolation_level = sqlite_conn.isolation_level
+    sqlite_conn.isolation_level = None
+    try:
+        cursor = sqlite_conn.cursor()
+        existing = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        stale = [table for table in models.Base.metadata.sorted_tables
+                 if table.name in existing and _stale_foreign_keys(cursor, table)]
+        foreign_keys = cursor.execute("PRAGMA foreign_keys").fetchone()[0]
+        cursor.execute("PRAGMA foreign_keys = OFF")
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            views = cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'view'").fetchall()
+            for name, _ in views:
+                cursor.execute(f'DROP VIEW "{name}"')
+            # The rebuilt copies need every table they reference in their metadata
+            scratch = MetaData()
+            for table in models.Base.metadata.sorted_tables:
+                table.to_metadata(scratch)
+            for table in stale:
+                columns = {row[1] for row in cursor.execute(f'PRAGMA table_info("{table.name}")')}
+                copied = ", ".join(f'"{column.name}"' for column in table.columns if column.name in columns)
+                sequence = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table.name,)).fetchone() \
+                    if "sqlite_sequence" in existing else None
+                new_table = table.to_metadata(scratch, name=f"{table.name}_rebuilt")
+                cursor.execute(str(CreateTable(new_table).compile(dialect=engine.dialect)))
+                cursor.execute(f'INSERT INTO "{new_table.name}" ({copied}) SELECT {copied} FROM "{table.name}"')
+                cursor.execute(f'DROP TABLE "{table.name}"')
+                cursor.execute(f'ALTER TABLE "{new_table.name}" RENAME TO "{table.name}"')
+                for index in table.indexes:
+                    cursor.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+                if sequence:
+                    cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence[0], table.name))
+                    cursor.execute("INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? WHERE NOT EXISTS "
+                                   "(SELECT 1 FROM sqlite_sequence WHERE name = ?)", (table.name, sequence[0], table.name))
+            for table in models.Base.metadata.sorted_tables:
+                for fk in table.foreign_keys:
+                    if table.name in existing and (fk.ondelete or "").upper() == "SET NULL":
+                        cursor.execute(f'UPDATE "{table.name}" SET "{fk.parent.name}" = NULL WHERE "{fk.parent.name}" '
+                                       f'NOT IN (SELECT "{fk.column.name}" FROM "{fk.column.table.name}")')
+            for _, sql in views:
+                cursor.execute(sql)
+            cursor.execute("COMMIT")
+        except BaseException:
+            if sqlite_conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.execute(f"PRAGMA foreign_keys = {foreign_keys}")
+        cursor.close()
+    finally:
+        sqlite_conn.isolation_level = isolation_level
+        raw.close()
+
+MIGRATIONS = (
+    (1, "create tables", _create_tables),
+    (2, "add users.is_blocked", _add_user_is_blocked),
+    (3, "coded history actions and compact changes", history_store.convert_legacy_history),
+    (4, "create refresh_tokens", _create_refresh_tokens),
+    (5, "ON DELETE actions on foreign keys", _rebuild_foreign_keys),
+    (6, "history snapshots", history_snapshots.backfill_snapshots),
+)
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+REFRESH_STEPS = (
+    ("history view and archive", history_store.ensure_history_schema),
+    ("index set", indexes.sync_indexes),
+    ("search index", search.ensure_search_index),
+    ("finance summary", reports.ensure_finance_summary),
+)
+
+
+# --- Runner ---
+def get_version(engine) -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+def _set_version(engine, version: int):
+    with engine.connect() as conn:
+        conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+def ensure_admin(engine):
+    """Creates the admin user from ADMIN_PASSWORD unless it already exists."""
+    password = os.getenv("ADMIN_PASSWORD")
+    if not password: return
+    with Session(bind=engine) as db:
+        if not crud.get_user_by_username(db, username="admin"):
+            admin_schema = schemas.UserCreate(first_name="Admin", last_name="User", email="admin@example.com", user_name="admin", password=password, role="admin")
+            crud.create_user(db=db, user=admin_schema)
+
+def _timed(log, label: str, step, engine):
+    started = time.perf_counter()
+    step(engine)
+    log(f"  {label:<46}{time.perf_counter() - started:>8.2f}s")
+
+def upgrade(engine, log=print) -> int:
+    """Applies pending migrations, then the refresh steps and the admin user; returns the new version."""
+    if engine.dialect.name != "sqlite":
+        # No user_version to track outside SQLite; keep the old create_all behaviour
+        _create_tables(engine)
+        ensure_admin(engine)
+        return LATEST_VERSION
+    version = get_version(engine)
+    if version > LATEST_VERSION:
+        raise SchemaOutOfDate(f"Database schema is at version {version}, newer than this code's {LATEST_VERSION}")
+    for number, description, migrate in MIGRATIONS:
+        if number > version:
+            _timed(log, f"{number} {description}", migrate, engine)
+            _set_version(engine, number)
+    for label, refresh in REFRESH_STEPS:
+        _timed(log, label, refresh, engine)
+    ensure_admin(engine)
+    return LATEST_VERSION
+
+def check_schema(engine):
+    """Raises SchemaOutOfDate unless the database is at (or past) LATEST_VERSION. Does no DDL."""
+    if engine.dialect.name != "sqlite":
+        return
+    version = get_version(engine)
+    if version < LATEST_VERSION:
+        raise SchemaOutOfDate(f"Database schema is at version {version}, this code needs {LATEST_VERSION}; "
+                              "run `python migrations.py upgrade` first")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("upgrade", "Apply pending migrations and refresh derived objects."),
+                            ("status", "Print the database's schema version and the one this code needs.")):
+        commands.add_parser(name, help=help_text).add_argument("--db", help="SQLite file (default: the app's DATABASE_URL).")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    import database
+    engine = database.make_engine(f"sqlite:///{args.db}") if args.db else database.engine
+    if args.db and database.HISTORY_ARCHIVE_PATH:
+        database.attach_archive(engine, database.HISTORY_ARCHIVE_PATH)
+    if args.command == "status":
+        version = get_version(engine)
+        print(f"schema version {version}, code needs {LATEST_VERSION}" + ("" if version >= LATEST_VERSION else " (run upgrade)"))
+        sys.exit(0 if version >= LATEST_VERSION else 1)
+    started = time.perf_counter()
+    print(f"Upgrading schema from version {get_version(engine)}")
+    upgrade(engine)
+    print(f"Schema at version {LATEST_VERSION} ({time.perf_counter() - started:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
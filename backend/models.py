@@ -1,48 +1,56 @@
+import json
 from sqlalchemy import (
     Boolean, Column, Integer, Float, String, 
-    Date, ForeignKey, Table, DateTime, JSON
+    Date, ForeignKey, Table, DateTime, SmallInteger, Text, Index, JSON
 )
 from sqlalchemy.orm import relationship
-from database import Base
+from sqlalchemy.types import TypeDecorator
+from database import Base, json_default
 from datetime import datetime, timezone
 
 
+# Deleting a row removes its rows in the association tables below, its anex records and its refresh tokens
+# (ON DELETE CASCADE), and detaches its history (ON DELETE SET NULL). Relationships over those keys are
+# passive_deletes, so the ORM leaves them to the database instead of loading and deleting each row.
+
 # Links Users (staff) and Patients for general assignment
 user_patient_association = Table('user_patient_association', Base.metadata,
-    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
-    Column('patient_id', Integer, ForeignKey('patients.id'), primary_key=True)
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
+    Column('patient_id', Integer, ForeignKey('patients.id', ondelete='CASCADE'), primary_key=True),
+    # The primary key serves lookups by user; this one serves loading a patient's staff
+    Index('ix_user_patient_association_patient_id', 'patient_id', 'user_id')
 )
 
 # Links Users (doctors or staff) and Specialisations
 user_specialisation_association = Table('user_specialisation_association', Base.metadata,
-    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
-    Column('specialisation_id', Integer, ForeignKey('specialisations.id'), primary_key=True)
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
+    Column('specialisation_id', Integer, ForeignKey('specialisations.id', ondelete='CASCADE'), primary_key=True)
 )
 
 
 class User(Base):
     """Represents any user of the system, like a doctor or staff member."""
     __tablename__ = "users"
-    id = Column(Integer, primary_key=True, index=True)
-    first_name = Column(String, index=True)
-    last_name = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    first_name = Column(String)
+    last_name = Column(String)
     email = Column(String, unique=True, index=True, nullable=False)
     phone_number = Column(String)
     user_name = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
-    role = Column(String, index=True, nullable=False) # e.g., "doctor", "staff"
+    role = Column(String, nullable=False) # e.g., "doctor", "staff"
     is_approved = Column(Boolean, default=False)
     # --- MODIFIED: Added is_blocked column ---
     is_blocked = Column(Boolean, default=False, nullable=False)
     
     # Many-to-Many relationship for general staff assignment to a Patient
-    patients_assigned = relationship("Patient", secondary=user_patient_association, back_populates="staff_assigned")
+    patients_assigned = relationship("Patient", secondary=user_patient_association, back_populates="staff_assigned", passive_deletes=True)
     
     # Many-to-Many relationship to Specialisation
-    specialisations = relationship("Specialisation", secondary=user_specialisation_association, back_populates="users")
+    specialisations = relationship("Specialisation", secondary=user_specialisation_association, back_populates="users", passive_deletes=True)
 
     # One-to-Many relationship for tracking changes made by this user
-    history_logs = relationship("HistoryLog", back_populates="user")
+    history_logs = relationship("HistoryLog", back_populates="user", passive_deletes=True)
 
 
 class Specialisation(Base):
@@ -51,36 +59,44 @@ class Specialisation(Base):
     (e.g., Cardiology, Pediatrics, Billing).
     """
     __tablename__ = "specialisations"
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     name = Column(String, unique=True, index=True, nullable=False)
     
     # Many-to-Many relationship back to Users
-    users = relationship("User", secondary=user_specialisation_association, back_populates="specialisations")
+    users = relationship("User", secondary=user_specialisation_association, back_populates="specialisations", passive_deletes=True)
 
 
 class Patient(Base):
     """Represents a patient."""
     __tablename__ = "patients"
-    id = Column(Integer, primary_key=True, index=True)
-    first_name = Column(String, index=True)
-    last_name = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    first_name = Column(String)
+    last_name = Column(String)
     birth_date = Column(Date)
-    nationality = Column(String, index=True)
+    nationality = Column(String)
     personal_number = Column(String, index=True, nullable=False, unique=True)
-    address = Column(String, index=True)
+    address = Column(String)
 
     # Many-to-Many for general staff assignment
-    staff_assigned = relationship("User", secondary=user_patient_association, back_populates="patients_assigned")
+    staff_assigned = relationship("User", secondary=user_patient_association, back_populates="patients_assigned", passive_deletes=True)
     
     # One-to-Many for detailed Doctor->Service->Funder records
-    anex_records = relationship("AnexRecord", back_populates="patient", cascade="all, delete-orphan")
+    anex_records = relationship("AnexRecord", back_populates="patient", cascade="all, delete-orphan", passive_deletes=True)
 
 
 class AnexRecord(Base):
     """ Links a Patient to a specific Doctor, Service, and Funder with amounts. """
     __tablename__ = "anex_records"
-    id = Column(Integer, primary_key=True, index=True)
-    patient_id = Column(Integer, ForeignKey('patients.id'), nullable=False)
+    # Each foreign key leads its index, with patient_id after it so the /patients/ doctor, funder and
+    # research filters are answered from the index alone (they only need the patient ids)
+    __table_args__ = (
+        Index("ix_anex_records_patient_id", "patient_id"),
+        Index("ix_anex_records_doctor_id_patient_id", "doctor_id", "patient_id"),
+        Index("ix_anex_records_service_id_patient_id", "service_id", "patient_id"),
+        Index("ix_anex_records_finance_id_patient_id", "finance_id", "patient_id"),
+    )
+    id = Column(Integer, primary_key=True)
+    patient_id = Column(Integer, ForeignKey('patients.id', ondelete='CASCADE'), nullable=False)
     # --- MODIFIED: Added ondelete='SET NULL' to preserve records if a doctor is deleted ---
     doctor_id = Column(Integer, ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
     service_id = Column(Integer, ForeignKey('services.id'), nullable=False)
@@ -97,18 +113,18 @@ class AnexRecord(Base):
 class Service(Base):
     """Represents a medical service or research item."""
     __tablename__ = "services"
-    id = Column(Integer, primary_key=True, index=True)
-    service_number = Column(String, index=True)
-    research_name = Column(String, index=True)
-    laboratory_name = Column(String, index=True, nullable=False)
+    id = Column(Integer, primary_key=True)
+    service_number = Column(String)
+    research_name = Column(String)
+    laboratory_name = Column(String, nullable=False)
     deadline = Column(Date)
     
 
 class Finance(Base):
     """Represents a financial record or transaction."""
     __tablename__ = "finances"
-    id = Column(Integer, primary_key=True, index=True)
-    funder_name = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    funder_name = Column(String)
     email = Column(String, unique=True, index=True, nullable=False)
     phone_number = Column(String)
     
@@ -116,24 +132,145 @@ class Finance(Base):
 class Invitation(Base):
     """Represents a one-time invitation for user registration."""
     __tablename__ = "invitations"
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, index=True, nullable=False)
     token = Column(String, unique=True, index=True, nullable=False)
     expires_at = Column(DateTime, nullable=False)
     is_used = Column(Boolean, default=False)
 
+
+class RefreshToken(Base):
+    """
+    A long-lived token exchanged at /token/refresh for a new access token. Only its
+    SHA-256 is stored. Each exchange revokes it and issues a successor in the same
+    family, so reuse of a revoked token can revoke the whole chain.
+    """
+    __tablename__ = "refresh_tokens"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    token_hash = Column(String, unique=True, index=True, nullable=False)
+    family = Column(String, nullable=False, index=True)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime, nullable=True)
+
+# --- History Encoding ---
+# A code is the name's position in its tuple, so names are only ever appended
+HISTORY_ACTIONS = ("CREATE", "UPDATE", "DELETE", "BLOCK", "UNBLOCK", "BULK_CREATE", "SYNC_ANEX")
+HISTORY_ENTITY_TYPES = ("User", "Patient", "AnexRecord", "Finance", "Service", "Specialisation", "Invitation")
+
+
+class HistoryCode(TypeDecorator):
+    """A name from a fixed tuple, stored as its 1-based position in that tuple."""
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, names: tuple):
+        super().__init__()
+        self.names = names
+        self.codes = {name: code for code, name in enumerate(names, 1)}
+
+    def process_bind_param(self, value, dialect):
+        if value is None: return None
+        if value not in self.codes:
+            raise ValueError(f"{value!r} has no history code, append it to the tuple in models.py")
+        return self.codes[value]
+
+    def process_result_value(self, value, dialect):
+        return self.names[value - 1] if value is not None else None
+
+
+def encode_changes(changes) -> str:
+    """
+    Stored text of a history `changes` dict: JSON without padding or ASCII escapes,
+    and a field diff {"field": {"before": b, "after": a}, ...} flattened to ["field", b, a, ...].
+    """
+    if changes is None: return None
+    if changes and all(isinstance(diff, dict) and diff.keys() == {"before", "after"} for diff in changes.values()):
+        changes = [item for field, diff in changes.items() for item in (field, diff["before"], diff["after"])]
+    return json.dumps(changes, default=json_default, ensure_ascii=False, separators=(",", ":"))
+
+def expand_changes(value):
+    """Turns parsed stored `changes` back into the API shape; only flattened diffs are lists."""
+    if isinstance(value, list):
+        return {value[i]: {"before": value[i + 1], "after": value[i + 2]} for i in range(0, len(value), 3)}
+    return value
+
+
+class HistoryChanges(TypeDecorator):
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return encode_changes(value)
+
+    def process_result_value(self, value, dialect):
+        return expand_changes(json.loads(value)) if value is not None else None
+
+
 class HistoryLog(Base):
     """Represents a record of a change made in the system."""
     __tablename__ = "history_logs"
-    id = Column(Integer, primary_key=True, index=True)
+    # Pages are ordered newest first, alone or within one author's or patient's entries;
+    # point-in-time rebuilds read one entity's entries in time order (see history_snapshots.py)
+    __table_args__ = (
+        Index("ix_history_logs_timestamp_id", "timestamp", "id"),
+        Index("ix_history_logs_entity_type_entity_id_timestamp", "entity_type", "entity_id", "timestamp"),
+        Index("ix_history_logs_patient_id_timestamp", "patient_id", "timestamp"),
+        Index("ix_history_logs_user_id_timestamp", "user_id", "timestamp"),
+        # Ids are never reused, so entries moved to the archive (history_store.py) keep them unique
+        {"sqlite_autoincrement": True},
+    )
+    id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     # --- MODIFIED: Added ondelete='SET NULL' to preserve history logs ---
     user_id = Column(Integer, ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
-    action = Column(String, index=True) # e.g., CREATE, UPDATE, DELETE
-    entity_type = Column(String, index=True) # e.g., Patient, User
+    action = Column(HistoryCode(HISTORY_ACTIONS)) # e.g., CREATE, UPDATE, DELETE
+    entity_type = Column(HistoryCode(HISTORY_ENTITY_TYPES)) # e.g., Patient, User
     entity_id = Column(Integer)
-    patient_id = Column(Integer, ForeignKey('patients.id'), nullable=True, index=True)
-    changes = Column(JSON) # Stores a dict of changes, e.g., {"field": {"before": "...", "after": "..."}}
+    patient_id = Column(Integer, ForeignKey('patients.id', ondelete='SET NULL'), nullable=True)
+    changes = Column(HistoryChanges) # Stores a dict of changes, e.g., {"field": {"before": "...", "after": "..."}}
 
     user = relationship("User", back_populates="history_logs")
     patient = relationship("Patient")
+
+
+class HistorySnapshot(Base):
+    """
+    Full state of an entity as of the history entry at `timestamp`, written every
+    HISTORY_SNAPSHOT_EVERY entries so a past state is rebuilt from the nearest
+    snapshot instead of the entity's whole history (see history_snapshots.py).
+    """
+    __tablename__ = "history_snapshots"
+    __table_args__ = (
+        Index("ix_history_snapshots_entity_type_entity_id_timestamp", "entity_type", "entity_id", "timestamp"),
+    )
+    id = Column(Integer, primary_key=True)
+    entity_type = Column(HistoryCode(HISTORY_ENTITY_TYPES), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+    state = Column(JSON, nullable=False)
+
+
+class AnexSummary(Base):
+    """
+    Running totals of anex records per (service, funder, doctor), kept by reports.py
+    when FINANCE_SUMMARY is enabled so finance reports read O(groups) rows.
+    """
+    __tablename__ = "anex_summary"
+    service_id = Column(Integer, primary_key=True)
+    finance_key = Column(Integer, primary_key=True) # finance_id, 0 for self-funded
+    doctor_key = Column(Integer, primary_key=True) # doctor_id, 0 when no doctor
+    record_count = Column(Integer, nullable=False, default=0)
+    payable_total = Column(Float, nullable=False, default=0.0)
+    paid_total = Column(Float, nullable=False, default=0.0)
+
+
+class TableVersion(Base):
+    """
+    Change counter per table, bumped by crud in the same transaction as the change.
+    Drives the ETags and rendered-body cache of the reference-data listings (see caching.py).
+    """
+    __tablename__ = "table_versions"
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,92 @@
+"""
+Rate-limit storage shared by all worker processes.
+
+slowapi keeps its counters in the storage named by RATE_LIMIT_STORAGE_URI.
+`memory://` is per process, so with several workers every one of them would
+allow the full /token budget. For multi-worker runs (WEB_CONCURRENCY > 1, as
+set by serve.py) the default is therefore a small SQLite file that all workers
+on the host share, registered below under the `sqlite://` scheme. Any scheme the
+`limits` package supports also works, e.g. `redis://host:6379` once the redis
+package is installed.
+"""
+import os
+import sqlite3
+import threading
+import time
+from limits.storage import Storage
+
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1") or 1)
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI") or (
+    "sqlite:///./rate_limits.db" if WEB_CONCURRENCY > 1 else "memory://")
+
+# Expired counters are deleted every this many increments per process
+_PURGE_EVERY = 1000
+
+
+class SQLiteStorage(Storage):
+    """
+    Fixed-window counters in a SQLite file: `sqlite:///relative/path.db` or
+    `sqlite:////absolute/path.db`. Each increment is a single upsert, so
+    concurrent workers never lose a hit.
+    """
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri: str = None, wrap_exceptions: bool = False, **options):
+        path = uri.split("://", 1)[1]
+        self.path = path[1:] if path.startswith("/") else path
+        self._local = threading.local()
+        self._increments = 0
+        self._connection().execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL, "
+                                   "expires_at REAL NOT NULL) WITHOUT ROWID")
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    def _connection(self) -> sqlite3.Connection:
+        # One autocommit connection per thread: sync routes run on the thread pool, async ones on the loop
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            # Counters are disposable, so losing the last writes on power loss is acceptable
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+        return conn
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def incr(self, key: str, expiry: float, amount: int = 1) -> int:
+        now = time.time()
+        conn = self._connection()
+        value = conn.execute(
+            "INSERT INTO counters (key, value, expires_at) VALUES (:key, :amount, :expires_at) "
+            "ON CONFLICT (key) DO UPDATE SET "
+            "value = CASE WHEN expires_at <= :now THEN excluded.value ELSE value + excluded.value END, "
+            "expires_at = CASE WHEN expires_at <= :now THEN excluded.expires_at ELSE expires_at END "
+            "RETURNING value",
+            {"key": key, "amount": amount, "expires_at": now + expiry, "now": now}).fetchone()[0]
+        self._increments += 1
+        if self._increments % _PURGE_EVERY == 0:
+            conn.execute("DELETE FROM counters WHERE expires_at <= ?", (now,))
+        return value
+
+    def get(self, key: str) -> int:
+        row = self._connection().execute("SELECT value FROM counters WHERE key = ? AND expires_at > ?",
+                                         (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> float:
+        row = self._connection().execute("SELECT expires_at FROM counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self) -> bool:
+        try:
+            self._connection().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> int:
+        return self._connection().execute("DELETE FROM counters").rowcount
+
+    def clear(self, key: str) -> None:
+        self._connection().execute("DELETE FROM counters WHERE key = ?", (key,))
@@ -0,0 +1,170 @@
+"""
+Financial reporting over anex records, aggregated in SQL.
+
+Reports group either the anex_records table directly or, when
+FINANCE_SUMMARY is enabled, the anex_summary table: running totals per
+(service, funder, doctor) that crud keeps up to date as records change.
+Either way the grouping joins services/finances/users live, so renaming a
+laboratory or funder never leaves the summary stale. The summary is rebuilt
+by `python migrations.py upgrade`, so run it after switching FINANCE_SUMMARY on.
+"""
+import os
+from collections import defaultdict
+from datetime import date
+from typing import Optional
+from sqlalchemy import select, func, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+import models
+
+FINANCE_SUMMARY = os.getenv("FINANCE_SUMMARY", "off").lower() in ("1", "true", "on")
+
+GROUPINGS = ("none", "funder", "laboratory", "research", "doctor", "deadline")
+DEADLINE_BUCKETS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+
+# --- Queries ---
+def _source():
+    """Columns of the table being aggregated, in the same shape for both sources."""
+    if FINANCE_SUMMARY:
+        s = models.AnexSummary
+        return (s, s.service_id, s.finance_key, s.doctor_key,
+                func.sum(s.record_count), func.sum(s.payable_total), func.sum(s.paid_total))
+    a = models.AnexRecord
+    return (a, a.service_id, a.finance_id, a.doctor_id, func.count(a.id),
+            func.sum(func.coalesce(a.payable_amount, 0.0)), func.sum(func.coalesce(a.paid_amount, 0.0)))
+
+
+def _group_columns(group_by: str, bucket: str):
+    if group_by == "funder":
+        return models.Finance.id, func.coalesce(models.Finance.funder_name, "Self-funded")
+    if group_by == "laboratory":
+        return models.Service.laboratory_name, models.Service.laboratory_name
+    if group_by == "research":
+        return models.Service.research_name, models.Service.research_name
+    if group_by == "doctor":
+        return models.User.id, models.User.first_name + ' ' + models.User.last_name
+    if group_by == "deadline":
+        period = func.strftime(DEADLINE_BUCKETS[bucket], models.Service.deadline)
+        return period, period
+    return None, None
+
+
+def finance_report(db: Session, group_by: str = "none", bucket: str = "month",
+                   deadline_from: Optional[date] = None, deadline_to: Optional[date] = None):
+    table, service_id, finance_id, doctor_id, count, payable, paid = _source()
+    key, label = _group_columns(group_by, bucket)
+    measures = [count.label("record_count"), payable.label("payable_total"), paid.label("paid_total")]
+
+    def scoped(stmt):
+        stmt = stmt.select_from(table).outerjoin(models.Service, models.Service.id == service_id)
+        if group_by == "funder":
+            stmt = stmt.outerjoin(models.Finance, models.Finance.id == finance_id)
+        if group_by == "doctor":
+            stmt = stmt.outerjoin(models.User, models.User.id == doctor_id)
+        if deadline_from:
+            stmt = stmt.where(models.Service.deadline >= deadline_from)
+        if deadline_to:
+            stmt = stmt.where(models.Service.deadline <= deadline_to)
+        return stmt
+
+    def to_row(row, key=None, label=None):
+        payable_total, paid_total = row.payable_total or 0.0, row.paid_total or 0.0
+        return {"key": key, "label": label, "record_count": row.record_count or 0,
+                "payable_total": payable_total, "paid_total": paid_total,
+                "outstanding": payable_total - paid_total}
+
+    rows = []
+    if key is not None:
+        grouped = scoped(select(key.label("key"), label.label("label"), *measures)).group_by(key, label).order_by(label)
+        rows = [to_row(row, None if row.key is None else str(row.key), row.label) for row in db.execute(grouped)]
+    totals = db.execute(scoped(select(*measures))).one()
+    return {"group_by": group_by, "rows": rows, "totals": to_row(totals)}
+
+
+# --- Summary Maintenance ---
+def _summary_key(service_id, finance_id, doctor_id):
+    return (service_id, finance_id or 0, doctor_id or 0)
+
+
+def apply_anex_changes(db: Session, removed=(), added=()):
+    """
+    Folds anex record changes into anex_summary with one multi-row upsert.
+    `removed`/`added` hold objects or dicts with service_id, finance_id, doctor_id,
+    payable_amount and paid_amount (an update is a remove of the old values plus an add).
+    """
+    if not FINANCE_SUMMARY: return
+    deltas = defaultdict(lambda: [0, 0.0, 0.0])
+    for sign, records in ((-1, removed), (1, added)):
+        for record in records:
+            get = record.get if isinstance(record, dict) else lambda name: getattr(record, name)
+            delta = deltas[_summary_key(get("service_id"), get("finance_id"), get("doctor_id"))]
+            delta[0] += sign
+            delta[1] += sign * (get("payable_amount") or 0.0)
+            delta[2] += sign * (get("paid_amount") or 0.0)
+    _upsert_deltas(db, deltas)
+
+
+def _upsert_deltas(db: Session, deltas: dict):
+    deltas = {key: value for key, value in deltas.items() if any(value)}
+    if not deltas: return
+    summary = models.AnexSummary
+    stmt = sqlite_insert(summary)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[summary.service_id, summary.finance_key, summary.doctor_key],
+        set_={
+            "record_count": summary.record_count + stmt.excluded.record_count,
+            "payable_total": summary.payable_total + stmt.excluded.payable_total,
+            "paid_total": summary.paid_total + stmt.excluded.paid_total,
+        },
+    )
+    db.execute(stmt, [
+        {"service_id": service_id, "finance_key": finance_key, "doctor_key": doctor_key,
+         "record_count": count, "payable_total": payable, "paid_total": paid}
+        for (service_id, finance_key, doctor_key), (count, payable, paid) in deltas.items()
+    ])
+    db.execute(delete(summary).where(summary.record_count <= 0))
+
+
+def remove_patient(db: Session, patient_id: int):
+    """Subtracts a patient's anex records, which the database deletes with the patient (ON DELETE CASCADE)."""
+    if not FINANCE_SUMMARY: return
+    anex = models.AnexRecord
+    rows = db.execute(
+        select(anex.service_id, anex.finance_id, anex.doctor_id, func.count(), func.sum(anex.payable_amount), func.sum(anex.paid_amount))
+        .where(anex.patient_id == patient_id).group_by(anex.service_id, anex.finance_id, anex.doctor_id))
+    deltas = defaultdict(lambda: [0, 0.0, 0.0])
+    for service_id, finance_id, doctor_id, count, payable, paid in rows:
+        delta = deltas[_summary_key(service_id, finance_id, doctor_id)]
+        delta[0] -= count
+        delta[1] -= payable or 0.0
+        delta[2] -= paid or 0.0
+    _upsert_deltas(db, deltas)
+
+
+def detach_doctor(db: Session, doctor_id: int):
+    """Moves a deleted doctor's totals to the 'no doctor' bucket, mirroring ON DELETE SET NULL."""
+    if not FINANCE_SUMMARY: return
+    summary = models.AnexSummary
+    deltas = defaultdict(lambda: [0, 0.0, 0.0])
+    for row in db.execute(select(summary).where(summary.doctor_key == doctor_id)).scalars():
+        for key, sign in (((row.service_id, row.finance_key, doctor_id), -1), ((row.service_id, row.finance_key, 0), 1)):
+            deltas[key][0] += sign * row.record_count
+            deltas[key][1] += sign * row.payable_total
+            deltas[key][2] += sign * row.paid_total
+    _upsert_deltas(db, deltas)
+
+
+def ensure_finance_summary(engine):
+    """Rebuilds anex_summary from anex_records with one GROUP BY (run by every migrations upgrade when enabled)."""
+    if not FINANCE_SUMMARY: return
+    a = models.AnexRecord
+    with Session(bind=engine) as db:
+        db.execute(delete(models.AnexSummary))
+        db.execute(models.AnexSummary.__table__.insert().from_select(
+            ["service_id", "finance_key", "doctor_key", "record_count", "payable_total", "paid_total"],
+            select(a.service_id, func.coalesce(a.finance_id, 0), func.coalesce(a.doctor_id, 0), func.count(a.id),
+                   func.sum(func.coalesce(a.payable_amount, 0.0)), func.sum(func.coalesce(a.paid_amount, 0.0)))
+            .group_by(a.service_id, func.coalesce(a.finance_id, 0), func.coalesce(a.doctor_id, 0))
+        ))
+        db.commit()
@@ -34,10 +34,22 @@ class User(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 class TokenData(BaseModel):
     username: Optional[str] = None
 
+class UserPrincipal(BaseModel):
+    """The slice of a User that authorization needs; cached by auth.get_current_user."""
+    id: int
+    user_name: str
+    role: str
+    is_blocked: bool
+    class Config: from_attributes = True
+
 # --- User Schemas (Full) ---
 class UserBase(BaseModel):
     email: EmailStr
@@ -117,6 +129,19 @@ class Patient(PatientBase):
     anex_records: List[AnexRecord] = []
     class Config: from_attributes = True
 
+class BulkImportError(BaseModel):
+    row: int
+    personal_number: Optional[str] = None
+    error: str
+
+class BulkImportReport(BaseModel):
+    created: int
+    errors: List[BulkImportError] = []
+
+class PatientPage(BaseModel):
+    items: List[Patient]
+    next_cursor: Optional[str] = None
+
 # --- Invitation Schemas ---
 class InvitationBase(BaseModel): email: EmailStr
 class InvitationCreate(InvitationBase): pass
@@ -166,6 +191,47 @@ class HistoryLog(BaseModel):
     patient: Optional[PatientForHistory] = None
     class Config: from_attributes = True
 
+class HistoryLogPage(BaseModel):
+    items: List[HistoryLog]
+    next_cursor: Optional[str] = None
+
+class EntityAsOf(BaseModel):
+    entity_type: str
+    entity_id: int
+    as_of: datetime
+    exists: bool
+    # False when the history holds no full state to start from, so `state` has only the fields changed since
+    complete: bool
+    replayed: int
+    state: Optional[dict] = None
+
+# --- Change Feed Schemas ---
+class Change(BaseModel):
+    entity_type: str
+    entity_id: int
+    deleted: bool
+    # The entity as its list endpoint renders it; None when deleted
+    data: Optional[dict] = None
+
+class ChangeFeed(BaseModel):
+    changes: List[Change]
+    cursor: str
+    has_more: bool
+
+# --- Report Schemas ---
+class FinanceReportRow(BaseModel):
+    key: Optional[str] = None
+    label: Optional[str] = None
+    record_count: int
+    payable_total: float
+    paid_total: float
+    outstanding: float
+
+class FinanceReport(BaseModel):
+    group_by: str
+    rows: List[FinanceReportRow] = []
+    totals: FinanceReportRow
+
 # --- Misc Schemas ---
 class PasswordVerify(BaseModel):
     password: str
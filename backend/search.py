@@ -0,0 +1,160 @@
+"""
+Substring search index for the patient, doctor and staff filters.
+
+Backed by SQLite FTS5 tables using the trigram tokenizer, so `%term%` style
+lookups are answered from the index instead of scanning the base tables.
+Indexed text and search terms are NFC-normalized and casefolded in Python,
+which (unlike SQLite's ASCII-only lower()) folds Georgian Mtavruli to
+Mkhedruli and handles every other script the same way.
+
+The index is kept in sync by the create/update/delete functions in crud.py,
+inside the same transaction as the change itself.
+"""
+import unicodedata
+from typing import Optional
+from sqlalchemy import text, table, column, select, literal_column
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+import models
+
+# Trigram queries need at least this many characters; shorter terms fall back to ILIKE
+MIN_TERM_LENGTH = 3
+
+patient_search = table("patient_search", column("rowid"), column("personal_number"),
+                       column("first_name"), column("last_name"), column("full_name"))
+user_search = table("user_search", column("rowid"), column("user_name"), column("full_name"))
+
+# Set by ensure_search_index() / detect_search_index(); when False, crud keeps using plain ILIKE filters
+enabled = False
+
+
+def normalize(value: Optional[str]) -> str:
+    return unicodedata.normalize("NFC", value or "").casefold()
+
+
+def _full_name(first_name: Optional[str], last_name: Optional[str]) -> str:
+    return normalize(f"{first_name or ''} {last_name or ''}")
+
+
+def usable(term: Optional[str]) -> bool:
+    """True if `term` can be answered from the index."""
+    return enabled and term is not None and len(normalize(term)) >= MIN_TERM_LENGTH
+
+
+def _match_query(term: str, fields) -> str:
+    # A quoted phrase is a substring match under the trigram tokenizer; the
+    # column filter keeps multi-column searches on the index (OR-ed GLOBs do not)
+    phrase = normalize(term).replace('"', '""')
+    return f'{{{" ".join(fields)}}}: "{phrase}"'
+
+
+# --- Lookups (return subqueries of matching ids) ---
+def patient_ids_matching(term: str, *fields: str):
+    return select(patient_search.c.rowid).where(literal_column("patient_search").op("MATCH")(_match_query(term, fields)))
+
+
+def user_ids_matching(term: str, *fields: str):
+    return select(user_search.c.rowid).where(literal_column("user_search").op("MATCH")(_match_query(term, fields)))
+
+
+# --- Maintenance ---
+_INSERT_PATIENT = text("INSERT INTO patient_search(rowid, personal_number, first_name, last_name, full_name) "
+                       "VALUES (:id, :personal_number, :first_name, :last_name, :full_name)")
+_INSERT_USER = text("INSERT INTO user_search(rowid, user_name, full_name) VALUES (:id, :user_name, :full_name)")
+
+
+def _patient_row(patient) -> dict:
+    return {"id": patient.id, "personal_number": normalize(patient.personal_number),
+            "first_name": normalize(patient.first_name), "last_name": normalize(patient.last_name),
+            "full_name": _full_name(patient.first_name, patient.last_name)}
+
+
+def _user_row(user) -> dict:
+    return {"id": user.id, "user_name": normalize(user.user_name), "full_name": _full_name(user.first_name, user.last_name)}
+
+
+def index_patient(db: Session, patient: models.Patient):
+    if not enabled: return
+    unindex_patient(db, patient.id)
+    db.execute(_INSERT_PATIENT, _patient_row(patient))
+
+
+def index_patient_rows(db: Session, patients):
+    """Bulk variant of index_patient for freshly inserted rows (anything with id and the name fields)."""
+    if not enabled or not patients: return
+    db.execute(_INSERT_PATIENT, [_patient_row(patient) for patient in patients])
+
+
+def unindex_patient(db: Session, patient_id: int):
+    if not enabled: return
+    db.execute(text("DELETE FROM patient_search WHERE rowid = :id"), {"id": patient_id})
+
+
+def index_user(db: Session, user: models.User):
+    if not enabled: return
+    unindex_user(db, user.id)
+    db.execute(_INSERT_USER, _user_row(user))
+
+
+def unindex_user(db: Session, user_id: int):
+    if not enabled: return
+    db.execute(text("DELETE FROM user_search WHERE rowid = :id"), {"id": user_id})
+
+
+def _rebuild(db: Session, table_name: str, insert, rows, row_builder, batch_size: int = 5000):
+    db.execute(text(f"DELETE FROM {table_name}"))
+    batch = []
+    for row in rows:
+        batch.append(row_builder(row))
+        if len(batch) >= batch_size:
+            db.execute(insert, batch); batch = []
+    if batch:
+        db.execute(insert, batch)
+
+
+# --- Setup ---
+def ensure_search_index(engine) -> bool:
+    """
+    Creates the FTS5 tables if needed and backfills them when they are out of
+    step with the base tables (run by every migrations upgrade). Leaves search
+    disabled if FTS5 is unavailable.
+    """
+    global enabled
+    if engine.dialect.name != "sqlite":
+        enabled = False
+        return enabled
+    with Session(bind=engine) as db:
+        try:
+            db.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS patient_search USING fts5("
+                            "personal_number, first_name, last_name, full_name, tokenize='trigram case_sensitive 1')"))
+            db.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+                            "user_name, full_name, tokenize='trigram case_sensitive 1')"))
+        except OperationalError:
+            # SQLite built without FTS5 / trigram support
+            db.rollback()
+            enabled = False
+            return enabled
+        enabled = True
+
+        if db.scalar(text("SELECT count(*) FROM patient_search")) != db.query(models.Patient).count():
+            patients = db.query(models.Patient.id, models.Patient.personal_number,
+                                models.Patient.first_name, models.Patient.last_name).yield_per(5000)
+            _rebuild(db, "patient_search", _INSERT_PATIENT, patients, _patient_row)
+        if db.scalar(text("SELECT count(*) FROM user_search")) != db.query(models.User).count():
+            users = db.query(models.User.id, models.User.user_name,
+                             models.User.first_name, models.User.last_name).yield_per(5000)
+            _rebuild(db, "user_search", _INSERT_USER, users, _user_row)
+        db.commit()
+    return enabled
+
+
+def detect_search_index(engine) -> bool:
+    """Enables search if the upgrade created the FTS5 tables; a worker's startup check, without DDL or backfill."""
+    global enabled
+    if engine.dialect.name != "sqlite":
+        enabled = False
+        return enabled
+    with engine.connect() as conn:
+        enabled = conn.exec_driver_sql(
+            "SELECT count(*) FROM sqlite_master WHERE name IN ('patient_search', 'user_search')").scalar() == 2
+    return enabled
@@ -0,0 +1,59 @@
+"""
+Production entry point: applies the schema migrations once, then serves the
+app from WEB_CONCURRENCY uvicorn worker processes. Without WEB_CONCURRENCY the
+worker count is the number of CPUs this process may use (affinity mask and
+cgroup CPU quota both count). Workers inherit WEB_CONCURRENCY, which switches
+the rate limiter to the storage they share (see rate_limits.py).
+
+Each worker keeps its own user-principal cache (entries are checked against the
+shared `users` table version, so a change made through any worker reaches all
+of them; see auth.py), history writer queue, /metrics counters and the history
+poller behind /events (see events.py).
+
+Run from the backend directory:
+    python serve.py [--host 0.0.0.0] [--port 8000] [--workers N]
+"""
+import argparse
+import math
+import os
+import uvicorn
+
+GRACEFUL_SHUTDOWN_SECONDS = int(os.getenv("GRACEFUL_SHUTDOWN_SECONDS", "10"))
+
+
+def available_cpus() -> int:
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        # cgroup v2 quota, e.g. "200000 100000" for `docker run --cpus 2`; "max ..." means unlimited
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY") or 0) or available_cpus())
+    args = parser.parse_args()
+    os.environ["WEB_CONCURRENCY"] = str(args.workers)
+
+    # Once, before any worker imports the app (which only checks the schema version)
+    from dotenv import load_dotenv
+    load_dotenv()
+    import database, migrations
+    migrations.upgrade(database.engine)
+    database.engine.dispose()
+
+    print(f"Starting {args.workers} worker(s) on {args.host}:{args.port}")
+    # /events streams stay open, so shutdown waits this long for them before closing them
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers,
+                timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_SECONDS)
+
+
+if __name__ == "__main__":
+    main()
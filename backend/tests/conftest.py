@@ -0,0 +1,48 @@
+"""
+Shared fixtures: the app runs against a throwaway SQLite database, migrated at
+import (AUTO_MIGRATE) with an admin user. Run from the backend directory:
+    python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+
+# database.py and main.py read their settings at import, so these come first
+_DB_DIR = tempfile.mkdtemp(prefix="lab_app_tests_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'test.db')}"
+os.environ["AUTO_MIGRATE"] = "on"
+os.environ["ADMIN_PASSWORD"] = "admin-password"
+os.environ["BCRYPT_ROUNDS"] = "4"
+os.environ["USER_CACHE_TTL_SECONDS"] = "0"
+# Streams end on their own shortly, so a test can read a whole /events body
+os.environ["EVENTS_MAX_STREAM_SECONDS"] = "0.5"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+import main
+
+ADMIN_PASSWORD = os.environ["ADMIN_PASSWORD"]
+
+
+@pytest.fixture(scope="session")
+def client():
+    # /token allows five logins a minute per address, and every test logs in
+    main.limiter.enabled = False
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def login(client, username="admin", password=ADMIN_PASSWORD) -> dict:
+    response = client.post("/token", data={"username": username, "password": password})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def bearer(tokens: dict) -> dict:
+    return {"Authorization": f"Bearer {tokens['access_token']}"}
+
+
+@pytest.fixture
+def admin_headers(client):
+    return bearer(login(client))
@@ -0,0 +1,53 @@
+import io
+import json
+import crud
+import models
+from database import SessionLocal
+
+HEADER = "first_name,last_name,birth_date,nationality,personal_number,address\n"
+
+
+def csv_row(personal_number: str) -> str:
+    return f"Nino,Beridze,1990-01-01,GE,{personal_number},\n"
+
+
+def upload(client, headers, body: bytes, filename: str, **params):
+    return client.post("/patients/bulk", params=params, headers=headers, files={"file": (filename, body)})
+
+
+def test_bad_utf8_is_reported_per_row(client, admin_headers):
+    rows = [csv_row(f"BULK-UTF-{n}") for n in range(250)]
+    body = (HEADER + "".join(rows[:200])).encode() + b"Nin\xff,Beridze,1990-01-01,GE,BULK-UTF-BAD,\n" + "".join(rows[200:]).encode()
+    response = upload(client, admin_headers, body, "patients.csv", chunk_size=100)
+    assert response.status_code == 200
+    assert response.json() == {"created": 250, "errors": [{"row": 201, "personal_number": None, "error": "Row is not valid UTF-8."}]}
+
+
+def test_bad_utf8_in_jsonl(client, admin_headers):
+    good = {"first_name": "Nino", "last_name": "Beridze", "birth_date": "1990-01-01", "nationality": "GE", "personal_number": "BULK-JL-1"}
+    body = json.dumps(good).encode() + b'\n{"first_name": "\xc3"}\n'
+    report = upload(client, admin_headers, body, "patients.jsonl").json()
+    assert report == {"created": 1, "errors": [{"row": 2, "personal_number": None, "error": "Row is not valid UTF-8."}]}
+
+
+def test_non_string_personal_number_is_reported(client, admin_headers):
+    record = {"first_name": "Nino", "last_name": "Beridze", "birth_date": "1990-01-01", "nationality": "GE"}
+    body = "".join(json.dumps({**record, "personal_number": value}) + "\n" for value in (["x"], 12345, {"a": 1})).encode()
+    response = upload(client, admin_headers, body, "patients.jsonl")
+    assert response.status_code == 200
+    errors = response.json()["errors"]
+    assert [(e["row"], e["personal_number"]) for e in errors] == [(1, None), (2, None), (3, None)]
+
+
+def test_conflict_at_insert_retries_row_by_row(client, admin_headers, monkeypatch):
+    upload(client, admin_headers, (HEADER + csv_row("BULK-RACE-2")).encode(), "patients.csv")
+    records = [(n, {"first_name": "Nino", "last_name": "Beridze", "birth_date": "1990-01-01",
+                    "nationality": "GE", "personal_number": f"BULK-RACE-{n}"}) for n in (1, 2, 3)]
+    with SessionLocal() as db:
+        admin = db.query(models.User).filter_by(user_name="admin").one()
+        # Make the duplicate lookup miss, as if another writer inserted BULK-RACE-2 right after it
+        monkeypatch.setattr(db, "scalars", lambda *args, **kwargs: iter(()))
+        report = crud.bulk_create_patients(db, iter(records), admin)
+    assert report["created"] == 2
+    assert [(e["row"], e["personal_number"]) for e in report["errors"]] == [(2, "BULK-RACE-2")]
+    assert report["errors"][0]["error"].startswith("Could not be inserted:")
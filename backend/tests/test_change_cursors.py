@@ -0,0 +1,70 @@
+import base64
+import json
+import pytest
+import change_feed, crud
+
+
+def cursor_of(key) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+EMPTY_CURSOR = cursor_of([]) # "W10", what a first page carries
+BOOL_CURSOR = cursor_of([True])
+HUGE_CURSOR = cursor_of([10**30]) # past SQLite's INTEGER range
+
+
+def test_parse_since():
+    assert change_feed.parse_since("") is None
+    assert change_feed.parse_since(EMPTY_CURSOR) is None
+    assert change_feed.parse_since(cursor_of([7])) == 7
+    for malformed in (BOOL_CURSOR, cursor_of([False]), cursor_of(["7"]), cursor_of([1, 2]), "not a cursor!",
+                      HUGE_CURSOR, cursor_of([2**63]), cursor_of([-1]), cursor_of([1.5])):
+        assert change_feed.parse_since(malformed) is False
+    assert change_feed.parse_since(cursor_of([2**63 - 1])) == 2**63 - 1
+
+
+def test_parse_patients_and_history_cursors():
+    assert crud.parse_patients_cursor(cursor_of([7])) == 7
+    for malformed in (BOOL_CURSOR, HUGE_CURSOR, cursor_of([-1])):
+        assert crud.parse_patients_cursor(malformed) is False
+    timestamp = "2024-01-01T00:00:00"
+    assert crud.parse_history_cursor(cursor_of([timestamp, 7]))[1] == 7
+    for bad_id in (True, 10**30, -1, "7", 7.0):
+        assert crud.parse_history_cursor(cursor_of([timestamp, bad_id])) is False
+
+
+@pytest.mark.parametrize("path, cursor", [
+    ("/patients/", BOOL_CURSOR), ("/patients/", HUGE_CURSOR),
+    ("/history/", cursor_of(["2024-01-01T00:00:00", True])), ("/history/", cursor_of(["2024-01-01T00:00:00", 10**30])),
+    ("/changes", HUGE_CURSOR),
+])
+def test_out_of_range_cursors_are_rejected(client, admin_headers, path, cursor):
+    param = "since" if path == "/changes" else "cursor"
+    assert client.get(path, params={param: cursor}, headers=admin_headers).status_code == 400
+
+
+def test_changes_rejects_bool_cursor(client, admin_headers):
+    assert client.get("/changes", params={"since": BOOL_CURSOR}, headers=admin_headers).status_code == 400
+
+
+def test_changes_with_empty_cursor_returns_head(client, admin_headers):
+    head = client.get("/changes", headers=admin_headers).json()
+    assert client.get("/changes", params={"since": EMPTY_CURSOR}, headers=admin_headers).json() == head
+
+
+@pytest.mark.parametrize("how", ["query", "header"])
+def test_events_rejects_bool_cursor(client, admin_headers, how):
+    kwargs = {"params": {"since": BOOL_CURSOR}} if how == "query" else {"headers": {"Last-Event-ID": BOOL_CURSOR}}
+    kwargs.setdefault("headers", {}).update(admin_headers)
+    assert client.get("/events", **kwargs).status_code == 400
+
+
+@pytest.mark.parametrize("how", ["query", "header"])
+def test_events_with_empty_cursor_starts_from_head(client, admin_headers, how):
+    head = client.get("/changes", headers=admin_headers).json()["cursor"]
+    kwargs = {"params": {"since": EMPTY_CURSOR}} if how == "query" else {"headers": {"Last-Event-ID": EMPTY_CURSOR}}
+    kwargs.setdefault("headers", {}).update(admin_headers)
+    # The stream closes by itself after EVENTS_MAX_STREAM_SECONDS (see conftest.py)
+    response = client.get("/events", **kwargs)
+    assert response.status_code == 200
+    assert response.text.startswith(f"retry: 1000\nid: {head}\n\n")
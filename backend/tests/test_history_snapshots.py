@@ -0,0 +1,41 @@
+from datetime import datetime, timezone
+from sqlalchemy import select, func
+import history_snapshots, models
+from database import SessionLocal
+
+
+def patient_payload(first_name: str) -> dict:
+    return {"first_name": first_name, "last_name": "Snapshot", "birth_date": "2000-01-01",
+            "nationality": "GE", "personal_number": "snapshot-1"}
+
+
+def snapshot_count(patient_id: int) -> int:
+    snapshot = models.HistorySnapshot
+    with SessionLocal() as db:
+        return db.scalar(select(func.count()).select_from(snapshot)
+                         .where(snapshot.entity_type == "Patient", snapshot.entity_id == patient_id))
+
+
+def test_snapshots_every_n_entries_and_as_of_replays_from_them(client, admin_headers):
+    every = history_snapshots.HISTORY_SNAPSHOT_EVERY
+    patient_id = client.post("/patients/", json=patient_payload("v0"), headers=admin_headers).json()["id"]
+    marks = [datetime.now(timezone.utc)]
+    for version in range(1, 2 * every + 5):
+        response = client.put(f"/patients/{patient_id}", json=patient_payload(f"v{version}"), headers=admin_headers)
+        assert response.status_code == 200
+        marks.append(datetime.now(timezone.utc))
+    # The CREATE entry counts too
+    assert snapshot_count(patient_id) == len(marks) // every
+
+    for version, ts in enumerate(marks):
+        response = client.get(f"/history/patient/{patient_id}/as-of", params={"ts": ts.isoformat()}, headers=admin_headers)
+        assert response.status_code == 200
+        body = response.json()
+        assert body["complete"] and body["state"]["first_name"] == f"v{version}"
+        assert body["replayed"] <= every
+
+
+def test_as_of_rejects_unknown_types_and_entities(client, admin_headers):
+    ts = datetime.now(timezone.utc).isoformat()
+    assert client.get("/history/anexrecord/1/as-of", params={"ts": ts}, headers=admin_headers).status_code == 400
+    assert client.get("/history/patient/999999/as-of", params={"ts": ts}, headers=admin_headers).status_code == 404
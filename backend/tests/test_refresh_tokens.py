@@ -0,0 +1,105 @@
+import itertools
+from datetime import datetime, timedelta, timezone
+import pytest
+from sqlalchemy import update
+import auth, models
+from database import SessionLocal
+from conftest import bearer, login
+
+_names = itertools.count(1)
+
+
+@pytest.fixture
+def staff(client, admin_headers):
+    """A new approved staff user: (id, user_name, password)."""
+    name, password = f"refresh-staff-{next(_names)}", "staff-password"
+    response = client.post("/admin/users/", headers=admin_headers, json={
+        "first_name": "Refresh", "last_name": "Staff", "email": f"{name}@example.com",
+        "user_name": name, "password": password, "role": "staff"})
+    assert response.status_code == 200, response.text
+    return response.json()["id"], name, password
+
+
+def refresh(client, token: str):
+    return client.post("/token/refresh", json={"refresh_token": token})
+
+
+def set_user(user_id: int, **values):
+    with SessionLocal() as db:
+        db.execute(update(models.User).where(models.User.id == user_id).values(**values))
+        db.commit()
+
+
+def test_rotation_issues_a_working_successor(client, staff):
+    _, name, password = staff
+    first = login(client, name, password)
+    response = refresh(client, first["refresh_token"])
+    assert response.status_code == 200
+    second = response.json()
+    assert second["refresh_token"] != first["refresh_token"]
+    assert client.get("/users/list", headers=bearer(second)).status_code == 200
+    assert refresh(client, second["refresh_token"]).status_code == 200
+
+
+def test_reused_token_is_rejected_and_revokes_its_family(client, staff):
+    _, name, password = staff
+    first = login(client, name, password)
+    second = refresh(client, first["refresh_token"]).json()
+    third = refresh(client, second["refresh_token"]).json()
+    other_session = login(client, name, password)
+
+    reuse = refresh(client, first["refresh_token"])
+    assert reuse.status_code == 401
+    assert reuse.headers["WWW-Authenticate"] == "Bearer"
+    # The newest token of the family dies with it; the user's other sessions do not
+    assert refresh(client, third["refresh_token"]).status_code == 401
+    assert refresh(client, other_session["refresh_token"]).status_code == 200
+
+
+def test_revoked_token_is_rejected(client, staff):
+    _, name, password = staff
+    tokens = login(client, name, password)
+    assert client.post("/token/revoke", json={"refresh_token": tokens["refresh_token"]}).status_code == 204
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
+
+
+def test_expired_token_is_rejected(client, staff):
+    _, name, password = staff
+    tokens = login(client, name, password)
+    with SessionLocal() as db:
+        db.execute(update(models.RefreshToken)
+                   .where(models.RefreshToken.token_hash == auth.hash_refresh_token(tokens["refresh_token"]))
+                   .values(expires_at=datetime.now(timezone.utc) - timedelta(seconds=1)))
+        db.commit()
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
+
+
+def test_unknown_token_is_rejected(client):
+    assert refresh(client, "not-a-refresh-token").status_code == 401
+
+
+def test_blocking_a_user_ends_their_refresh_tokens(client, admin_headers, staff):
+    user_id, name, password = staff
+    tokens = login(client, name, password)
+    assert client.post(f"/admin/users/{user_id}/block", json={"is_blocked": True}, headers=admin_headers).status_code == 200
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
+    # Unblocking does not bring the revoked tokens back
+    assert client.post(f"/admin/users/{user_id}/block", json={"is_blocked": False}, headers=admin_headers).status_code == 200
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
+
+
+@pytest.mark.parametrize("flags, detail", [
+    ({"is_blocked": True}, "This account has been blocked."),
+    ({"is_approved": False}, "Account not approved by admin."),
+])
+def test_blocked_or_unapproved_user_cannot_refresh(client, staff, flags, detail):
+    user_id, name, password = staff
+    tokens = login(client, name, password)
+    # Set directly, so the exchange itself has to refuse a token that is still valid
+    set_user(user_id, **flags)
+    response = refresh(client, tokens["refresh_token"])
+    assert response.status_code == 403
+    assert response.json()["detail"] == detail
+    # The refused token was used up all the same
+    set_user(user_id, is_blocked=False, is_approved=True)
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
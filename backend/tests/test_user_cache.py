@@ -0,0 +1,25 @@
+from sqlalchemy import update
+import auth, caching, models
+from database import SessionLocal
+from conftest import bearer, login
+
+
+def test_change_committed_by_another_worker_reaches_cached_principal(client, admin_headers, monkeypatch):
+    monkeypatch.setattr(auth, "USER_CACHE_TTL_SECONDS", 30)
+    name, password = "cache-staff", "staff-password"
+    response = client.post("/admin/users/", headers=admin_headers, json={
+        "first_name": "Cache", "last_name": "Staff", "email": f"{name}@example.com",
+        "user_name": name, "password": password, "role": "staff"})
+    user_id = response.json()["id"]
+    headers = bearer(login(client, name, password))
+    assert client.get("/users/list", headers=headers).status_code == 200
+    assert name in auth._user_cache
+
+    # A block committed through another worker: same database, but this worker's cache is never told
+    with SessionLocal() as db:
+        db.execute(update(models.User).where(models.User.id == user_id).values(is_blocked=True))
+        caching.bump(db, "users")
+        db.commit()
+    response = client.get("/users/list", headers=headers)
+    assert response.status_code == 403
+    assert response.json()["detail"] == "Your account is blocked."
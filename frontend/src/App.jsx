@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useCallback, useMemo } from 'react';
+import React, { useState, useEffect, useCallback, useMemo, useRef } from 'react';
 import { BrowserRouter, Routes, Route, useNavigate, useSearchParams } from 'react-router-dom';
 import axios from 'axios';
 import { jwtDecode } from 'jwt-decode';
@@ -72,6 +72,95 @@ apiClient.interceptors.request.use((config) => {
   return config;
 }, (error) => Promise.reject(error));
 
+// Access tokens expire after 30 minutes; a stored refresh token renews them without re-entering the password.
+// Concurrent 401s share one refresh request, since each refresh token can be used only once.
+let refreshRequest = null;
+const refreshAccessToken = () => {
+  const refreshToken = localStorage.getItem('refreshToken');
+  if (!refreshToken) return Promise.reject(new Error('No refresh token'));
+  if (!refreshRequest) {
+    refreshRequest = axios.post(`${API_BASE_URL}/token/refresh`, { refresh_token: refreshToken })
+      .then((response) => {
+        localStorage.setItem('accessToken', response.data.access_token);
+        localStorage.setItem('refreshToken', response.data.refresh_token);
+        return response.data.access_token;
+      })
+      .catch((error) => {
+        localStorage.removeItem('accessToken');
+        localStorage.removeItem('refreshToken');
+        throw error;
+      })
+      .finally(() => { refreshRequest = null; });
+  }
+  return refreshRequest;
+};
+
+apiClient.interceptors.response.use((response) => response, async (error) => {
+  const config = error.config;
+  if (error.response?.status !== 401 || !config || config._retried || config.url?.startsWith('/token')) {
+    return Promise.reject(error);
+  }
+  try {
+    const token = await refreshAccessToken();
+    config._retried = true;
+    config.headers.Authorization = `Bearer ${token}`;
+    return apiClient(config);
+  } catch {
+    return Promise.reject(error);
+  }
+});
+
+// Pushed data changes from GET /events, as lists of { entity_type, entity_id, deleted, data }; null means reload everything.
+// EventSource cannot send the Authorization header, so the stream is read with fetch. It reconnects from the
+// last event id when the server closes it (every few minutes) or the connection drops.
+const useDataChanges = (types, onChanges) => {
+  const handler = useRef(onChanges);
+  handler.current = onChanges;
+  useEffect(() => {
+    const controller = new AbortController();
+    let lastEventId = '';
+    const listen = async () => {
+      while (!controller.signal.aborted) {
+        try {
+          const headers = { Authorization: `Bearer ${localStorage.getItem('accessToken')}` };
+          if (lastEventId) headers['Last-Event-ID'] = lastEventId;
+          const response = await fetch(`${API_BASE_URL}/events?types=${types}`, { headers, signal: controller.signal });
+          if (response.status === 401) {
+            try { await refreshAccessToken(); continue; } catch { return; }
+          }
+          if (response.status === 400) lastEventId = '';
+          if (!response.ok) throw new Error(`HTTP ${response.status}`);
+          const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+          let buffer = '';
+          for (;;) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += value;
+            let end;
+            while ((end = buffer.indexOf('\n\n')) >= 0) {
+              const fields = {};
+              for (const line of buffer.slice(0, end).split('\n')) {
+                const colon = line.indexOf(':');
+                if (colon > 0) fields[line.slice(0, colon)] = line.slice(colon + 1).trimStart();
+              }
+              buffer = buffer.slice(end + 2);
+              if (fields.id) lastEventId = fields.id;
+              if (fields.event === 'changes') handler.current(JSON.parse(fields.data).changes);
+              if (fields.event === 'reload') handler.current(null);
+            }
+          }
+        } catch (error) {
+          if (controller.signal.aborted) return;
+          console.error("Change stream interrupted:", error);
+          await new Promise((resolve) => setTimeout(resolve, 1000));
+        }
+      }
+    };
+    listen();
+    return () => controller.abort();
+  }, [types]);
+};
+
 const FormModal = ({ title, children, onClose, onSubmit, apiError }) => (
     <div className="modal-backdrop">
         <div className="modal-content" style={{maxWidth: '600px'}}>
@@ -325,6 +414,7 @@ const Login = ({ onLoginSuccess }) => {
       const response = await apiClient.post('/token', new URLSearchParams({ username, password }));
       const token = response.data.access_token;
       localStorage.setItem('accessToken', token);
+      localStorage.setItem('refreshToken', response.data.refresh_token);
       onLoginSuccess(token);
       navigate('/');
     } catch (err) {
@@ -544,6 +634,20 @@ const PatientsView = ({ user }) => {
         fetchPatients(filters);
     }, [fetchPatients]);
 
+    // Patients already listed are updated in place; a new one may or may not match the filters, so search again
+    useDataChanges('Patient', (changes) => {
+        const listed = new Set(patients.map(p => p.id));
+        if (!changes || changes.some(c => !c.deleted && !listed.has(c.entity_id))) {
+            fetchPatients(filters);
+            return;
+        }
+        const byId = new Map(changes.map(c => [c.entity_id, c]));
+        setPatients(prev => prev.flatMap(p => {
+            const change = byId.get(p.id);
+            return !change ? [p] : change.deleted ? [] : [change.data];
+        }));
+    });
+
     const handleFilterChange = (e) => {
         const { name, value } = e.target;
         setFilters(prev => ({ ...prev, [name]: value }));
@@ -1007,6 +1111,9 @@ const HistoryView = ({ user }) => {
         fetchHistory(filters);
     }, [fetchHistory]);
 
+    // Every change writes a history entry
+    useDataChanges('Patient,Finance,Service,User', () => fetchHistory(filters));
+
     const handleFilterChange = (e) => {
         const { name, value } = e.target;
         setFilters(prev => ({ ...prev, [name]: value }));
@@ -1102,21 +1209,28 @@ function App() {
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
-    const token = localStorage.getItem('accessToken');
-    if (token) {
+    const restoreSession = async () => {
+        let token = localStorage.getItem('accessToken');
         try {
-            const decoded = jwtDecode(token);
-            if (decoded.exp * 1000 > Date.now()) {
-                setUser({ role: decoded.role, username: decoded.sub });
-            } else {
+            if (token && jwtDecode(token).exp * 1000 <= Date.now()) {
                 localStorage.removeItem('accessToken');
+                token = null;
             }
         } catch (error) {
             console.error("ტოკენი არ არის ვალიდური");
             localStorage.removeItem('accessToken');
+            token = null;
         }
-    }
-    setLoading(false);
+        if (!token && localStorage.getItem('refreshToken')) {
+            token = await refreshAccessToken().catch(() => null);
+        }
+        if (token) {
+            const decoded = jwtDecode(token);
+            setUser({ role: decoded.role, username: decoded.sub });
+        }
+        setLoading(false);
+    };
+    restoreSession();
   }, []);
   
   const handleLoginSuccess = (token) => {
@@ -1129,7 +1243,10 @@ function App() {
   };
   
   const handleLogout = (navigate) => {
+    const refreshToken = localStorage.getItem('refreshToken');
+    if (refreshToken) { apiClient.post('/token/revoke', { refresh_token: refreshToken }).catch(() => {}); }
     localStorage.removeItem('accessToken');
+    localStorage.removeItem('refreshToken');
     setUser(null);
     navigate('/login');
   };